@@ -0,0 +1,203 @@
+'''
+Offline crawl benchmark. A synthetic site is served locally, and each
+scenario crawls it in a fresh process, so the peak RSS is its own:
+
+    python -m crawler.bench.runner --pages 2000 --output bench.json
+    python -m crawler.bench.runner --pages 2000 --baseline bench.json
+
+With a baseline, the run fails if the throughput of a scenario dropped,
+or its peak RSS grew, by more than the tolerance.
+'''
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+from crawler.bench.synthetic import SyntheticSite
+from crawler.core.common import CrawlerConf, TaskConf, CrawlMode, Key, LoggerFactory
+from crawler.core.crawlers import DefaultCrawler, UrlTask
+from crawler.core.http import DefaultHttpEngine, AsyncHttpEngine
+from crawler.core.manager import DefaultCrawlerManager
+from crawler.core.stats import CrawlStats
+from crawler.core.storage import CrawlerStorage
+
+
+RUNNERS = ('crawler', 'manager')
+MODES = {'simple' : CrawlMode.SIMPLE, 'storage' : CrawlMode.STORAGE}
+ENGINES = {'default' : DefaultHttpEngine, 'async' : AsyncHttpEngine}
+
+
+def run_scenario(runner, mode, engine, domain, max_depth):
+    '''
+    Crawl the site once, return the report of the scenario.
+    '''
+    # both runners log alike, the manager starts the logger factory
+    LoggerFactory.start()
+    work_dir = tempfile.mkdtemp(prefix='crawler-bench-')
+    db = os.path.join(work_dir, 'bench.db')
+    CrawlStats.reset()
+    start = time.perf_counter()
+    try:
+        if runner == 'manager':
+            _run_manager(MODES[mode], ENGINES[engine], domain, max_depth, work_dir, db)
+        else:
+            _run_crawler(MODES[mode], ENGINES[engine], domain, max_depth, db)
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    stats = CrawlStats.snapshot()
+    fetch = stats['stages'].get('fetch', {})
+    # parse and store of a page, after its fetch
+    process = stats['stages'].get('process', {})
+    pages = stats['counters'].get('pages', 0)
+    return {
+        'scenario' : '-'.join((runner, mode, engine)),
+        'pages' : pages,
+        'elapsed' : elapsed,
+        'pages_per_sec' : pages / elapsed if elapsed > 0 else 0.0,
+        'fetch_p50' : fetch.get('p50', 0.0),
+        'fetch_p99' : fetch.get('p99', 0.0),
+        'process_p50' : process.get('p50', 0.0),
+        'process_p99' : process.get('p99', 0.0),
+        'peak_rss_kb' : peak_rss_kb(),
+        'stats' : stats
+    }
+
+
+def _run_crawler(mode, engine_class, domain, max_depth, db):
+    crawler_conf = CrawlerConf()
+    crawler_conf.mode = mode
+    crawler_conf.http_engine = engine_class()
+    if mode == CrawlMode.STORAGE:
+        crawler_conf.storage = CrawlerStorage(db=db)
+        crawler_conf.storage.initialize()
+    task_conf = TaskConf(domain)
+    task_conf.max_depth = max_depth
+    try:
+        DefaultCrawler(crawler_conf).crawl(UrlTask(task_conf))
+    finally:
+        if crawler_conf.storage:
+            crawler_conf.storage.close()
+        crawler_conf.http_engine.close()
+
+
+def _run_manager(mode, engine_class, domain, max_depth, work_dir, db):
+    task_file = os.path.join(work_dir, 'seeds.conf')
+    with open(task_file, 'w') as f:
+        f.write('%s, -1, 0, %d, false, 3000, 30000\n' % (domain, max_depth))
+    settings = {
+        Key.CRAWLER_CRAWL_MODE          :   mode,
+        Key.CRAWLER_TASK_FILE           :   task_file,
+        Key.CRAWLER_HTTP_ENGINE_CLASS   :   engine_class,
+        Key.CRAWLER_STORAGE_CLASS       :   CrawlerStorage,
+        Key.CRAWLER_STORAGE_DB          :   db
+    }
+    DefaultCrawlerManager(settings).wait_for()
+
+
+def peak_rss_kb():
+    '''
+    Return the peak resident set size of the process in KB, or None if
+    it is unknown on this platform.
+    '''
+    try:
+        # unlike ru_maxrss, reset by exec so not inherited from the parent
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB on Linux
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def compare(reports, baseline, tolerance):
+    '''
+    Return the regressions of reports against baseline reports.
+    '''
+    regressions = []
+    previous = {report['scenario'] : report for report in baseline}
+    for report in reports:
+        before = previous.get(report['scenario'])
+        if not before:
+            continue
+        if report['pages_per_sec'] < before['pages_per_sec'] * (1 - tolerance):
+            regressions.append('%s: pages/sec %.1f < %.1f' % (report['scenario'],
+                               report['pages_per_sec'], before['pages_per_sec']))
+        if report['peak_rss_kb'] and before.get('peak_rss_kb') and \
+                report['peak_rss_kb'] > before['peak_rss_kb'] * (1 + tolerance):
+            regressions.append('%s: peak RSS %d KB > %d KB' % (report['scenario'],
+                               report['peak_rss_kb'], before['peak_rss_kb']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline crawl benchmark on a synthetic site.')
+    parser.add_argument('--pages', type=int, default=1000, help='number of pages of the site')
+    parser.add_argument('--page-size', type=int, default=8192, help='size of a page in bytes')
+    parser.add_argument('--fan-out', type=int, default=8, help='links to new pages on a page')
+    parser.add_argument('--latency', type=float, default=0.0, help='server latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a 500 response')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the site generator')
+    parser.add_argument('--runners', default=','.join(RUNNERS), help='crawler, manager')
+    parser.add_argument('--modes', default=','.join(MODES), help='simple, storage')
+    parser.add_argument('--engines', default='default', help='default, async')
+    parser.add_argument('--output', help='write the reports to a JSON file')
+    parser.add_argument('--baseline', help='JSON file of reports to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative regression')
+    args = parser.parse_args(argv)
+
+    site = SyntheticSite(args.pages, args.page_size, args.fan_out, args.latency, args.error_rate, args.seed)
+    site.start()
+    reports = []
+    try:
+        for runner in args.runners.split(','):
+            for mode in args.modes.split(','):
+                for engine in args.engines.split(','):
+                    # a fresh process per scenario, for its own peak RSS
+                    context = multiprocessing.get_context('spawn')
+                    with ProcessPoolExecutor(1, mp_context=context) as executor:
+                        future = executor.submit(run_scenario, runner.strip(), mode.strip(), engine.strip(),
+                                                 site.domain, site.max_depth())
+                        report = future.result()
+                    reports.append(report)
+                    print('%-24s pages = %-6d pages/sec = %-8.1f fetch p50 = %.2f ms, p99 = %.2f ms, '
+                          'process p50 = %.2f ms, p99 = %.2f ms, peak RSS = %s KB'
+                          % (report['scenario'], report['pages'], report['pages_per_sec'],
+                             report['fetch_p50'] * 1000, report['fetch_p99'] * 1000,
+                             report['process_p50'] * 1000, report['process_p99'] * 1000,
+                             report['peak_rss_kb']))
+    finally:
+        site.stop()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(reports, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
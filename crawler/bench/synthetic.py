@@ -0,0 +1,131 @@
+from functools import lru_cache
+import hashlib
+import http.server
+import random
+import sys
+import threading
+import time
+
+
+class SyntheticSite:
+    '''
+    Local HTTP server generating a deterministic site graph: page n links
+    to pages n * fan_out + 1 ... n * fan_out + fan_out, so the graph is a
+    tree covering every page, plus a link back to the home page. Pages
+    are padded with words picked by a generator seeded by the page
+    number, so the same seed serves the same site on every run. A page
+    fails with a 500 response with probability error_rate, and every
+    response waits latency seconds.
+    '''
+    WORDS = [hashlib.md5(str(i).encode('ascii')).hexdigest()[:i % 7 + 3] for i in range(1024)]
+
+    def __init__(self, page_count=1000, page_size=8192, fan_out=8, latency=0.0, error_rate=0.0, seed=0):
+        self.page_count = page_count
+        self.page_size = page_size
+        self.fan_out = fan_out
+        self.latency = latency
+        self.error_rate = error_rate
+        self.seed = seed
+        self.__server = None
+        self.__render = lru_cache(maxsize=4096)(self.__render_page)
+
+    def start(self, port=0):
+        handler = type('SyntheticHandler', (_SyntheticHandler, ), {'site' : self})
+        self.__server = _SyntheticServer(('127.0.0.1', port), handler)
+        threading.Thread(target=self.__server.serve_forever, name='synthetic-site', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.__server:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+    @property
+    def domain(self):
+        return '127.0.0.1:' + str(self.__server.server_address[1])
+
+    def max_depth(self):
+        '''
+        Return the depth reaching every page of the tree.
+        '''
+        depth = 0
+        reached = 1
+        width = 1
+        while reached < self.page_count and self.fan_out > 0:
+            width *= self.fan_out
+            reached += width
+            depth += 1
+        return depth
+
+    def page(self, n):
+        '''
+        Return the (status_code, body) of page n.
+        '''
+        return self.__render(n)
+
+    def __render_page(self, n):
+        rng = random.Random(self.seed * 1000003 + n)
+        if n and rng.random() < self.error_rate:
+            return 500, b'<html><body>Internal Server Error</body></html>'
+        links = ['<a href="/">home</a>']
+        for i in range(1, self.fan_out + 1):
+            child = n * self.fan_out + i
+            if child < self.page_count:
+                links.append('<a href="/p/%d">page %d</a>' % (child, child))
+        head = '<html><head><title>page %d</title></head><body>%s<p>' % (n, ''.join(links))
+        tail = '</p></body></html>'
+        words = []
+        size = len(head) + len(tail)
+        while size < self.page_size:
+            word = rng.choice(SyntheticSite.WORDS)
+            words.append(word)
+            size += len(word) + 1
+        return 200, (head + ' '.join(words) + tail).encode('ascii')
+
+
+class _SyntheticServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 drops the connections of concurrent engines
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # clients closing connections early are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super(_SyntheticServer, self).handle_error(request, client_address)
+
+
+class _SyntheticHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are separate writes, which stall on delayed ACKs
+    disable_nagle_algorithm = True
+    site = None
+
+    def do_GET(self):
+        site = self.site
+        if site.latency:
+            time.sleep(site.latency)
+        n = self.__page_number(self.path)
+        if n is None or n >= site.page_count:
+            status_code, body = 404, b'<html><body>Not Found</body></html>'
+        else:
+            status_code, body = site.page(n)
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+    @staticmethod
+    def __page_number(path):
+        if path in ('', '/'):
+            return 0
+        if path.startswith('/p/'):
+            try:
+                return int(path[3:])
+            except ValueError:
+                pass
+        return None
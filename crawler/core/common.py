@@ -1,7 +1,15 @@
 from abc import ABCMeta, abstractmethod
+import atexit
 import copy
 import logging
-import socket
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import threading
+from urllib.parse import urlsplit
+
+from crawler.core.resolver import DnsResolver
+from crawler.core.stats import CrawlStats
+from crawler.core.urls import UrlNormalizer
 
 
 class CrawlMode:
@@ -22,6 +30,10 @@ class Key:
     CRAWLER_TASK_FILE = 'crawler.task.file'
     CRAWLER_STORAGE_CLASS = 'crawler.storage.class'
     CRAWLER_HTTP_ENGINE_CLASS = 'crawler.http.engine.class'
+    CRAWLER_STORAGE_DB = 'crawler.storage.db'
+    CRAWLER_PROCESS_COUNT = 'crawler.process.count'
+    CRAWLER_FRONTIER_DB = 'crawler.frontier.db'
+    CRAWLER_RECRAWL_INTERVAL = 'crawler.recrawl.interval'
         
 
 class CrawlerConf:
@@ -34,11 +46,29 @@ class CrawlerConf:
         self.http_engine = None
         self.storage = None
         self.max_depth = 0
+        # max number of url tasks waiting in the frontier, -1 for unbounded
+        self.max_frontier_size = -1
+        # file of a disk-backed, resumable frontier, None to keep it in memory
+        self.frontier_db = None
+        # max number of url tasks a disk-backed frontier holds in memory
+        self.frontier_memory_size = 10000
+        # skip storing and expanding pages whose content was seen before
+        self.skip_duplicates = True
+        # worker threads per pipeline stage, as in {'fetch' : 8, 'parse' : 2,
+        # 'normalize' : 1, 'store' : 1}, None to crawl on the calling thread
+        self.stage_workers = None
+        # max number of items waiting for a pipeline stage
+        self.stage_queue_size = 64
        
     @classmethod 
     def clone(cls, crawler_conf=None):
         if crawler_conf:
-            copier = copy.deepcopy(crawler_conf)
+            # HTTP engine and storage are shared, not copied
+            memo = {
+                id(crawler_conf.http_engine) : crawler_conf.http_engine,
+                id(crawler_conf.storage) : crawler_conf.storage
+            }
+            copier = copy.deepcopy(crawler_conf, memo)
         else:
             copier = CrawlerConf()
         return copier
@@ -46,29 +76,37 @@ class CrawlerConf:
         
 class TaskConf:
     '''
-    A crawl task configuration object.
+    A crawl task configuration object. The configuration of a seed is
+    shared by all url tasks built from it, and frozen once it is shared.
     '''
+    __slots__ = ('domain', 'url', 'max_url_count', 'priority', 'max_depth',
+                 'cross_host_allowed', 'connect_timeout', 'socket_timeout', 'max_body_size',
+                 'max_redirects', '_frozen')
+    SCHEMES = ('http', 'https')
+    
     def __init__(self, domain):
+        self._frozen = False
         # process domain or url
+        scheme = 'http'
         if domain:
-            domain = domain.lower()
-            if domain.startswith('https://'):
-                raise ValueError('Unsupported HTTPS link!')
-            elif domain.startswith('http://'):
-                if domain.endswith('/'):
-                    self.domain = domain[7:len(domain) - 2]
-                else:
-                    self.domain = domain[7:len(domain) - 1]
+            domain = domain.lower().strip()
+            if '://' in domain:
+                parts = urlsplit(domain)
+                if parts.scheme not in TaskConf.SCHEMES:
+                    raise ValueError('Unsupported scheme: ' + domain)
+                scheme = parts.scheme
+                self.domain = parts.netloc
             else:
-                self.domain = domain
+                self.domain = domain.rstrip('/')
         else:
             raise ValueError('Invalid domain string!')
         if self.domain:
             if self.domain.startswith('www.'):
                 self.domain = self.domain[4:]
-            self.url = 'http://' + self.domain
-            self.ip_addr = self.__get_addr_info(self.domain)
-        print('domain = ' + self.domain)
+            # canonical like the links to it, so the frontier sees one url
+            url = scheme + '://' + self.domain
+            self.url = UrlNormalizer.normalize(url) or url
+        _LOG.debug('domain = %s', self.domain)
         # initialize default value
         self.max_url_count = -1
         self.priority = 0
@@ -76,25 +114,58 @@ class TaskConf:
         self.cross_host_allowed = False
         self.connect_timeout = 3000
         self.socket_timeout = 30000
+        # max decoded size of a response body in bytes, -1 for unbounded
+        self.max_body_size = 10485760
+        # redirects followed by a fetch, 0 to not follow them
+        self.max_redirects = 5
         
-    def __get_addr_info(self, domain):
-        ip = None
+    def freeze(self):
+        '''
+        Make the configuration read-only, and return it.
+        '''
+        object.__setattr__(self, '_frozen', True)
+        return self
+    
+    def frozen(self):
+        '''
+        Return the configuration if it is frozen, or a frozen copy of it,
+        leaving the configuration of the caller modifiable.
+        '''
+        if self._frozen:
+            return self
+        return copy.copy(self).freeze()
+    
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError('Frozen task conf: ' + name)
+        object.__setattr__(self, name, value)
+    
+    def __getstate__(self):
+        return {name : getattr(self, name) for name in TaskConf.__slots__ if hasattr(self, name)}
+    
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+    
+    @property
+    def ip_addr(self):
+        # resolved at first use through the shared DNS cache
         try:
-            ip = socket.getaddrinfo(domain, 'http')[0][4][0]
-        except:
-            print('Fail to get ip addr info.')
-        return ip
+            return DnsResolver.resolve(urlsplit(self.url).hostname)[0][1]
+        except OSError:
+            _LOG.warning('Fail to get ip addr info: url = %s', self.url)
+        return None
     
     @classmethod
     def clone(cls, domain, task_conf):
         copier = None
         # a domain, or a url
         if task_conf:
-            copier = copy.deepcopy(task_conf)
-            if domain.startswith('http://'):
-                copier.url = domain
-            else:
-                copier.url = 'http://' + domain
+            # a clone can be modified
+            copier = copy.copy(task_conf)
+            object.__setattr__(copier, '_frozen', False)
+            url = domain if domain.startswith(('http://', 'https://')) else 'http://' + domain
+            copier.url = UrlNormalizer.normalize(url) or url
         else:
             copier = TaskConf(domain)
         return copier
@@ -149,14 +220,46 @@ class CrawlPolicy:
     def should_crawl(self, url):
         pass
     
+    def can_resume(self, url_task):
+        '''
+        Whether an interrupted crawl of a seed task is left to resume,
+        in which case the seed is crawled even if it is not due.
+        '''
+        return False
+    
     @abstractmethod
     def store(self, url_task):
         pass
 
 class HttpEngine:
     '''
+    Abstract HTTP engine, which fetches the page of a url task.
+    Host is set per request, and response bodies are decoded by their
+    Content-Encoding before they are handed out.
+    The body of a response whose Content-Type is not one of CONTENT_TYPES,
+    or whose Content-Length exceeds the max body size of the task, is not
+    read at all, and the reason is set as the aborted crawl result.
+    A redirect is followed within the domain of the task, unless cross
+    host links are allowed, up to max_redirects hops and never back to a
+    url of the same fetch, nor to a url the follow filter of the crawl
+    result turns down. The urls redirected from go to the redirects of
+    the crawl result, and its url becomes the url fetched last.
     '''
     __metaclass__ = ABCMeta
+    reqHeaders = {
+        'Accept'             : 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+        'Accept-Charset'     : 'utf-8',
+        'Accept-Encoding'    : 'gzip, deflate',
+        'Accept-Language'    : 'en-US;zh-CN',
+        'User-Agent'         : 'Mozilla/5.0 (compatible; MSIE 9.0; Windows NT 6.1; Trident/5.0;'
+    }
+    CHUNK_SIZE = 65536
+    SCHEMES = frozenset(['http', 'https'])
+    DEFAULT_PORTS = {'http' : 80, 'https' : 443}
+    REDIRECT_CODES = frozenset([301, 302, 303, 307, 308])
+    CONTENT_TYPES = frozenset([
+        'text/html', 'application/xhtml+xml', 'application/xml', 'text/xml', 'text/plain'
+    ])
     
     def __init__(self):
         self._initialize()
@@ -166,6 +269,7 @@ class HttpEngine:
         self._status_code = 0
         self._resp_headers = {}
         self._binary_data = None
+        self._aborted = None
         self._exceptions = []
         
     @abstractmethod
@@ -176,11 +280,24 @@ class HttpEngine:
     def reuse(self):
         pass
     
+    def is_async(self):
+        return False
+    
+    def clone(self):
+        '''
+        Return an engine for another thread. The state of a fetch is kept
+        in the engine, so an engine is not shared by threads.
+        '''
+        return self.__class__()
+    
+    def close(self):
+        self._is_reuseable = False
+    
     def get_status_code(self):
         return self._status_code
     
     def get_resp_header(self, key):
-        return self._resp_headers.get(key)
+        return self._resp_headers.get(key.lower())
     
     def get_data(self):
         return self._binary_data
@@ -188,6 +305,58 @@ class HttpEngine:
     def is_reuseable(self):
         return self._is_reuseable
     
+    def _export(self, crawl_result):
+        # copy the fetched status into the crawl result of a url task
+        crawl_result.status_code = self._status_code
+        crawl_result.response_headers = dict(self._resp_headers)
+        crawl_result.binary_data = self._binary_data
+        crawl_result.aborted = self._aborted
+        crawl_result.exceptions.extend(self._exceptions)
+    
+    def _check_head(self, headers, task_conf):
+        # reason not to read the body of a response, or None
+        content_type = headers.get('content-type')
+        if content_type:
+            media_type = content_type.split(';', 1)[0].strip().lower()
+            if media_type not in self.CONTENT_TYPES:
+                return 'Content-Type: ' + media_type
+        content_length = headers.get('content-length', '').strip()
+        max_body_size = task_conf.max_body_size
+        if max_body_size and max_body_size > 0 and content_length.isdigit():
+            if int(content_length) > max_body_size:
+                return 'Content-Length: ' + content_length
+        return None
+    
+    def _follow_redirect(self, crawl_result, status_code, headers, task_conf):
+        # the url a response redirects to if it is followed, or None
+        if status_code not in self.REDIRECT_CODES or not task_conf.max_redirects:
+            return None
+        location = headers.get('location')
+        target_url = UrlNormalizer.normalize(location.strip(), crawl_result.url) if location else None
+        if not target_url:
+            return None
+        if not task_conf.cross_host_allowed and not any(UrlNormalizer.filter_urls([target_url], task_conf.domain)):
+            return None
+        if target_url == crawl_result.url or any(url == target_url for url, _ in crawl_result.redirects):
+            CrawlStats.count('http.redirect_loops')
+            _LOG.debug('Redirect loop: url = %s, location = %s', crawl_result.url, target_url)
+            return None
+        if len(crawl_result.redirects) >= task_conf.max_redirects:
+            CrawlStats.count('http.redirect_limits')
+            _LOG.debug('Too many redirects: url = %s, location = %s', crawl_result.url, target_url)
+            return None
+        if crawl_result.follow_filter and not crawl_result.follow_filter(target_url):
+            CrawlStats.count('http.redirects.skipped')
+            _LOG.debug('Redirect target crawled: url = %s, location = %s', crawl_result.url, target_url)
+            return None
+        CrawlStats.count('http.redirects')
+        crawl_result.redirects.append((crawl_result.url, status_code))
+        crawl_result.url = target_url
+        # the validators of a stored page do not apply to another url
+        crawl_result.request_headers.pop('If-None-Match', None)
+        crawl_result.request_headers.pop('If-Modified-Since', None)
+        return target_url
+    
         
 class Storage:
     '''
@@ -226,6 +395,39 @@ class Storage:
     def is_crawled(self, url):
         pass
     
+    @abstractmethod
+    def query_validators(self, url):
+        '''
+        Return the (etag, last_modified) pair of a stored page, or None.
+        '''
+        pass
+    
+    @abstractmethod
+    def touch_page(self, url):
+        '''
+        Mark a stored page as unchanged by the latest crawl.
+        '''
+        pass
+    
+    @abstractmethod
+    def find_duplicate(self, url, fingerprint):
+        '''
+        Return the url of another page with the same or nearly the same
+        content fingerprint, or None.
+        '''
+        pass
+    
+    @abstractmethod
+    def save_fingerprint(self, url, fingerprint):
+        pass
+    
+    @abstractmethod
+    def merge(self, db):
+        '''
+        Merge the rows of another storage database, return False on error.
+        '''
+        pass
+    
     @abstractmethod
     def close(self):
         pass
@@ -238,6 +440,7 @@ class CrawlerManager:
     __metaclass__ = ABCMeta
 
     def __init__(self, settings):
+        LoggerFactory.start()
         self._http_engine = None
         self._storage = None
         self._crawlers = {}
@@ -261,24 +464,88 @@ class CrawlerManager:
     def get_storage(self):
         return self._storage
     
+    def get_stats(self):
+        '''
+        Return a snapshot of the crawl statistics, see CrawlStats.
+        '''
+        return CrawlStats.snapshot()
+    
     def get_http_engine(self):
         return self._http_engine
     
 
 class LoggerFactory:
     '''
-    Logger factory class.
+    Logger factory class. Getting a logger has no side effects: the
+    crawler loggers are left to the logging configuration of the
+    application. An application may start the factory, as the crawler
+    managers do, to put the records of the crawler loggers on a queue,
+    which a background listener thread formats and writes, so crawl
+    threads never block on the console. Messages take lazy %s
+    arguments, formatted only if the level is enabled.
     http://docs.python.org/3/library/logging.html
     '''
     FORMAT = '%(asctime)-15s %(thread)d [%(threadName)s] %(levelname)s %(module)s %(funcName)s %(message)s'
-    logging.basicConfig(format=FORMAT)
+    ROOT = 'crawler'
+    LEVEL = logging.INFO
+    __listener = None
+    __queue_handler = None
+    __lock = threading.Lock()
     
     @classmethod
     def get_logger(cls, name=None):
         if not name:
-            name = cls.__.class__.__name__
+            name = cls.ROOT
         logger = logging.getLogger(name)
         return logger
     
+    @classmethod
+    def start(cls, level=None, handler=None):
+        '''
+        Route the records of the crawler loggers through the queue to a
+        handler, stderr by default, and set their level. Records still
+        propagate to the handlers of the application. Does nothing if
+        already started, and the listener is stopped at exit.
+        '''
+        with cls.__lock:
+            if cls.__listener:
+                return
+            if handler is None:
+                handler = logging.StreamHandler()
+                handler.setFormatter(logging.Formatter(cls.FORMAT))
+            records = queue.SimpleQueue()
+            cls.__queue_handler = QueueHandler(records)
+            root = logging.getLogger(cls.ROOT)
+            root.addHandler(cls.__queue_handler)
+            root.setLevel(level or cls.LEVEL)
+            cls.__listener = QueueListener(records, handler, respect_handler_level=True)
+            cls.__listener.start()
+            atexit.register(cls.stop)
+    
+    @classmethod
+    def stop(cls):
+        '''
+        Write the queued records and stop the listener thread.
+        '''
+        with cls.__lock:
+            if not cls.__listener:
+                return
+            cls.__listener.stop()
+            logging.getLogger(cls.ROOT).removeHandler(cls.__queue_handler)
+            cls.__listener = None
+            cls.__queue_handler = None
+            atexit.unregister(cls.stop)
+    
+    @classmethod
+    def is_started(cls):
+        return cls.__listener is not None
+    
+    @classmethod
+    def set_level(cls, level):
+        logging.getLogger(cls.ROOT).setLevel(level)
+
+
+_LOG = LoggerFactory.get_logger(__name__)
+    
     
     
\ No newline at end of file
@@ -0,0 +1,127 @@
+'''
+One-shot converter of crawler databases keyed by md5 hex text (schema
+version 0) to integer url ids (schema version 1):
+
+    python -m crawler.core.convert crawler.db [other.db ...]
+
+The url text of every url, page and fingerprint row goes to the url
+table, and pages and fingerprints keep only the url id. Url ids are 64
+bits, so two urls of a database may share an id; the converter keeps the
+first of them and reports the dropped rows. The saved Bloom filter of a
+database is removed, and rebuilt from the url ids when it is opened.
+'''
+import os
+import sqlite3
+import sys
+
+from crawler.core.common import LoggerFactory
+from crawler.core.storage import CrawlerStorage, SQLite
+
+
+# __name__ is __main__ when run with -m, outside of the crawler loggers
+_LOG = LoggerFactory.get_logger('crawler.core.convert')
+
+TABLES = ('url', 'page', 'fingerprint')
+# the url rows first, then the urls only known from pages and fingerprints
+_CONVERT_SQL = {
+    'url' : '''
+        INSERT OR IGNORE INTO url(id, url, create_time, update_time)
+        SELECT url_id(url), url, create_time, update_time FROM url_v0 ORDER BY rowid
+    ''',
+    'page' : '''
+        INSERT OR IGNORE INTO url(id, url, create_time, update_time)
+        SELECT url_id(url), url, create_time, update_time FROM page_v0
+        WHERE url IS NOT NULL ORDER BY rowid;
+        INSERT OR IGNORE INTO page(
+        id, status_code, charset, etag, last_modified, content, create_time, update_time)
+        SELECT url_id(url), status_code, charset, etag, last_modified, content, create_time, update_time
+        FROM page_v0 WHERE url IS NOT NULL ORDER BY rowid
+    ''',
+    'fingerprint' : '''
+        INSERT OR IGNORE INTO url(id, url) SELECT url_id(url), url FROM fingerprint_v0
+        WHERE url IS NOT NULL ORDER BY rowid;
+        INSERT OR IGNORE INTO fingerprint(id, exact, simhash, band0, band1, band2, band3)
+        SELECT url_id(url), exact, simhash, band0, band1, band2, band3
+        FROM fingerprint_v0 WHERE url IS NOT NULL ORDER BY rowid
+    '''
+}
+
+
+def convert(db):
+    '''
+    Convert a crawler database in place, in one transaction. Return
+    False if it is already converted.
+    '''
+    connection = sqlite3.connect(db, isolation_level=None)
+    try:
+        version = SQLite.get_schema_version(connection)
+        if version == SQLite.SCHEMA_VERSION:
+            _LOG.info('Crawler database is converted: %s', db)
+            return False
+        if version != 0:
+            raise ValueError('Unsupported crawler database schema version ' + str(version) + ': ' + db)
+        connection.create_function('url_id', 1, CrawlerStorage.url_id, deterministic=True)
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            counts = _convert_tables(connection)
+            connection.execute('PRAGMA user_version = ' + str(SQLite.SCHEMA_VERSION))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        # give back the pages of the dropped url text
+        connection.execute('VACUUM')
+    finally:
+        connection.close()
+    try:
+        # keyed by md5 digests of the url text
+        os.remove(db + CrawlerStorage.FILTER_SUFFIX)
+    except FileNotFoundError:
+        pass
+    _LOG.info('Converted crawler database: %s, urls = %d, pages = %d, fingerprints = %d',
+              db, counts['url'], counts['page'], counts['fingerprint'])
+    return True
+
+
+def _convert_tables(connection):
+    # return the row count of each converted table
+    old_tables = [table for table in TABLES if SQLite.has_table(connection, table)]
+    for table in old_tables:
+        connection.execute('ALTER TABLE ' + table + ' RENAME TO ' + table + '_v0')
+    for table in TABLES + ('codec_dict', ):
+        connection.execute(SQLite.get_table_sql(table))
+    counts = {}
+    for table in TABLES:
+        counts[table] = 0
+        if table in old_tables:
+            for sql in _CONVERT_SQL[table].split(';'):
+                connection.execute(sql)
+            old_count = connection.execute('SELECT count(*) FROM ' + table + '_v0').fetchone()[0]
+            counts[table] = connection.execute('SELECT count(*) FROM ' + table).fetchone()[0]
+            if table != 'url' and counts[table] < old_count:
+                _LOG.warning('Rows of %s dropped on url id collisions: %d', table, old_count - counts[table])
+    # dropped with the indexes of the old tables, whose names are reused
+    for table in old_tables:
+        connection.execute('DROP TABLE ' + table + '_v0')
+    for sql in SQLite.get_index_sql():
+        connection.execute(sql)
+    counts['url'] = connection.execute('SELECT count(*) FROM url').fetchone()[0]
+    return counts
+
+
+def main(argv=None):
+    LoggerFactory.start()
+    dbs = sys.argv[1:] if argv is None else argv
+    if not dbs:
+        print('Usage: python -m crawler.core.convert crawler.db [other.db ...]')
+        return 2
+    for db in dbs:
+        if not os.path.isfile(db):
+            _LOG.error('Crawler database not found: %s', db)
+            return 1
+        convert(db)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,28 @@
 from abc import ABCMeta
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import queue
 import re
+import threading
+import time
+from urllib.parse import urljoin, urlsplit
 
-from crawler.core.common import Crawler, TaskConf, CrawlMode, CrawlPolicy
-from crawler.core.http import DefaultHttpEngine, HtmlParser
+from crawler.core.common import Crawler, TaskConf, CrawlMode, CrawlPolicy, HttpEngine, LoggerFactory
+from crawler.core.fingerprint import Fingerprint, FingerprintIndex
+from crawler.core.frontier import CrawlFrontier, DiskFrontier
+from crawler.core.http import DefaultHttpEngine, HtmlParser, LinkExtractor
+from crawler.core.pipeline import Pipeline
+from crawler.core.resolver import DnsResolver
+from crawler.core.stats import CrawlStats
 from crawler.core.storage import CrawlerStorage
+from crawler.core.urls import FetchedUrls, RedirectMap, UrlNormalizer
 from crawler.core.utils import UniqIdGenerator
 
 
+_LOG = LoggerFactory.get_logger(__name__)
+
+
 class DefaultCrawler(Crawler):
     '''
     Default crawler implementation class.
@@ -22,6 +38,9 @@ class DefaultCrawler(Crawler):
             self._name  = 'crawler-' + str(UniqIdGenerator.next_id(seed))
         # set HTTP engine
         self._http_engine = self._crawler_conf.http_engine
+        if not self._http_engine:
+            self._http_engine = DefaultHttpEngine()
+            self._crawler_conf.http_engine = self._http_engine
         # set storage tool
         self.__storage = self._crawler_conf.storage
         # initialize crawler according to the mode
@@ -29,16 +48,15 @@ class DefaultCrawler(Crawler):
             self._crawl_policy = SimpleCrawlPolicy(self)
         elif self._crawler_conf.mode == CrawlMode.STORAGE:
             # crawl and store page content
-            if not self._http_engine:
-                self._http_engine = DefaultHttpEngine()
             if not self.__storage:
                 self.__storage = CrawlerStorage()
                 self.__storage.initialize()
+                self._crawler_conf.storage = self.__storage
             # set internal fetcher
             self._crawl_policy = StorageCrawlPolicy(self)
             # internal storage fetcher implementation
         else:
-            print('Undefined crawl mode: mode = ' + self._crawler_conf.mode)
+            _LOG.error('Undefined crawl mode: mode = %s', self._crawler_conf.mode)
     
     def get_name(self):
         return self._name
@@ -46,9 +64,15 @@ class DefaultCrawler(Crawler):
     def crawl(self, url_task):
         # crawl a url task built from the seed file
         task = url_task
-        if task and task.url and self._crawl_policy.should_crawl(task.url):
+        if task and task.url and (self._crawl_policy.can_resume(task) or
+                                  self._crawl_policy.should_crawl(task.url)):
             # invoke
-            self._crawl_policy.fetch(task)
+            if self._http_engine.is_async():
+                asyncio.run(self._crawl_policy.fetch_async(task))
+            elif self._crawler_conf.stage_workers:
+                self._crawl_policy.fetch_pipelined(task)
+            else:
+                self._crawl_policy.fetch(task)
            
     def __str__(self):
         return 'Crawler[' + self._name + ']'
@@ -59,91 +83,365 @@ class AbstractCrawlPolicy(CrawlPolicy):
     Abstract crawl policy.
     '''
     __metaclass__ = ABCMeta
+    # seconds between two probes of the event loop lag of async crawls
+    LOOP_LAG_INTERVAL = 0.01
     
     def __init__(self, crawler):
         super(AbstractCrawlPolicy, self).__init__(crawler)
         self._crawler_conf = self._crawler.get_crawler_conf()
         self._http_engine = self._crawler_conf.http_engine
+        self._fingerprint_index = None
+        self._redirect_map = None
+        # pipeline workers check and save fingerprints concurrently
+        self._fingerprint_lock = threading.Lock()
+        self.__local = threading.local()
+        self.__fetched_urls = None
         
-    def __compute_max_depth(self, url_task):
-        if not self._max_depth:
-            if url_task.task_conf.max_depth:
-                self._max_depth = url_task.task_conf.max_depth
-            else:
-                self._max_depth = self._crawler_conf.max_depth
-        else:
-            self._max_depth = self._crawler_conf.max_depth
+    def __get_max_depth(self, url_task):
+        # task level max depth overrides the crawler level one
+        if url_task.task_conf.max_depth:
+            return url_task.task_conf.max_depth
+        return self._crawler_conf.max_depth
+    
+    def _create_frontier(self, url_task):
+        conf = self._crawler_conf
+        # a crawl fetches a page once, be it linked or redirected to
+        self.__fetched_urls = FetchedUrls()
+        if conf.frontier_db:
+            # resumes the crawl of the seed if it was interrupted
+            return DiskFrontier(conf.frontier_db, url_task.url,
+                                conf.frontier_memory_size, conf.max_frontier_size,
+                                before_checkpoint=self.__flush_storage)
+        return CrawlFrontier(conf.max_frontier_size)
+    
+    def can_resume(self, url_task):
+        conf = self._crawler_conf
+        return bool(conf.frontier_db) and DiskFrontier.is_pending(conf.frontier_db, url_task.url)
+    
+    def __flush_storage(self):
+        # done tasks leave the frontier file only once their pages are stored
+        if self._storage is None:
+            return True
+        return self._storage.flush()
     
     def fetch(self, url_task):
+        '''
+        Crawl from a url task, draining the frontier breadth first.
+        '''
+        frontier = self._create_frontier(url_task)
+        try:
+            frontier.push(url_task)
+            while frontier:
+                task = frontier.pop()
+                # fetch page
+                self._prepare(task)
+                if not self.__claim(task):
+                    frontier.task_done(task)
+                    continue
+                self._http_engine.reuse()
+                with CrawlStats.timer('fetch'):
+                    self._http_engine.fetch(task)
+                CrawlStats.count('pages')
+                for child_task in self.__process(task):
+                    frontier.push(child_task)
+                frontier.task_done(task)
+        finally:
+            frontier.close()
+    
+    async def fetch_async(self, url_task):
+        '''
+        Crawl with an asynchronous HTTP engine: newly extracted url tasks
+        go to the frontier as soon as their parent page is done, and the
+        number of running fetches is capped by the engine's concurrency.
+        Fetched pages are parsed and stored on a worker thread, so the
+        event loop only waits on the network. The worker still contends
+        for the GIL, so how late the loop wakes up is recorded too, as
+        the loop.lag stage.
+        '''
+        frontier = self._create_frontier(url_task)
+        running = set()
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='crawl-process')
+        monitor = asyncio.ensure_future(self.__monitor_loop())
+        try:
+            frontier.push(url_task)
+            limit = self._http_engine.get_max_concurrency()
+            while frontier or running:
+                while frontier and len(running) < limit:
+                    running.add(asyncio.ensure_future(self.__fetch_async(frontier.pop(), executor)))
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    task, child_tasks = future.result()
+                    for child_task in child_tasks:
+                        frontier.push(child_task)
+                    frontier.task_done(task)
+        finally:
+            for future in running:
+                future.cancel()
+            monitor.cancel()
+            executor.shutdown()
+            frontier.close()
+    
+    def fetch_pipelined(self, url_task):
+        '''
+        Crawl through a pipeline of stages, each on its own worker
+        threads: fetch, parse (fingerprint and link extraction), normalize
+        (url normalization and filtering) and store. Stages are joined by
+        bounded queues, so the frontier is only drained as fast as the
+        slowest stage goes. Url tasks are pushed to and popped from the
+        frontier on the calling thread only.
+        '''
+        conf = self._crawler_conf
+        frontier = self._create_frontier(url_task)
+        done = queue.SimpleQueue()
+        pipeline = Pipeline(conf.crawler_name or 'pipeline')
+        stages = (('fetch', self.__fetch_stage), ('parse', self.__parse_stage),
+                  ('normalize', self.__normalize_stage), ('store', self.__store_stage))
+        def fail(item, error):
+            # a task failing in a stage is done, without child tasks
+            done.put((item[0] if isinstance(item, tuple) else item, []))
+        for name, handler in stages:
+            pipeline.add_stage(name, lambda item, handler=handler: handler(pipeline, done, item),
+                               conf.stage_workers.get(name, 1), conf.stage_queue_size, fail)
+        pipeline.start()
+        running = 0
+        try:
+            frontier.push(url_task)
+            while frontier or running:
+                if frontier:
+                    # blocks while the fetch stage is full
+                    pipeline.put('fetch', frontier.pop())
+                    running += 1
+                try:
+                    task, child_tasks = done.get(block=not frontier)
+                except queue.Empty:
+                    continue
+                while True:
+                    for child_task in child_tasks:
+                        frontier.push(child_task)
+                    frontier.task_done(task)
+                    running -= 1
+                    try:
+                        task, child_tasks = done.get_nowait()
+                    except queue.Empty:
+                        break
+        finally:
+            pipeline.stop()
+            frontier.close()
+    
+    def __fetch_stage(self, pipeline, done, url_task):
+        # an engine per worker thread, sharing the connections
+        http_engine = getattr(self.__local, 'http_engine', None)
+        if http_engine is None:
+            http_engine = self._http_engine.clone()
+            self.__local.http_engine = http_engine
+        # links are extracted by the parse stage, not while fetching
+        self._prepare(url_task, collect_links=False)
+        if not self.__claim(url_task):
+            done.put((url_task, []))
+            return
+        http_engine.reuse()
+        with CrawlStats.timer('fetch'):
+            http_engine.fetch(url_task)
+        CrawlStats.count('pages')
+        pipeline.put('parse', url_task)
+    
+    def __parse_stage(self, pipeline, done, url_task):
+        if self._is_duplicate(url_task):
+            done.put((url_task, []))
+        else:
+            pipeline.put('normalize', (url_task, self._extract_links(url_task)))
+    
+    def __normalize_stage(self, pipeline, done, item):
+        url_task, urls = item
+        pipeline.put('store', (url_task, self._build_url_tasks(url_task, urls)))
+    
+    def __store_stage(self, pipeline, done, item):
+        url_task, child_tasks = item
+        self.store(url_task)
+        done.put((url_task, child_tasks))
+    
+    async def __fetch_async(self, url_task, executor):
+        # links are extracted off the event loop, not while fetching
+        self._prepare(url_task, collect_links=False)
+        if not self.__claim(url_task):
+            return url_task, []
+        with CrawlStats.timer('fetch'):
+            await self._http_engine.fetch_async(url_task)
+        CrawlStats.count('pages')
+        return url_task, await asyncio.get_running_loop().run_in_executor(executor, self.__process, url_task)
+    
+    async def __monitor_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(AbstractCrawlPolicy.LOOP_LAG_INTERVAL)
+            CrawlStats.record('loop.lag', loop.time() - start - AbstractCrawlPolicy.LOOP_LAG_INTERVAL)
+    
+    def __process(self, url_task):
+        # check, store and expand a fetched page, into its child tasks
+        with CrawlStats.timer('process'):
+            if self._is_duplicate(url_task):
+                return []
+            self.store(url_task)
+            return self._expand(url_task)
+    
+    def _prepare(self, url_task, collect_links=True):
+        # set up the request of a url task before it is fetched: links
+        # are extracted while the body streams in, and the body is only
+        # kept if it is stored, fingerprinted or parsed afterwards
+        crawl_result = url_task.crawl_result
+        if self._redirect_map is not None:
+            target_url = self._redirect_map.find_redirect(url_task.url)
+            if target_url:
+                # fetch the url a known redirect ends at, without the round-trip
+                CrawlStats.count('http.redirects.cached')
+                crawl_result.url = target_url
+        expand = url_task.depth <= self.__get_max_depth(url_task) - 1
+        if expand and collect_links:
+            crawl_result.consumers.append(LinkCollector(crawl_result))
+        crawl_result.keep_data = self._keep_data() or (expand and not collect_links)
+        crawl_result.follow_filter = self.__should_follow
+    
+    def __claim(self, url_task):
+        # whether a popped url task is fetched, not if a redirect already was
+        if self.__fetched_urls.claim(url_task.crawl_result.url):
+            return True
+        CrawlStats.count('pages.redirected')
+        _LOG.debug('Fetched through a redirect: url = %s', url_task.crawl_result.url)
+        return False
+    
+    def __should_follow(self, url):
+        # a redirect target is fetched once per crawl, and only when due
+        return self.should_crawl(url) and self.__fetched_urls.claim_target(url)
+    
+    def _keep_data(self):
+        return self._crawler_conf.skip_duplicates
+    
+    def _is_duplicate(self, url_task):
+        # check the content fingerprint of a fetched page against the index
+        crawl_result = url_task.crawl_result
+        if not self._crawler_conf.skip_duplicates or self._fingerprint_index is None:
+            return False
+        if crawl_result.status_code != 200 or not crawl_result.binary_data:
+            return False
+        if crawl_result.aborted:
+            # a cut body could match the start of a complete page
+            return False
+        with CrawlStats.timer('fingerprint'):
+            fingerprint = Fingerprint.compute(crawl_result.binary_data)
+        with self._fingerprint_lock:
+            duplicate_url = self._fingerprint_index.find_duplicate(crawl_result.url, fingerprint)
+            if not duplicate_url:
+                self._fingerprint_index.save_fingerprint(crawl_result.url, fingerprint)
+        if duplicate_url:
+            CrawlStats.count('pages.duplicate')
+            _LOG.debug('Duplicate: url = %s, duplicate_of = %s', crawl_result.url, duplicate_url)
+            self._save_duplicate(url_task, duplicate_url)
+            return True
+        return False
+    
+    def _save_duplicate(self, url_task, duplicate_url):
+        # remember a dropped duplicate, so it is not downloaded again
+        pass
+    
+    def _expand(self, url_task):
+        # build url tasks from the links of a fetched page
+        return self._build_url_tasks(url_task, self._extract_links(url_task))
+    
+    def _extract_links(self, url_task):
+        # links of a fetched page, None if the page is not expanded
+        task = url_task
+        status_code = task.crawl_result.status_code
+        if status_code == 304:
+            if task.depth <= self.__get_max_depth(task) - 1 and self._load_stored_content(task):
+                return ResultParser.extract_urls(task.crawl_result)
+        elif status_code == 200:
+            if task.depth <= self.__get_max_depth(task) - 1:
+                if task.crawl_result.links is None:
+                    # parsed after the fetch, in the charset of the response
+                    content_type = task.crawl_result.get_resp_header('Content-Type')
+                    task.crawl_result.charset = self._extract_charset(content_type)
+                return ResultParser.extract_urls(task.crawl_result)
+        elif status_code and status_code >= 300 and status_code < 400:
+            # a redirect the engine did not follow
+            location = task.crawl_result.get_resp_header('Location')
+            _LOG.debug('Redirection: location_url = %s', location)
+        return None
+    
+    def _load_stored_content(self, url_task):
+        # set the stored content of a page not modified, False if none
+        return False
+    
+    def _build_url_tasks(self, url_task, urls):
+        # normalize, filter and check the links of a page into url tasks
         task = url_task
-        # fetch page
-        self._http_engine.fetch(task)
-        status_code = self._http_engine.get_status_code()
-        # save result
-        self.store(task)
-        self.__compute_max_depth(task)
-        if status_code and status_code == 200:
-            if task.depth <= self._max_depth - 1:
-                # extract and check urls
-                urls = ResultParser.extract_urls(task.crawl_result)
-                # normalize urls
-                urls = ResultParser.normalize_urls(urls, task.url)
-                # filter urls
-                if not task.task_conf.cross_host_allowed:
-                    urls = ResultParser.filter_urls(urls, task.task_conf.domain)
-                waiting_crawled_urls = filter(self.should_crawl, urls)
-                # build url tasks
-                url_tasks = TaskFactory.build_url_tasks(task, waiting_crawled_urls);
-                print('Extract urls: ref = ' + task.url + ', urls_in_page = ' + str(len(url_tasks)))
-                for url_task in url_tasks:
-                    self.fetch(url_task)
-        elif status_code >= 300 and status_code < 400:
-            # redirection
-            location = self._http_engine.get_resp_header('Location')
-            print('Redirection: localtion_url = ' + location)
+        url_tasks = []
+        if urls is None:
+            return url_tasks
+        # normalize urls
+        base_url = task.crawl_result.base_url or task.crawl_result.url
+        urls = ResultParser.normalize_urls(urls, base_url)
+        urls = self._resolve_redirects(urls)
+        # filter urls
+        if not task.task_conf.cross_host_allowed:
+            urls = ResultParser.filter_urls(urls, task.task_conf.domain)
+        waiting_crawled_urls = filter(self.should_crawl, urls)
+        # build url tasks
+        url_tasks = TaskFactory.build_url_tasks(task, waiting_crawled_urls, self.__get_max_depth(task))
+        CrawlStats.count('links', len(url_tasks))
+        _LOG.debug('Extract urls: ref = %s, urls_in_page = %d', task.crawl_result.url, len(url_tasks))
+        return url_tasks
+    
+    def _resolve_redirects(self, urls):
+        # links to known redirects go to their targets
+        if self._redirect_map is None:
+            return urls
+        resolved_urls = {}
+        for url in urls:
+            target_url = self._redirect_map.find_redirect(url)
+            if target_url:
+                CrawlStats.count('links.redirected')
+            resolved_urls[target_url or url] = None
+        return list(resolved_urls)
             
     def store(self, url_task):
-        status_code = self._http_engine.get_status_code()
-        url_task.crawl_result.status_code = status_code
-        if status_code and status_code == 200:
-            url_task.crawl_result.binary_data = self._http_engine.get_data()
-            #url_task.crawl_result.response_headers = None
-            self._log_crawl(status_code, url_task.url)
-        else:
-            self._log_crawl(status_code, url_task.url)
+        crawl_result = url_task.crawl_result
+        status_code = crawl_result.status_code
+        self._log_crawl(status_code, crawl_result.url)
+        if crawl_result.aborted:
+            _LOG.info('Aborted: url = %s, reason = %s', crawl_result.url, crawl_result.aborted)
+        if crawl_result.redirects and self._redirect_map is not None and \
+                status_code not in HttpEngine.REDIRECT_CODES:
+            # later links to the redirected urls go straight to the page,
+            # unless the hops ended on a redirect, such as a loop
+            self._redirect_map.save_redirects(crawl_result.redirects, crawl_result.url)
         # collect crawled data
-        # collect url data
-        url_data = url_task.crawl_result.url_data
-        url_data['url'] = url_task.url
+        # collect url data, of the url fetched last if redirected
+        url_data = crawl_result.url_data
+        url_data['url'] = crawl_result.url
         # collect page data
-        page_data = url_task.crawl_result.page_data
-        page_data['url'] = url_task.url
+        page_data = crawl_result.page_data
+        page_data['url'] = crawl_result.url
         page_data['status_code'] = status_code
-        content_type = self._http_engine.get_resp_header('Content-Type')
+        content_type = crawl_result.get_resp_header('Content-Type')
         charset = self._extract_charset(content_type)
         if charset:
             page_data['charset'] = charset
             url_task.crawl_result.charset = charset
-        etag = self._http_engine.get_resp_header('ETag')
+        etag = crawl_result.get_resp_header('ETag')
         page_data['etag'] = etag
-        last_modified = self._http_engine.get_resp_header('Last-Modified')
+        last_modified = crawl_result.get_resp_header('Last-Modified')
         page_data['last_modified'] = last_modified
-        data = self._http_engine.get_data()
-        if data:
+        data = crawl_result.binary_data
+        if data and not crawl_result.aborted:
+            # a cut body is not kept as the content of the page
             page_data['content'] = data
     
     def _extract_charset(self, content_type):
-        encoding = 'utf-8'
-        if content_type:
-#             print('content_type = ' + content_type)
-            charsets = re.findall(r'.*charset\s*=\s*[\'\"]*([^\'\"]+).*', content_type, re.I)
-            if charsets:
-                encoding = charsets[0].lower() 
-        return encoding
+        return ResultParser.extract_charset(content_type)
     
     def _log_crawl(self, status_code, url):
-        template = 'Crawled: status_code = {0}, url = {1}'
-        print(template.format(status_code, url))      
+        _LOG.debug('Crawled: status_code = %s, url = %s', status_code, url)
     
         
 class SimpleCrawlPolicy(AbstractCrawlPolicy):
@@ -152,14 +450,24 @@ class SimpleCrawlPolicy(AbstractCrawlPolicy):
     '''
     def __init__(self, crawler):
         super(SimpleCrawlPolicy, self).__init__(crawler)
+        self._fingerprint_index = FingerprintIndex()
+        self._redirect_map = RedirectMap()
         
     def should_crawl(self, url):
         return True
     
+    def _resolve_redirects(self, urls):
+        # the targets of known redirects were fetched by this crawl
+        return [url for url in urls if self._redirect_map.find_redirect(url) is None]
+    
     def store(self, url_task):
         super().store(url_task)
-        print('url_data = ' + str(url_task.crawl_result.url_data))
-        print('page_data = ' + str(url_task.crawl_result.page_data))
+        if _LOG.isEnabledFor(logging.DEBUG):
+            # the page content is left out, only its size is logged
+            page_data = dict(url_task.crawl_result.page_data)
+            content = page_data.pop('content', None)
+            _LOG.debug('url_data = %s, page_data = %s, content_size = %d', url_task.crawl_result.url_data,
+                       page_data, len(content) if content else 0)
     
 
 class StorageCrawlPolicy(AbstractCrawlPolicy):
@@ -169,6 +477,8 @@ class StorageCrawlPolicy(AbstractCrawlPolicy):
     def __init__(self, crawler):
         super(StorageCrawlPolicy, self).__init__(crawler)
         self._storage = crawler.get_crawler_conf().storage
+        self._fingerprint_index = self._storage
+        self._redirect_map = self._storage
         
     def should_crawl(self, url):
         if not self._storage.is_crawled(url):
@@ -178,8 +488,42 @@ class StorageCrawlPolicy(AbstractCrawlPolicy):
         else:
             return False
     
+    def _keep_data(self):
+        return True
+    
+    def _prepare(self, url_task, collect_links=True):
+        super(StorageCrawlPolicy, self)._prepare(url_task, collect_links)
+        # revalidate a stored page instead of downloading it again
+        validators = self._storage.query_validators(url_task.crawl_result.url)
+        if validators:
+            etag, last_modified = validators
+            request_headers = url_task.crawl_result.request_headers
+            if etag:
+                request_headers['If-None-Match'] = etag
+            if last_modified:
+                request_headers['If-Modified-Since'] = last_modified
+    
+    def _save_duplicate(self, url_task, duplicate_url):
+        self._storage.save_duplicate(url_task.crawl_result.url, duplicate_url)
+    
+    def _load_stored_content(self, url_task):
+        # links of a page not modified are extracted from the stored content
+        crawl_result = url_task.crawl_result
+        if not crawl_result.binary_data:
+            records = self._storage.query_page(crawl_result.url)
+            if not records:
+                return False
+            crawl_result.charset = records[0][3] or crawl_result.charset
+            crawl_result.binary_data = records[0].content
+        return True
+    
     def store(self, url_task):
         super().store(url_task)
+        crawl_result = url_task.crawl_result
+        if crawl_result.status_code == 304:
+            # not modified, only the update time changes
+            self._storage.touch_page(crawl_result.url)
+            return
         # store to database
         # store url data
         url_data = url_task.crawl_result.url_data
@@ -242,38 +586,56 @@ class TaskFactory:
                     if len(socket_timeout) > 0:
                         task_conf.socket_timeout = int(socket_timeout)
                         
-                    url_task = UrlTask(task_conf)
+                    url_task = UrlTask(task_conf.freeze())
                     url_tasks.append(url_task)
         f.close()
+        # resolve seed hosts in the background while crawling starts
+        DnsResolver.prefetch(urlsplit(url_task.url).hostname for url_task in url_tasks)
         return url_tasks
     
     @classmethod
-    def build_url_tasks(cls, url_task, waiting_crawled_urls):
+    def build_url_tasks(cls, url_task, waiting_crawled_urls, max_depth=None):
+        # max_depth is resolved by the crawl policy, the task level one if None
         url_tasks = []
-        if not url_task and not url_task.crawl_result:
+        if not url_task:
             return url_tasks
-        if url_task.depth <= url_task.task_conf.max_depth:
+        if max_depth is None:
+            max_depth = url_task.task_conf.max_depth
+        if url_task.depth <= max_depth:
             depth = url_task.depth + 1
-            # build url tasks
+            # child tasks share the conf of their parent, frozen
+            task_conf = url_task.task_conf.frozen()
+            url_task.task_conf = task_conf
             for url in waiting_crawled_urls:
-                print('build url task: url = ' + url)
-                conf = TaskConf.clone(url, url_task.task_conf)
-                task = UrlTask(conf)
-                task.depth = depth
-                url_tasks.append(task)
+                _LOG.debug('build url task: url = %s', url)
+                url_tasks.append(UrlTask(task_conf, url, depth))
         return url_tasks
     
     
 class UrlTask:
     '''
     A task encapsulates crawler related url resources before starting
-    to crawl pages represented by a url.
+    to crawl pages represented by a url. Frontiers hold many waiting
+    tasks, so a task is slotted and its crawl result is only created
+    when it is first used, once the task is fetched.
     '''
-    def __init__(self, task_conf):
+    __slots__ = ('task_conf', 'url', 'depth', '_crawl_result')
+    
+    def __init__(self, task_conf, url=None, depth=0):
         self.task_conf = task_conf
-        self.url = task_conf.url
-        self.crawl_result = CrawlResult(self.url)
-        self.depth = 0
+        self.url = url or task_conf.url
+        self.depth = depth
+        self._crawl_result = None
+    
+    @property
+    def crawl_result(self):
+        if self._crawl_result is None:
+            self._crawl_result = CrawlResult(self.url)
+        return self._crawl_result
+    
+    @crawl_result.setter
+    def crawl_result(self, crawl_result):
+        self._crawl_result = crawl_result
         
     def __str__(self):
         return 'url = ' + self.url
@@ -284,45 +646,120 @@ class CrawlResult:
     The result of a crawler fetching a page.
     '''
     def __init__(self, url):
+        # the url fetched last, once redirects are followed
         self.url = url
         self.binary_data = None
         self.string_data = None
         self.status_code = None
         self.charset = 'UTF-8'
+        self.base_url = None
+        # links extracted while the body was read, None if not extracted
+        self.links = None
+        # reason why the body was not read or cut, None if complete
+        self.aborted = None
+        # body consumers, and whether the body is kept in binary_data
+        self.consumers = []
+        self.keep_data = True
+        # (url, status_code) of the redirects followed to the url, and
+        # whether a redirect target is followed, None to follow all
+        self.redirects = []
+        self.follow_filter = None
+        self.request_headers = {}
         self.response_headers = {}
         self.exceptions = []
         self.url_data = {}
         self.page_data = {}
         
+    def get_resp_header(self, key):
+        return self.response_headers.get(key.lower())
+        
     def __str__(self):
         return 'url = ' + self.url + ', charset=' + self.charset
     
 
+class LinkCollector:
+    '''
+    Body consumer extracting the links of a page while it is fetched,
+    into the links and base url of the crawl result.
+    '''
+    def __init__(self, crawl_result):
+        self._crawl_result = crawl_result
+        self.__extractor = None
+        self.__urls = []
+        self.__parse_time = 0.0
+    
+    def open(self, status_code, headers):
+        self.__extractor = None
+        self.__urls = []
+        if status_code == 200:
+            charset = ResultParser.extract_charset(headers.get('content-type'))
+            self.__extractor = LinkExtractor(charset)
+    
+    def feed(self, chunk):
+        if self.__extractor:
+            start = time.perf_counter()
+            self.__urls.extend(self.__extractor.feed_bytes(chunk))
+            self.__parse_time += time.perf_counter() - start
+    
+    def close(self):
+        if self.__extractor:
+            start = time.perf_counter()
+            self.__urls.extend(self.__extractor.close())
+            CrawlStats.record('parse.links', self.__parse_time + time.perf_counter() - start)
+            self._crawl_result.links = self.__urls
+            if self.__extractor.base_url:
+                self._crawl_result.base_url = urljoin(self._crawl_result.url, self.__extractor.base_url)
+    
+
 class ResultParser:
     '''
     Parse result page content crawled by a crawler.
     '''
+    CHUNK_SIZE = 65536
+    
+    @classmethod
+    def extract_charset(cls, content_type):
+        encoding = 'utf-8'
+        if content_type:
+            charsets = re.findall(r'.*charset\s*=\s*[\'\"]*([^\'\"]+).*', content_type, re.I)
+            if charsets:
+                encoding = charsets[0].lower() 
+        return encoding
+    
     @classmethod
     def extract_urls(cls, crawl_result):
+        if crawl_result.links is not None:
+            # extracted while the page was fetched
+            return crawl_result.links
         urls = []
-        if crawl_result.status_code == 200:
-            cls.__get_string_data(crawl_result)
-            if len(crawl_result.string_data) > 0:
-                urls = HtmlParser.extract_urls(crawl_result.string_data)
+        data = crawl_result.binary_data
+        if crawl_result.status_code in (200, 304) and data:
+            # decode and tokenize chunk by chunk instead of the whole page
+            with CrawlStats.timer('parse.links'):
+                extractor = LinkExtractor(crawl_result.charset)
+                urls = list(extractor.extract(cls.__chunks(data)))
+            if extractor.base_url:
+                crawl_result.base_url = urljoin(crawl_result.url, extractor.base_url)
         return urls
     
+    @classmethod
+    def __chunks(cls, data):
+        view = memoryview(data)
+        for i in range(0, len(view), cls.CHUNK_SIZE):
+            yield view[i:i + cls.CHUNK_SIZE].tobytes()
+    
     @classmethod
     def normalize_urls(cls, urls, base_url):
         return HtmlParser.normalize_urls(urls, base_url)
     
     @classmethod
     def filter_urls(cls, urls, domain):
-        return filter(lambda url : url.find(domain) != -1, urls)
+        return UrlNormalizer.filter_urls(urls, domain)
     
     @classmethod
     def extract_anchors(cls, crawl_result):
         anchors = []
-        if crawl_result.starus_code == 200:
+        if crawl_result.status_code == 200:
             cls.__get_string_data(crawl_result)
             if len(crawl_result.string_data) > 0:
                 anchors = re.findall(r"<a.*?href=.*?<\/a>", crawl_result.string_data, re.I)
@@ -336,7 +773,7 @@ class ResultParser:
             try:
                 string_data = data.decode(crawl_result.charset)
             except UnicodeDecodeError as e:
-                print(str(e))
+                _LOG.warning('Fail to decode page: charset = %s, %s', crawl_result.charset, e)
         crawl_result.string_data = string_data
 
 
@@ -0,0 +1,97 @@
+from collections import Counter
+import hashlib
+import re
+
+
+class Fingerprint:
+    '''
+    Content fingerprint of a page: an exact md5 hex digest of the bytes,
+    and a 64-bit SimHash of the page text, whose Hamming distance to the
+    SimHash of a near-duplicate page is small.
+    '''
+    BITS = 64
+    BANDS = 4
+    BAND_BITS = BITS // BANDS
+    BAND_MASK = (1 << BAND_BITS) - 1
+    # distance < BANDS, so two near-duplicates share at least one band
+    MAX_DISTANCE = 3
+    MAX_FEATURES = 4096
+    __TAG = re.compile(rb'<(script|style)\b.*?</\1\s*>|<[^>]*>', re.I | re.S)
+    __TOKEN = re.compile(rb'[0-9A-Za-z\x80-\xff]+')
+
+    def __init__(self, exact, simhash):
+        self.exact = exact
+        self.simhash = simhash
+
+    @classmethod
+    def compute(cls, content):
+        exact = hashlib.md5(content).hexdigest()
+        return Fingerprint(exact, cls.__simhash(content))
+
+    def bands(self):
+        return [(self.simhash >> (i * Fingerprint.BAND_BITS)) & Fingerprint.BAND_MASK
+                for i in range(Fingerprint.BANDS)]
+
+    def is_near(self, simhash):
+        return bin(self.simhash ^ simhash).count('1') <= Fingerprint.MAX_DISTANCE
+
+    @classmethod
+    def __simhash(cls, content):
+        text = cls.__TAG.sub(b' ', content)
+        features = Counter(token.lower() for token in cls.__TOKEN.findall(text))
+        if not features:
+            return 0
+        # weight of each byte value at each byte position of the feature
+        # hashes, so the per-bit sums cost 8 steps per feature instead of 64
+        byte_weights = [Counter() for _ in range(8)]
+        for token, weight in features.most_common(cls.MAX_FEATURES):
+            digest = hashlib.blake2b(token, digest_size=8).digest()
+            for position in range(8):
+                byte_weights[position][digest[position]] += weight
+        simhash = 0
+        for position in range(8):
+            sums = [0] * 8
+            for value, weight in byte_weights[position].items():
+                for bit in range(8):
+                    if value >> bit & 1:
+                        sums[bit] += weight
+                    else:
+                        sums[bit] -= weight
+            for bit in range(8):
+                if sums[bit] > 0:
+                    simhash |= 1 << (position * 8 + bit)
+        return simhash
+
+
+class FingerprintIndex:
+    '''
+    In-memory fingerprint index. Exact digests are looked up in a dict,
+    and near-duplicates through the SimHash bands: each band value maps
+    to the pages having it, so only pages sharing a band are compared.
+    '''
+    def __init__(self):
+        self.__exact = {}
+        self.__bands = [{} for _ in range(Fingerprint.BANDS)]
+        self.__urls = {}
+
+    def find_duplicate(self, url, fingerprint):
+        '''
+        Return the url of another page with the same or nearly the same
+        content, or None.
+        '''
+        duplicate = self.__exact.get(fingerprint.exact)
+        if duplicate and duplicate != url:
+            return duplicate
+        for band, value in enumerate(fingerprint.bands()):
+            for other_url, simhash in self.__bands[band].get(value, ()):
+                if other_url != url and fingerprint.is_near(simhash):
+                    return other_url
+        return None
+
+    def save_fingerprint(self, url, fingerprint):
+        if url in self.__urls:
+            return
+        self.__urls[url] = fingerprint
+        self.__exact.setdefault(fingerprint.exact, url)
+        for band, value in enumerate(fingerprint.bands()):
+            self.__bands[band].setdefault(value, []).append((url, fingerprint.simhash))
@@ -0,0 +1,464 @@
+import hashlib
+import heapq
+import json
+import os
+import sqlite3
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+from crawler.core.common import TaskConf
+from crawler.core.utils import ScalableBloomFilter
+
+
+class CrawlFrontier:
+    '''
+    Frontier of url tasks waiting to be crawled.
+    Tasks are queued per host in breadth-first order, and hosts are
+    scheduled through a heap keyed by the task priority (higher first)
+    and the depth of the host's next task (lower first). Each host is
+    in the heap at most once, so the next best task is popped in
+    O(log n) of the number of hosts.
+    A url is accepted only once. Seen urls are kept as md5 digests, up
+    to SEEN_CAP of them in a set; beyond that they are folded into a
+    Bloom filter, so memory stays bounded and a new url is taken for a
+    seen one with probability SEEN_ERROR_RATE. Tasks are dropped when
+    the frontier holds max_size tasks, or when a host has already
+    accepted TaskConf.max_url_count urls.
+    '''
+    SEEN_CAP = 262144
+    SEEN_ERROR_RATE = 0.00001
+    
+    def __init__(self, max_size=-1):
+        self._max_size = max_size
+        self.__heap = []
+        self.__queues = {}
+        self.__seen = set()
+        self.__seen_filter = None
+        self.__host_counts = {}
+        self.__size = 0
+        self.__sequence = 0
+        self.__dropped = 0
+
+    def push(self, url_task):
+        '''
+        Queue a url task, return False if it was rejected.
+        '''
+        url = url_task.url
+        md5 = hashlib.md5(url.encode('utf-8')).digest()
+        if self.__is_seen(md5):
+            return False
+        if self._max_size > 0 and self.__size >= self._max_size:
+            self.__dropped += 1
+            return False
+        host = urlsplit(url).netloc
+        count = self.__host_counts.get(host, 0)
+        max_url_count = url_task.task_conf.max_url_count
+        if max_url_count and max_url_count > 0 and count >= max_url_count:
+            self.__dropped += 1
+            return False
+        self.__add_seen(md5)
+        self.__host_counts[host] = count + 1
+        queue = self.__queues.get(host)
+        if queue is None:
+            queue = deque()
+            self.__queues[host] = queue
+        queue.append(url_task)
+        if len(queue) == 1:
+            # host becomes ready
+            self.__schedule(host, url_task)
+        self.__size += 1
+        return True
+
+    def pop(self):
+        '''
+        Return the next best url task, or None if the frontier is empty.
+        '''
+        if not self.__heap:
+            return None
+        host = heapq.heappop(self.__heap)[-1]
+        queue = self.__queues[host]
+        url_task = queue.popleft()
+        if queue:
+            self.__schedule(host, queue[0])
+        else:
+            del self.__queues[host]
+        self.__size -= 1
+        return url_task
+
+    def get_dropped_count(self):
+        return self.__dropped
+
+    def task_done(self, url_task):
+        # nothing to record for an in-memory frontier
+        pass
+
+    def close(self):
+        pass
+
+    def __is_seen(self, md5):
+        if md5 in self.__seen:
+            return True
+        return self.__seen_filter is not None and md5 in self.__seen_filter
+
+    def __add_seen(self, md5):
+        self.__seen.add(md5)
+        if len(self.__seen) >= CrawlFrontier.SEEN_CAP:
+            if self.__seen_filter is None:
+                self.__seen_filter = ScalableBloomFilter(error_rate=CrawlFrontier.SEEN_ERROR_RATE)
+            for digest in self.__seen:
+                self.__seen_filter.add(digest)
+            self.__seen = set()
+
+    def __schedule(self, host, url_task):
+        # sequence number keeps hosts with the same key in round-robin order
+        self.__sequence += 1
+        key = (-url_task.task_conf.priority, url_task.depth, self.__sequence, host)
+        heapq.heappush(self.__heap, key)
+
+    def __len__(self):
+        return self.__size
+
+    def __bool__(self):
+        return self.__size > 0
+
+
+class DiskFrontier:
+    '''
+    Frontier of url tasks backed by an SQLite file, so its size is not
+    bounded by memory and a crawl can be resumed after a crash.
+    Every queued task is a row of the file, and at most memory_size of
+    them are also held in an in-memory head, ordered by priority (higher
+    first), depth (lower first) and arrival. Tasks pushed while the head
+    is full spill to the file only, and the head is refilled from the
+    file when it runs empty.
+    Pushed tasks and done ones are written behind, and checkpointed in
+    one transaction every checkpoint_size changes or checkpoint_interval
+    seconds. A task leaves the file only once task_done() is called for
+    it, so tasks in flight at a crash are crawled again on resume.
+    Seen urls are kept in the file too, behind a Bloom filter.
+    A frontier is named after its seed url: opening the file with the
+    same name resumes the queue, and close() marks the name complete once
+    the queue is drained, so a resumed crawl skips the seed.
+    The before_checkpoint callable, if any, is called first by every
+    checkpoint, to make the pages of done tasks durable: done tasks are
+    only deleted from the file once it returns True.
+    '''
+    __tables = [
+        '''create table if not exists frontier_task (
+            frontier text,
+            seq integer,
+            rank integer,
+            depth integer,
+            url text,
+            conf integer,
+            primary key (frontier, seq))''',
+        '''create index if not exists frontier_task_order
+            on frontier_task(frontier, rank, depth, seq)''',
+        '''create table if not exists frontier_seen (
+            frontier text,
+            md5 blob,
+            host text,
+            primary key (frontier, md5)) without rowid''',
+        '''create table if not exists frontier_conf (
+            frontier text,
+            id integer,
+            state text,
+            primary key (frontier, id))''',
+        '''create table if not exists frontier_state (
+            frontier text primary key,
+            complete integer)'''
+    ]
+    __insert_task_sql = '''
+        INSERT OR REPLACE INTO frontier_task(frontier, seq, rank, depth, url, conf) VALUES (?, ?, ?, ?, ?, ?)
+    '''
+    __delete_task_sql = '''
+        DELETE FROM frontier_task WHERE frontier = ? AND seq = ?
+    '''
+    __insert_seen_sql = '''
+        INSERT OR IGNORE INTO frontier_seen(frontier, md5, host) VALUES (?, ?, ?)
+    '''
+    __insert_conf_sql = '''
+        INSERT OR REPLACE INTO frontier_conf(frontier, id, state) VALUES (?, ?, ?)
+    '''
+    __select_tasks_sql = '''
+        SELECT seq, rank, depth, url, conf FROM frontier_task WHERE frontier = ?
+        ORDER BY rank, depth, seq LIMIT ?
+    '''
+    __select_seen_sql = '''
+        SELECT 1 FROM frontier_seen WHERE frontier = ? AND md5 = ?
+    '''
+    __select_seen_md5_sql = '''
+        SELECT md5 FROM frontier_seen WHERE frontier = ?
+    '''
+    __select_host_counts_sql = '''
+        SELECT host, count(*) FROM frontier_seen WHERE frontier = ? GROUP BY host
+    '''
+    __select_confs_sql = '''
+        SELECT id, state FROM frontier_conf WHERE frontier = ?
+    '''
+    __select_task_stats_sql = '''
+        SELECT count(*), max(seq) FROM frontier_task WHERE frontier = ?
+    '''
+    __select_complete_sql = '''
+        SELECT complete FROM frontier_state WHERE frontier = ?
+    '''
+    __select_pending_sql = '''
+        SELECT 1 FROM frontier_task WHERE frontier = ? LIMIT 1
+    '''
+    __complete_sqls = [
+        'DELETE FROM frontier_task WHERE frontier = ?',
+        'DELETE FROM frontier_seen WHERE frontier = ?',
+        'DELETE FROM frontier_conf WHERE frontier = ?',
+        'INSERT OR REPLACE INTO frontier_state(frontier, complete) VALUES (?, 1)'
+    ]
+    __file_suffixes = ('', '-wal', '-shm')
+
+    def __init__(self, path, name, memory_size=10000, max_size=-1,
+                 checkpoint_size=1000, checkpoint_interval=5, before_checkpoint=None):
+        self._path = path
+        self._name = name
+        self._memory_size = memory_size
+        self._max_size = max_size
+        self._checkpoint_size = checkpoint_size
+        self._checkpoint_interval = checkpoint_interval
+        self._before_checkpoint = before_checkpoint
+        self.__head = []
+        self.__in_flight = {}
+        self.__seen = ScalableBloomFilter()
+        self.__host_counts = {}
+        self.__confs = {}
+        self.__conf_ids = {}
+        self.__pending_tasks = []
+        self.__pending_done = []
+        self.__pending_seen = {}
+        self.__pending_confs = []
+        self.__done_deferred = False
+        self.__size = 0
+        self.__sequence = 0
+        self.__dropped = 0
+        self.__last_checkpoint_time = time.monotonic()
+        self.__connection = sqlite3.connect(path)
+        self.__connection.execute('PRAGMA journal_mode = WAL')
+        self.__connection.execute('PRAGMA synchronous = NORMAL')
+        with self.__connection:
+            for sql in DiskFrontier.__tables:
+                self.__connection.execute(sql)
+        self.__complete = DiskFrontier.__is_complete(self.__connection, name)
+        if not self.__complete:
+            self.__resume()
+
+    @classmethod
+    def is_complete(cls, path, name):
+        '''
+        Whether the frontier of a name in a file has been drained.
+        '''
+        if not os.path.exists(path):
+            return False
+        connection = sqlite3.connect(path)
+        try:
+            return cls.__is_complete(connection, name)
+        finally:
+            connection.close()
+
+    @classmethod
+    def is_pending(cls, path, name):
+        '''
+        Whether the frontier of a name in a file still has queued tasks,
+        left by an interrupted crawl.
+        '''
+        if not os.path.exists(path):
+            return False
+        connection = sqlite3.connect(path)
+        try:
+            if cls.__is_complete(connection, name):
+                return False
+            return connection.execute(cls.__select_pending_sql, (name, )).fetchone() is not None
+        except sqlite3.Error:
+            return False
+        finally:
+            connection.close()
+
+    @classmethod
+    def remove(cls, path):
+        '''
+        Remove a frontier file, once the whole crawl is complete.
+        '''
+        for suffix in cls.__file_suffixes:
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def push(self, url_task):
+        '''
+        Queue a url task, return False if it was rejected.
+        '''
+        if self.__complete:
+            return False
+        url = url_task.url
+        md5 = hashlib.md5(url.encode('utf-8')).digest()
+        if self.__is_seen(md5):
+            return False
+        if self._max_size > 0 and self.__size >= self._max_size:
+            self.__dropped += 1
+            return False
+        host = urlsplit(url).netloc
+        count = self.__host_counts.get(host, 0)
+        max_url_count = url_task.task_conf.max_url_count
+        if max_url_count and max_url_count > 0 and count >= max_url_count:
+            self.__dropped += 1
+            return False
+        self.__seen.add(md5)
+        self.__pending_seen[md5] = host
+        self.__host_counts[host] = count + 1
+        self.__sequence += 1
+        seq = self.__sequence
+        rank = -url_task.task_conf.priority
+        conf_id = self.__get_conf_id(url_task.task_conf)
+        self.__pending_tasks.append((self._name, seq, rank, url_task.depth, url, conf_id))
+        if len(self.__head) < self._memory_size:
+            heapq.heappush(self.__head, (rank, url_task.depth, seq, url_task))
+        self.__size += 1
+        self.__checkpoint_if_needed()
+        return True
+
+    def pop(self):
+        '''
+        Return the next best url task, or None if the frontier is empty.
+        '''
+        if not self.__head and self.__size:
+            self.__refill()
+        if not self.__head:
+            return None
+        seq, url_task = heapq.heappop(self.__head)[2:]
+        self.__in_flight[id(url_task)] = seq
+        self.__size -= 1
+        return url_task
+
+    def task_done(self, url_task):
+        '''
+        Record that a popped task is crawled and its children are pushed.
+        '''
+        seq = self.__in_flight.pop(id(url_task), None)
+        if seq is not None:
+            self.__pending_done.append((self._name, seq))
+            self.__checkpoint_if_needed()
+
+    def checkpoint(self):
+        '''
+        Write the pending changes in one transaction. Done tasks stay
+        pending if the before_checkpoint callable fails.
+        '''
+        if not self.__count_pending():
+            return
+        done = self.__pending_done
+        if done and self._before_checkpoint and not self._before_checkpoint():
+            done = []
+        # retried on the interval only, not on every done task
+        self.__done_deferred = bool(self.__pending_done) and not done
+        seen = [(self._name, md5, host) for md5, host in self.__pending_seen.items()]
+        with self.__connection:
+            self.__connection.executemany(DiskFrontier.__insert_conf_sql, self.__pending_confs)
+            self.__connection.executemany(DiskFrontier.__insert_seen_sql, seen)
+            self.__connection.executemany(DiskFrontier.__insert_task_sql, self.__pending_tasks)
+            self.__connection.executemany(DiskFrontier.__delete_task_sql, done)
+        self.__pending_confs = []
+        self.__pending_seen = {}
+        self.__pending_tasks = []
+        if done:
+            self.__pending_done = []
+        self.__last_checkpoint_time = time.monotonic()
+
+    def close(self):
+        '''
+        Checkpoint, and mark the frontier complete if it is drained.
+        '''
+        if self.__connection is None:
+            return
+        try:
+            self.checkpoint()
+            if not self.__complete and not self.__size and not self.__in_flight \
+                    and not self.__pending_done:
+                with self.__connection:
+                    for sql in DiskFrontier.__complete_sqls:
+                        self.__connection.execute(sql, (self._name, ))
+                self.__complete = True
+        finally:
+            self.__connection.close()
+            self.__connection = None
+
+    def get_dropped_count(self):
+        return self.__dropped
+
+    @classmethod
+    def __is_complete(cls, connection, name):
+        try:
+            row = connection.execute(cls.__select_complete_sql, (name, )).fetchone()
+        except sqlite3.Error:
+            return False
+        return bool(row and row[0])
+
+    def __resume(self):
+        # reload the confs, seen urls, host counts and size of the frontier
+        connection = self.__connection
+        for conf_id, state in connection.execute(DiskFrontier.__select_confs_sql, (self._name, )):
+            task_conf = TaskConf.__new__(TaskConf)
+            task_conf.__setstate__(json.loads(state))
+            self.__confs[conf_id] = task_conf
+            self.__conf_ids[id(task_conf)] = conf_id
+        for row in connection.execute(DiskFrontier.__select_seen_md5_sql, (self._name, )):
+            self.__seen.add(row[0])
+        for host, count in connection.execute(DiskFrontier.__select_host_counts_sql, (self._name, )):
+            self.__host_counts[host] = count
+        count, max_seq = connection.execute(DiskFrontier.__select_task_stats_sql, (self._name, )).fetchone()
+        self.__size = count
+        self.__sequence = max_seq or 0
+
+    def __refill(self):
+        # load the best queued tasks which are not in flight, nor done
+        # while their deletion is deferred
+        from crawler.core.crawlers import UrlTask
+        self.checkpoint()
+        popped = set(self.__in_flight.values())
+        popped.update(seq for _, seq in self.__pending_done)
+        value = (self._name, self._memory_size + len(popped))
+        for seq, rank, depth, url, conf_id in self.__connection.execute(DiskFrontier.__select_tasks_sql, value):
+            if seq not in popped:
+                url_task = UrlTask(self.__confs[conf_id], url, depth)
+                heapq.heappush(self.__head, (rank, depth, seq, url_task))
+
+    def __is_seen(self, md5):
+        if md5 not in self.__seen:
+            return False
+        if md5 in self.__pending_seen:
+            return True
+        row = self.__connection.execute(DiskFrontier.__select_seen_sql, (self._name, md5)).fetchone()
+        return row is not None
+
+    def __get_conf_id(self, task_conf):
+        # task confs are shared by url tasks, so each is written once
+        conf_id = self.__conf_ids.get(id(task_conf))
+        if conf_id is None:
+            conf_id = len(self.__confs) + 1
+            self.__confs[conf_id] = task_conf
+            self.__conf_ids[id(task_conf)] = conf_id
+            state = json.dumps(task_conf.__getstate__())
+            self.__pending_confs.append((self._name, conf_id, state))
+        return conf_id
+
+    def __count_pending(self):
+        return (len(self.__pending_tasks) + len(self.__pending_done)
+                + len(self.__pending_seen) + len(self.__pending_confs))
+
+    def __checkpoint_if_needed(self):
+        if self.__count_pending() >= self._checkpoint_size and not self.__done_deferred:
+            self.checkpoint()
+        elif time.monotonic() - self.__last_checkpoint_time >= self._checkpoint_interval:
+            self.checkpoint()
+
+    def __len__(self):
+        return self.__size
+
+    def __bool__(self):
+        return self.__size > 0
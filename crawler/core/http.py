@@ -1,43 +1,347 @@
-import re
-import urllib
-from urllib.error import HTTPError
-from urllib.parse import urljoin
+import asyncio
+import codecs
+from html.parser import HTMLParser
+from collections import OrderedDict
+import http.client
+import ssl
+import threading
+import time
+from urllib.parse import urlsplit
+import zlib
 
 from crawler.core.common import HttpEngine
+from crawler.core.resolver import DnsResolver
+from crawler.core.stats import CrawlStats
+from crawler.core.urls import UrlNormalizer
 
 
 class DefaultHttpEngine(HttpEngine):
     '''
-    Default HTTP engine implementation.
+    Default HTTP engine implementation. Connections are kept alive
+    and reused across fetches through a per-host connection pool, and
+    HTTPS connections resume the TLS session of the host.
     '''
-    reqHeaders = {
-        'Accept'             : 'text/plain',
-        'Accept-Charset'     : 'utf-8',
-        'Accept-Language'    : 'en-US;zh-CN',
-        'Host'               : 'www.shiyanjun.cn',
-        'Content-Length'     : '10240',
-        'User-Agent'         : 'Mozilla/5.0 (compatible; MSIE 9.0; Windows NT 6.1; Trident/5.0;'
-    }
-    
-    def __init__(self):
+    def __init__(self, pool=None, ssl_context=None):
         super(DefaultHttpEngine, self).__init__()
+        self._pool = pool
+        if not self._pool:
+            self._pool = HttpConnectionPool(ssl_context=ssl_context)
         
     def fetch(self, url_task):
-        url = url_task.url
+        url = url_task.crawl_result.url
         try:
-            response = urllib.request.urlopen(url)
-        except HTTPError as e:
-            self._status_code = int(e.code)
-            self._exceptions.append(e)
+            while url:
+                parts = urlsplit(url)
+                if parts.scheme not in self.SCHEMES:
+                    raise ValueError('Unsupported scheme: url = ' + url)
+                # the url of a followed redirect, or None
+                url = self.__request(parts, url_task.task_conf, url_task.crawl_result)
         except BaseException as e:
             self._exceptions.append(e)
+            CrawlStats.count('http.errors')
+        self._export(url_task.crawl_result)
+        
+    def __request(self, parts, task_conf, crawl_result):
+        host = parts.hostname
+        port = parts.port or self.DEFAULT_PORTS[parts.scheme]
+        path = parts.path or '/'
+        if parts.query:
+            path = path + '?' + parts.query
+        headers = self.reqHeaders
+        if crawl_result.request_headers:
+            headers = dict(headers)
+            headers.update(crawl_result.request_headers)
+        while True:
+            conn, reused = self._pool.acquire(host, port, parts.scheme)
+            keep_alive = False
+            try:
+                if not conn.sock:
+                    conn.timeout = _timeout_seconds(task_conf.connect_timeout)
+                    start = time.perf_counter()
+                    conn.connect()
+                    CrawlStats.record('connect', time.perf_counter() - start)
+                    if parts.scheme == 'https':
+                        _count_handshake(conn.sock)
+                else:
+                    CrawlStats.count('http.reused')
+                conn.sock.settimeout(_timeout_seconds(task_conf.socket_timeout))
+                start = time.perf_counter()
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                CrawlStats.record('ttfb', time.perf_counter() - start)
+                self._status_code = response.status
+                self._resp_headers = {}
+                for key in response.headers:
+                    self._resp_headers[key.lower()] = response.headers[key]
+                target_url = self._follow_redirect(crawl_result, response.status, self._resp_headers, task_conf)
+                if target_url:
+                    # drain a short body to keep the connection
+                    response.read(self.CHUNK_SIZE)
+                    keep_alive = response.isclosed() and not response.will_close
+                    return target_url
+                self._aborted = self._check_head(self._resp_headers, task_conf)
+                if self._aborted:
+                    # the connection is closed with the body unread
+                    CrawlStats.count('http.aborted')
+                    return
+                sink = BodySink(crawl_result, response.status, self._resp_headers, task_conf.max_body_size)
+                start = time.perf_counter()
+                self._binary_data = self.__read_body(response, sink)
+                CrawlStats.record('download', time.perf_counter() - start)
+                self._aborted = sink.aborted
+                keep_alive = not response.will_close and not sink.aborted
+                return None
+            except (ConnectionError, http.client.BadStatusLine):
+                # the server may have closed an idle connection, retry once
+                # on a new one
+                if not reused:
+                    raise
+            finally:
+                self._pool.release(host, port, conn, keep_alive, parts.scheme)
+    
+    def __read_body(self, response, sink):
+        # hand the body to the sink chunk by chunk as it comes off the socket
+        while True:
+            chunk = response.read(self.CHUNK_SIZE)
+            if not chunk or not sink.write(chunk):
+                break
+        return sink.close()
+    
+    def clone(self):
+        # shares the connection pool, which is closed with this engine
+        return DefaultHttpEngine(self._pool)
+    
+    def get_ssl_context(self):
+        return self._pool.get_ssl_context()
+    
+    def reuse(self):
+        if self._is_reuseable:
+            # clear status, but keep pooled connections
+            self._initialize()
         else:
-            self._status_code = response.status
-            for key in response.headers:
-                self._resp_headers[key] = response.headers[key]
-            data = response.read()
-            if data:
-                self._binary_data = data
+            raise BaseException('Can not be reused!')
+        
+    def close(self):
+        super(DefaultHttpEngine, self).close()
+        self._pool.close()
+    
+
+class HttpConnectionPool:
+    '''
+    Pool of persistent HTTP/1.1 connections keyed by scheme, host and
+    port. At most max_per_host connections to a host are in use at the
+    same time, and an idle connection is closed after idle_timeout
+    seconds. HTTPS connections share one TLS context, which caches the
+    session of each host for new connections to resume.
+    '''
+    def __init__(self, max_per_host=4, idle_timeout=30, ssl_context=None):
+        self._max_per_host = max_per_host
+        self._idle_timeout = idle_timeout
+        self._ssl_context = ssl_context
+        self.__idle = {}
+        self.__active = {}
+        self.__closed = False
+        self.__condition = threading.Condition()
+        
+    def acquire(self, host, port, scheme='http'):
+        '''
+        Return a (connection, reused) pair, blocking while the host
+        has no free connection slot.
+        '''
+        key = (scheme, host, port)
+        with self.__condition:
+            while True:
+                if self.__closed:
+                    raise ValueError('Connection pool is closed!')
+                conn = self.__pop_idle(key)
+                if conn:
+                    self.__active[key] += 1
+                    return conn, True
+                if self.__active.get(key, 0) < self._max_per_host:
+                    self.__active[key] = self.__active.get(key, 0) + 1
+                    break
+                self.__condition.wait()
+        if scheme == 'https':
+            return ResolvingHTTPSConnection(host, port, context=self.get_ssl_context()), False
+        return ResolvingHTTPConnection(host, port), False
+    
+    def release(self, host, port, conn, keep_alive=True, scheme='http'):
+        key = (scheme, host, port)
+        if scheme == 'https' and conn.sock:
+            # the session ticket of TLS 1.3 comes after the handshake
+            self.get_ssl_context().save_session(host, conn.sock)
+        with self.__condition:
+            self.__active[key] -= 1
+            if keep_alive and conn.sock and not self.__closed:
+                self.__idle.setdefault(key, []).append((conn, time.monotonic()))
+                conn = None
+            self.__condition.notify_all()
+        if conn:
+            conn.close()
+    
+    def get_ssl_context(self):
+        with self.__condition:
+            if self._ssl_context is None:
+                self._ssl_context = ResumableSSLContext.create_default()
+            return self._ssl_context
+    
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            idle = self.__idle
+            self.__idle = {}
+            self.__condition.notify_all()
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+        
+    def __pop_idle(self, key):
+        # the most recently used connection is the least likely to be stale
+        conns = self.__idle.get(key)
+        now = time.monotonic()
+        while conns:
+            conn, last_used = conns.pop()
+            if now - last_used < self._idle_timeout:
+                return conn
+            conn.close()
+        if key in self.__idle:
+            del self.__idle[key]
+        return None
+    
+
+class ResolvingHTTPConnection(http.client.HTTPConnection):
+    '''
+    HTTP connection resolving its host through the shared DNS cache.
+    '''
+    def __init__(self, host, port=None, **kwargs):
+        super(ResolvingHTTPConnection, self).__init__(host, port, **kwargs)
+        self._create_connection = DnsResolver.create_connection
+    
+
+class ResolvingHTTPSConnection(http.client.HTTPSConnection):
+    '''
+    HTTPS connection resolving its host through the shared DNS cache.
+    Given a ResumableSSLContext, the handshake resumes the cached TLS
+    session of the host.
+    '''
+    def __init__(self, host, port=None, **kwargs):
+        super(ResolvingHTTPSConnection, self).__init__(host, port, **kwargs)
+        self._create_connection = DnsResolver.create_connection
+    
+
+class ResumableSSLContext(ssl.SSLContext):
+    '''
+    Client TLS context caching the last session of each host, which is
+    offered by the next handshake with the host, so that it skips the
+    certificate exchange and key agreement of a full handshake. Both
+    wrap_socket (blocking connections) and wrap_bio (asyncio streams)
+    look up the session by server hostname. At most MAX_SESSIONS hosts
+    are cached, least recently used first out.
+    '''
+    MAX_SESSIONS = 4096
+    
+    @classmethod
+    def create_default(cls):
+        '''
+        Return a context verifying certificates against the default CA
+        certificates, like ssl.create_default_context.
+        '''
+        context = cls(ssl.PROTOCOL_TLS_CLIENT)
+        context.load_default_certs()
+        context.set_alpn_protocols(['http/1.1'])
+        return context
+    
+    def __init__(self, protocol=ssl.PROTOCOL_TLS_CLIENT):
+        super(ResumableSSLContext, self).__init__()
+        self.__sessions = OrderedDict()
+        self.__lock = threading.Lock()
+    
+    def wrap_socket(self, sock, server_side=False, do_handshake_on_connect=True,
+                    suppress_ragged_eofs=True, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.get_session(server_hostname)
+        return super(ResumableSSLContext, self).wrap_socket(sock, server_side, do_handshake_on_connect,
+                                                            suppress_ragged_eofs, server_hostname, session)
+    
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.get_session(server_hostname)
+        return super(ResumableSSLContext, self).wrap_bio(incoming, outgoing, server_side,
+                                                         server_hostname, session)
+    
+    def get_session(self, host):
+        if not host:
+            return None
+        with self.__lock:
+            session = self.__sessions.get(host)
+            if session is not None:
+                self.__sessions.move_to_end(host)
+            return session
+    
+    def save_session(self, host, ssl_object):
+        '''
+        Cache the session of a TLS socket or object with a host.
+        '''
+        session = getattr(ssl_object, 'session', None)
+        if not host or session is None or not session.has_ticket and not session.id:
+            return
+        with self.__lock:
+            self.__sessions[host] = session
+            self.__sessions.move_to_end(host)
+            while len(self.__sessions) > ResumableSSLContext.MAX_SESSIONS:
+                self.__sessions.popitem(last=False)
+    
+    def clear_sessions(self):
+        with self.__lock:
+            self.__sessions.clear()
+    
+    
+class AsyncHttpEngine(HttpEngine):
+    '''
+    HTTP engine implementation based on asyncio. One engine keeps many
+    requests in flight on a single event loop, and a global semaphore
+    caps the number of concurrent connections.
+    The fetch status is written into the crawl result of each url task,
+    since the engine itself is shared by all in-flight requests.
+    '''
+    MAX_HEADER_COUNT = 128
+    
+    def __init__(self, max_concurrency=256, ssl_context=None):
+        super(AsyncHttpEngine, self).__init__()
+        self._max_concurrency = max_concurrency
+        self._ssl_context = ssl_context
+        self.__loop = None
+        self.__semaphore = None
+        
+    def is_async(self):
+        return True
+    
+    def get_max_concurrency(self):
+        return self._max_concurrency
+    
+    def fetch(self, url_task):
+        # blocking entry, must not be called inside a running event loop
+        asyncio.run(self.fetch_async(url_task))
+        result = url_task.crawl_result
+        self._status_code = result.status_code or 0
+        self._resp_headers = dict(result.response_headers)
+        self._binary_data = result.binary_data
+        self._aborted = result.aborted
+        self._exceptions.extend(result.exceptions)
+    
+    async def fetch_async(self, url_task):
+        result = url_task.crawl_result
+        conf = url_task.task_conf
+        async with self.__get_semaphore():
+            try:
+                url = result.url
+                while url:
+                    # the url of a followed redirect, or None
+                    url = await asyncio.wait_for(self.__request(url, result, conf),
+                                                 _timeout_seconds(conf.socket_timeout))
+            except Exception as e:
+                result.exceptions.append(e)
+                CrawlStats.count('http.errors')
     
     def reuse(self):
         if self._is_reuseable:
@@ -46,71 +350,354 @@ class DefaultHttpEngine(HttpEngine):
         else:
             raise BaseException('Can not be reused!')
     
+    def get_ssl_context(self):
+        if self._ssl_context is None:
+            self._ssl_context = ResumableSSLContext.create_default()
+        return self._ssl_context
+    
+    def __get_semaphore(self):
+        # a semaphore is bound to the event loop it is first used in
+        loop = asyncio.get_running_loop()
+        if self.__loop is not loop:
+            self.__loop = loop
+            self.__semaphore = asyncio.Semaphore(self._max_concurrency)
+        return self.__semaphore
+        
+    async def __request(self, url, crawl_result, task_conf):
+        parts = urlsplit(url)
+        if parts.scheme not in self.SCHEMES:
+            raise ValueError('Unsupported scheme: url = ' + url)
+        port = parts.port or self.DEFAULT_PORTS[parts.scheme]
+        path = parts.path or '/'
+        if parts.query:
+            path = path + '?' + parts.query
+        ssl_context = None
+        if parts.scheme == 'https':
+            ssl_context = self.get_ssl_context()
+            connecting = DnsResolver.open_connection(parts.hostname, port, ssl=ssl_context,
+                                                     server_hostname=parts.hostname)
+        else:
+            connecting = DnsResolver.open_connection(parts.hostname, port)
+        start = time.perf_counter()
+        reader, writer = await asyncio.wait_for(connecting,
+                                                _timeout_seconds(task_conf.connect_timeout))
+        CrawlStats.record('connect', time.perf_counter() - start)
+        if ssl_context:
+            _count_handshake(writer.get_extra_info('ssl_object'))
+        try:
+            start = time.perf_counter()
+            writer.write(self.__build_request(path, parts.netloc, crawl_result.request_headers))
+            await writer.drain()
+            status_code, headers = await self.__read_head(reader)
+            CrawlStats.record('ttfb', time.perf_counter() - start)
+            crawl_result.status_code = status_code
+            crawl_result.response_headers = headers
+            target_url = self._follow_redirect(crawl_result, status_code, headers, task_conf)
+            if target_url:
+                return target_url
+            crawl_result.aborted = self._check_head(headers, task_conf)
+            if crawl_result.aborted:
+                CrawlStats.count('http.aborted')
+                return None
+            sink = BodySink(crawl_result, status_code, headers, task_conf.max_body_size)
+            start = time.perf_counter()
+            async for chunk in self.__read_body(reader, status_code, headers):
+                if not sink.write(chunk):
+                    break
+            crawl_result.binary_data = sink.close()
+            CrawlStats.record('download', time.perf_counter() - start)
+            crawl_result.aborted = sink.aborted
+            return None
+        finally:
+            if ssl_context:
+                # the session ticket of TLS 1.3 comes after the handshake
+                ssl_context.save_session(parts.hostname, writer.get_extra_info('ssl_object'))
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+    
+    def __build_request(self, path, host, request_headers):
+        lines = ['GET ' + path + ' HTTP/1.1', 'Host: ' + host]
+        headers = dict(self.reqHeaders)
+        headers.update(request_headers)
+        for key, value in headers.items():
+            lines.append(key + ': ' + value)
+        lines.append('Connection: close')
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+    
+    async def __read_head(self, reader):
+        status_line = await reader.readline()
+        parts = status_line.decode('latin-1').split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+            raise ValueError('Bad status line: ' + repr(status_line))
+        status_code = int(parts[1])
+        headers = {}
+        for _ in range(AsyncHttpEngine.MAX_HEADER_COUNT):
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                return status_code, headers
+            key, _, value = line.decode('latin-1').partition(':')
+            key = key.strip().lower()
+            value = value.strip()
+            if key in headers:
+                headers[key] = headers[key] + ', ' + value
+            else:
+                headers[key] = value
+        raise ValueError('Too many response headers!')
+    
+    async def __read_body(self, reader, status_code, headers):
+        # yield raw body chunks as they arrive
+        if status_code < 200 or status_code in (204, 304):
+            return
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            while True:
+                size_line = await reader.readline()
+                size = int(size_line.split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    # skip trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                while size > 0:
+                    chunk = await reader.readexactly(min(size, self.CHUNK_SIZE))
+                    size -= len(chunk)
+                    yield chunk
+                await reader.readline()
+        content_length = headers.get('content-length')
+        if content_length is not None:
+            remaining = int(content_length)
+            while remaining > 0:
+                chunk = await reader.readexactly(min(remaining, self.CHUNK_SIZE))
+                remaining -= len(chunk)
+                yield chunk
+            return
+        # connection is closed by server after the body
+        while True:
+            chunk = await reader.read(self.CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+    
+
+class BodySink:
+    '''
+    Receiver of a response body as it is read. Each chunk is decoded by
+    the Content-Encoding in pieces of at most CHUNK_SIZE bytes, and the
+    body is cut at max_body_size bytes of decoded data. Pieces are
+    handed to the consumers of the crawl result, which are opened with
+    the status and headers first, and are only joined into the body if
+    the crawl result keeps data.
+    A consumer has open(status_code, headers), feed(chunk) and close().
+    The decode time and the raw and decoded sizes go to CrawlStats.
+    '''
+    def __init__(self, crawl_result, status_code, headers, max_body_size=-1):
+        self._max_body_size = max_body_size
+        self.__decoder = ContentDecoder(headers.get('content-encoding'))
+        self.__consumers = crawl_result.consumers
+        self.__chunks = [] if crawl_result.keep_data else None
+        self.size = 0
+        self.raw_size = 0
+        self.aborted = None
+        self.__decode_time = 0.0
+        for consumer in self.__consumers:
+            consumer.open(status_code, headers)
+    
+    def write(self, chunk):
+        '''
+        Take a raw chunk, return False once the body is cut.
+        '''
+        self.raw_size += len(chunk)
+        start = time.perf_counter()
+        for data in self.__decoder.iter_decode(chunk, HttpEngine.CHUNK_SIZE):
+            self.__decode_time += time.perf_counter() - start
+            if not self.__put(data):
+                return False
+            start = time.perf_counter()
+        self.__decode_time += time.perf_counter() - start
+        return True
+    
+    def close(self):
+        '''
+        Close the consumers, and return the kept body or None.
+        '''
+        if not self.aborted:
+            self.__put(self.__decoder.flush())
+        for consumer in self.__consumers:
+            consumer.close()
+        CrawlStats.record('decode', self.__decode_time)
+        CrawlStats.count('bytes', self.size)
+        CrawlStats.count('bytes.raw', self.raw_size)
+        if self.__chunks:
+            return b''.join(self.__chunks)
+        return None
+    
+    def __put(self, data):
+        if self._max_body_size and self._max_body_size > 0:
+            if self.size + len(data) > self._max_body_size:
+                data = data[:self._max_body_size - self.size]
+                self.aborted = 'Body size > ' + str(self._max_body_size)
+        if data:
+            self.size += len(data)
+            for consumer in self.__consumers:
+                consumer.feed(data)
+            if self.__chunks is not None:
+                self.__chunks.append(data)
+        return not self.aborted
+    
+
+class ContentDecoder:
+    '''
+    Streaming decoder of a response body by its Content-Encoding, which
+    supports gzip and deflate. Deflate data is accepted both with the
+    zlib wrapper (RFC 1950) and raw (RFC 1951), as servers send either.
+    Other encodings are passed through.
+    '''
+    def __init__(self, content_encoding=None):
+        self.__decompressor = None
+        self.__pending = b''
+        self.__tail = b''
+        self.__is_deflate = False
+        encoding = (content_encoding or '').strip().lower()
+        if encoding in ('gzip', 'x-gzip'):
+            self.__decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self.__is_deflate = True
+            
+    def decode(self, chunk, max_length=0):
+        '''
+        Decode a chunk. If max_length is positive, at most max_length
+        bytes are returned, and the rest is returned by the next calls.
+        '''
+        if self.__is_deflate and not self.__decompressor:
+            # choose the deflate flavor by the first two bytes
+            self.__pending += chunk
+            if len(self.__pending) < 2:
+                return b''
+            chunk = self.__pending
+            self.__pending = b''
+            cmf, flg = chunk[0], chunk[1]
+            if cmf & 0x0f == 8 and ((cmf << 8) | flg) % 31 == 0:
+                self.__decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+            else:
+                self.__decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        if self.__decompressor:
+            data = self.__decompressor.decompress(self.__tail + chunk, max_length)
+            self.__tail = self.__decompressor.unconsumed_tail
+            return data
+        return chunk
+    
+    def iter_decode(self, chunk, piece_size):
+        '''
+        Yield the decoded data of a chunk in pieces of at most piece_size
+        bytes, so a small compressed chunk is never inflated at once.
+        '''
+        data = self.decode(chunk, piece_size)
+        while data:
+            yield data
+            if not self.__decompressor:
+                return
+            data = self.decode(b'', piece_size)
+    
+    def flush(self):
+        if self.__decompressor:
+            return self.__decompressor.flush()
+        return self.__pending
+    
+
+def _count_handshake(ssl_object):
+    CrawlStats.count('tls.handshakes')
+    if ssl_object is not None and ssl_object.session_reused:
+        CrawlStats.count('tls.resumed')
+
+
+def _timeout_seconds(millis):
+    # non-positive timeout in milliseconds means no timeout
+    if millis and millis > 0:
+        return millis / 1000.0
+    return None
+    
 
 class HtmlParser:
     '''
-    HTML related parser tool.
+    HTML related parser tool. Links are checked by UrlNormalizer, the
+    bad characters and suffix names are kept here as lists, as before.
     '''
     BAD_CHARACTERS = ['\'', '\"', '>', '<', ' ']
-    BAD_SUFFIX_NAMES = [
-        '.zip', '.rar', '.iso', '.gz', '.tar', '.jar', 
-        '.gzip', '.7z', '.cab', '.uue', '.bz2', '.z',
-        '.rmvb', '.mkv', '.mp3', '.mp4', '.mov', '.flv',
-        '.wmv', '.asf', '.csf', '.sts', '.swf', '.avi',
-        '.ts', '.acm', '.adf', '.aiff', '.ani', '.dll', 
-        '.so', '.emf', '.tiff', '.psd', '.pcx', '.wmf',
-        '.png', '.gif', '.bmp', '.ico', '.jpg', '.jpeg',
-        '.pdf', '.doc', '.docx', '.xls', '.xlsx', '.txt',
-        '.ppt', '.pptx', '.mdf', '.exe', '.css', 
-        '.java', '.cpp', '.py', '.rb', '.go', '.php',
-        '.c', '.cc', '.hpp', '.sh', '.pl', '.clj', '.h'
-    ]
+    BAD_SUFFIX_NAMES = sorted(UrlNormalizer.BAD_SUFFIX_NAMES)
     
     @classmethod
     def extract_urls(cls, html):
         urls = []
         if html and len(html) > 0:
-            all_urls = re.findall(r"<a.*?href=\s*[\"']*([^\"']+).*?<\/a>", html, re.I)
-            for url in all_urls:
-                if url and len(url.strip()) > 0:
-                    urls.append(url)
+            with CrawlStats.timer('parse.links'):
+                extractor = LinkExtractor()
+                extractor.feed(html)
+                urls = extractor.close()
         return urls
     
     @classmethod
     def normalize_urls(cls, urls, base_url=None):
-        url_set = set()
-        for url in urls:
-            u = None
-            # discard url with bad suffix name
-            lowered_url = url.lower()
-            for name in HtmlParser.BAD_SUFFIX_NAMES:
-                if lowered_url.endswith(name):
-                    continue
-            # discard url containing bad characters
-            bad_character_found = False
-            for ch in HtmlParser.BAD_CHARACTERS:
-                if url.find(ch) != -1:
-                    bad_character_found = True
-                    break
-            if not bad_character_found:
-                u = url
-            # url starting with '#'
-            if url.startswith('#'):
-                continue
-            if lowered_url.startswith('http://'):
-                # url starting with 'http://'
-                lowest_index = url.find('#')
-                if lowest_index != -1:
-                    u = url.split('#')[0]
-            elif lowered_url.startswith('https://'):
-                # url starting with 'https://'
-                continue
-            else:
-                # join base url and a relative url
-                if base_url:
-                    u = urljoin(base_url, url)
-            # collect normalized urls
-            if u:
-                url_set.add(u)
-        return url_set
+        with CrawlStats.timer('parse.normalize'):
+            return UrlNormalizer.normalize_urls(urls, base_url)
     
+
+class LinkExtractor(HTMLParser):
+    '''
+    Streaming link extractor. Byte chunks are decoded incrementally and
+    tokenized as they arrive, and hrefs of <a> and <area> tags are handed
+    out as soon as their tags are complete. Only an unfinished tag is
+    buffered, so memory stays bounded and work is linear in page size.
+    The first <base href> seen is kept in base_url.
+    '''
+    LINK_TAGS = frozenset(['a', 'area'])
+    
+    def __init__(self, charset='utf-8'):
+        super(LinkExtractor, self).__init__(convert_charrefs=True)
+        try:
+            self.__decoder = codecs.getincrementaldecoder(charset)(errors='replace')
+        except LookupError:
+            self.__decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.base_url = None
+        self.__urls = []
+    
+    def feed_bytes(self, chunk):
+        '''
+        Feed a chunk of page bytes, return hrefs completed by this chunk.
+        '''
+        self.feed(self.__decoder.decode(chunk))
+        return self.__drain()
+    
+    def extract(self, chunks):
+        '''
+        Yield hrefs from an iterable of byte chunks.
+        '''
+        for chunk in chunks:
+            yield from self.feed_bytes(chunk)
+        yield from self.close()
+    
+    def close(self):
+        '''
+        Flush pending data, return the remaining hrefs.
+        '''
+        self.feed(self.__decoder.decode(b'', True))
+        super(LinkExtractor, self).close()
+        return self.__drain()
+    
+    def handle_starttag(self, tag, attrs):
+        if tag in LinkExtractor.LINK_TAGS:
+            for name, value in attrs:
+                if name == 'href' and value:
+                    value = value.strip()
+                    if value:
+                        self.__urls.append(value)
+        elif tag == 'base' and self.base_url is None:
+            for name, value in attrs:
+                if name == 'href' and value and value.strip():
+                    self.base_url = value.strip()
+    
+    def __drain(self):
+        urls = self.__urls
+        self.__urls = []
+        return urls
@@ -1,29 +1,35 @@
-import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import multiprocessing
+import os
 
-from crawler.core.common import CrawlerManager, CrawlerConf, Key
+from crawler.core.common import CrawlerManager, CrawlerConf, Key, LoggerFactory
 from crawler.core.crawlers import TaskFactory, DefaultCrawler
+from crawler.core.frontier import DiskFrontier
+from crawler.core.stats import CrawlStats
+from crawler.core.storage import SQLite
 from crawler.core.utils import UniqIdGenerator
 
 
+_LOG = LoggerFactory.get_logger(__name__)
+
+
 class DefaultCrawlerManager(CrawlerManager):
     '''
     Default crawler manager implementation.
     '''
-    __FORMAT = ''
-    __LOG = logging.getLogger(__name__)
-    
     def __init__(self, settings):
         super(DefaultCrawlerManager, self).__init__(settings)
         task_file = settings[Key.CRAWLER_TASK_FILE]
         self._seed_tasks = TaskFactory.build_seeds(task_file)
-        self._storage = settings[Key.CRAWLER_STORAGE_CLASS]()
-        self._storage.initialize()
+        self._storage = _create_storage(settings, settings.get(Key.CRAWLER_STORAGE_DB))
         self._http_engine = settings[Key.CRAWLER_HTTP_ENGINE_CLASS]()
         # initialize default crawler conf
         self.__crawler_conf = CrawlerConf()
         self.__crawler_conf.mode = settings[Key.CRAWLER_CRAWL_MODE]
         self.__crawler_conf.http_engine = self._http_engine
         self.__crawler_conf.storage = self._storage
+        self.__crawler_conf.frontier_db = settings.get(Key.CRAWLER_FRONTIER_DB)
         seed = self.__class__.__name__
         self.__crawler_conf.crawler_name =  'crawler-' + str(UniqIdGenerator.next_id(seed))
     
@@ -39,9 +45,135 @@ class DefaultCrawlerManager(CrawlerManager):
             if crawler:
                 crawler.crawl(task)
                 self.notify_complete(crawler.get_name())
-        # close database
+        # every seed is complete, the next run starts over
+        if self.__crawler_conf.frontier_db:
+            DiskFrontier.remove(self.__crawler_conf.frontier_db)
+        # close database and HTTP connections
         self._storage.close()
+        self._http_engine.close()
         
     def notify_complete(self, crawler_name):
         self._crawlers.pop(crawler_name)
     
+
+class ProcessCrawlerManager(CrawlerManager):
+    '''
+    Crawler manager running seed tasks in a pool of worker processes.
+    Seed tasks are sharded by a hash of their domain, so all tasks of a
+    host go to the same worker, and each worker crawls its shard with its
+    own HTTP engine and a storage on its own database file. A shard
+    starts from the rows of its hosts copied from the manager's database,
+    so stored pages are revalidated or skipped as in a single process.
+    Completed shards are merged into the manager's storage and their
+    files removed.
+    The number of workers is the crawler.process.count setting, or the
+    number of CPUs. With crawler.frontier.db set, each worker keeps a
+    resumable frontier file per shard, so a crawl resumes when it is run
+    again with the same number of workers.
+    '''
+    __shard_suffix = '.shard-'
+    __file_suffixes = ('', '-wal', '-shm', '.bloom')
+    
+    def __init__(self, settings):
+        super(ProcessCrawlerManager, self).__init__(settings)
+        self._settings = settings
+        task_file = settings[Key.CRAWLER_TASK_FILE]
+        self._seed_tasks = TaskFactory.build_seeds(task_file)
+        self._process_count = settings.get(Key.CRAWLER_PROCESS_COUNT) or os.cpu_count() or 1
+        self._storage = _create_storage(settings, settings.get(Key.CRAWLER_STORAGE_DB))
+        self._db = SQLite.get_db()
+        seed = self.__class__.__name__
+        self._name_prefix = 'crawler-' + str(UniqIdGenerator.next_id(seed))
+    
+    def create_crawler(self, task):
+        # crawlers are created by the worker processes
+        return None
+    
+    def wait_for(self):
+        shards = self.__shard_tasks()
+        if not shards:
+            self._storage.close()
+            return
+        # spawned workers do not inherit the SQLite connections and locks
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(len(shards), mp_context=context) as executor:
+            futures = {}
+            for index, tasks in shards.items():
+                crawler_name = self._name_prefix + '-' + str(index)
+                db = self._db + ProcessCrawlerManager.__shard_suffix + str(index)
+                future = executor.submit(_crawl_shard, self._settings, crawler_name, index, db,
+                                         self._db, tasks)
+                futures[future] = db
+                self._crawlers[crawler_name] = future
+            for future in as_completed(futures):
+                try:
+                    crawler_name, stats = future.result()
+                except Exception as e:
+                    _LOG.error('Fail to crawl shard: db = %s, %s', futures[future], e)
+                else:
+                    # statistics of the worker process add up here
+                    CrawlStats.merge(stats)
+                    self.notify_complete(crawler_name)
+                # a failed worker may still have stored pages
+                self.__merge_shard(futures[future])
+        self._storage.close()
+    
+    def notify_complete(self, crawler_name):
+        self._crawlers.pop(crawler_name, None)
+    
+    def __shard_tasks(self):
+        # stable across runs and processes, unlike hash()
+        shards = {}
+        for task in self._seed_tasks:
+            digest = hashlib.md5(task.task_conf.domain.encode('utf-8')).digest()
+            index = int.from_bytes(digest[:8], 'big') % self._process_count
+            shards.setdefault(index, []).append(task)
+        return shards
+    
+    def __merge_shard(self, db):
+        if not os.path.exists(db):
+            return
+        if self._storage.merge(db):
+            for suffix in ProcessCrawlerManager.__file_suffixes:
+                try:
+                    os.remove(db + suffix)
+                except FileNotFoundError:
+                    pass
+        else:
+            _LOG.error('Fail to merge shard: db = %s', db)
+    
+
+def _create_storage(settings, db):
+    # stored pages are crawled again once older than the recrawl interval
+    recrawl_interval = settings.get(Key.CRAWLER_RECRAWL_INTERVAL, -1)
+    storage = settings[Key.CRAWLER_STORAGE_CLASS](db=db, recrawl_interval=recrawl_interval)
+    storage.initialize()
+    return storage
+
+
+def _crawl_shard(settings, crawler_name, index, db, main_db, tasks):
+    # run in a worker process: crawl the seed tasks of a shard in order,
+    # from the crawl state of their hosts in the main database
+    LoggerFactory.start()
+    storage = _create_storage(settings, db)
+    if not storage.copy_from(main_db, [task.task_conf.domain for task in tasks]):
+        _LOG.warning('Fail to copy crawl state of shard: db = %s', db)
+    http_engine = settings[Key.CRAWLER_HTTP_ENGINE_CLASS]()
+    crawler_conf = CrawlerConf()
+    crawler_conf.mode = settings[Key.CRAWLER_CRAWL_MODE]
+    crawler_conf.crawler_name = crawler_name
+    crawler_conf.http_engine = http_engine
+    crawler_conf.storage = storage
+    frontier_db = settings.get(Key.CRAWLER_FRONTIER_DB)
+    if frontier_db:
+        crawler_conf.frontier_db = frontier_db + '.shard-' + str(index)
+    try:
+        for task in tasks:
+            crawler = DefaultCrawler(CrawlerConf.clone(crawler_conf))
+            crawler.crawl(task)
+        if crawler_conf.frontier_db:
+            DiskFrontier.remove(crawler_conf.frontier_db)
+    finally:
+        storage.close()
+        http_engine.close()
+    return crawler_name, CrawlStats.snapshot()
@@ -0,0 +1,165 @@
+import queue
+import threading
+import time
+
+from crawler.core.common import LoggerFactory
+from crawler.core.stats import CrawlStats
+
+
+_LOG = LoggerFactory.get_logger(__name__)
+
+
+class PipelineStage:
+    '''
+    A stage of a pipeline: a bounded queue of items, and the worker
+    threads running the handler of the stage on them.
+    '''
+    def __init__(self, name, handler, workers=1, queue_size=64, error_handler=None):
+        self.name = name
+        self.handler = handler
+        self.error_handler = error_handler
+        self.workers = max(workers, 1)
+        self.queue = queue.Queue(queue_size)
+        self.threads = []
+        self.busy_time = 0.0
+        self.blocked_time = 0.0
+        self.processed = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+
+class Pipeline:
+    '''
+    Stages of work joined by bounded queues, each stage running its
+    handler on its own pool of worker threads. A handler passes its
+    results to another stage with put, which blocks while the queue of
+    that stage is full, so a slow stage holds back the stages upstream of
+    it down to the producer. The busy time of the workers of a stage over
+    their running time is the utilization of the stage.
+    '''
+    __STOP = object()
+
+    def __init__(self, name='pipeline'):
+        self._name = name
+        self.__stages = {}
+        self.__in_flight = 0
+        self.__condition = threading.Condition()
+        self.__start_time = None
+        self.__stop_time = None
+
+    def add_stage(self, name, handler, workers=1, queue_size=64, error_handler=None):
+        '''
+        Add a stage handling items with handler(item). If the handler
+        raises, error_handler(item, error) is called instead.
+        '''
+        if self.__start_time is not None:
+            raise ValueError('Pipeline is started: ' + self._name)
+        self.__stages[name] = PipelineStage(name, handler, workers, queue_size, error_handler)
+
+    def start(self):
+        self.__start_time = time.monotonic()
+        for stage in self.__stages.values():
+            for i in range(stage.workers):
+                thread = threading.Thread(target=self.__work, args=(stage, ),
+                                          name=self._name + '-' + stage.name + '-' + str(i), daemon=True)
+                stage.threads.append(thread)
+                thread.start()
+        return self
+
+    def put(self, name, item):
+        '''
+        Queue an item for a stage, blocking while the stage is full.
+        '''
+        stage = self.__stages[name]
+        with self.__condition:
+            self.__in_flight += 1
+        try:
+            stage.queue.put_nowait(item)
+        except queue.Full:
+            start = time.perf_counter()
+            stage.queue.put(item)
+            with stage.lock:
+                stage.blocked_time += time.perf_counter() - start
+
+    def join(self):
+        '''
+        Wait until every queued item, and every item queued while
+        handling them, is handled.
+        '''
+        with self.__condition:
+            while self.__in_flight:
+                self.__condition.wait()
+
+    def stop(self):
+        '''
+        Stop the workers once the queued items are handled, and record
+        the utilization of each stage.
+        '''
+        self.join()
+        for stage in self.__stages.values():
+            for _ in stage.threads:
+                stage.queue.put(Pipeline.__STOP)
+        for stage in self.__stages.values():
+            for thread in stage.threads:
+                thread.join()
+        self.__stop_time = time.monotonic()
+        for name, utilization in self.get_utilization().items():
+            # added up as counters, so snapshots of processes merge
+            CrawlStats.count('stage.' + name + '.busy', utilization['busy_time'])
+            CrawlStats.count('stage.' + name + '.capacity', utilization['capacity'])
+            CrawlStats.count('stage.' + name + '.blocked', utilization['blocked_time'])
+            _LOG.info('Stage %s: workers = %d, processed = %d, errors = %d, utilization = %.2f, blocked = %.3fs',
+                      name, utilization['workers'], utilization['processed'], utilization['errors'],
+                      utilization['utilization'], utilization['blocked_time'])
+
+    def get_utilization(self):
+        '''
+        Return per stage its workers, processed items, errors, busy time,
+        capacity (workers times running time), utilization, time spent
+        blocked on its full queue, and queued items.
+        '''
+        if self.__start_time is None:
+            return {}
+        elapsed = (self.__stop_time or time.monotonic()) - self.__start_time
+        utilization = {}
+        for name, stage in self.__stages.items():
+            with stage.lock:
+                capacity = stage.workers * elapsed
+                utilization[name] = {
+                    'workers' : stage.workers,
+                    'processed' : stage.processed,
+                    'errors' : stage.errors,
+                    'busy_time' : stage.busy_time,
+                    'capacity' : capacity,
+                    'utilization' : stage.busy_time / capacity if capacity > 0 else 0.0,
+                    'blocked_time' : stage.blocked_time,
+                    'queued' : stage.queue.qsize()
+                }
+        return utilization
+
+    def __work(self, stage):
+        while True:
+            item = stage.queue.get()
+            if item is Pipeline.__STOP:
+                break
+            error = False
+            start = time.perf_counter()
+            try:
+                stage.handler(item)
+            except Exception as e:
+                error = True
+                _LOG.exception('Fail to handle item: stage = %s', stage.name)
+                if stage.error_handler:
+                    stage.error_handler(item, e)
+            elapsed = time.perf_counter() - start
+            CrawlStats.record('stage.' + stage.name, elapsed)
+            with stage.lock:
+                stage.busy_time += elapsed
+                stage.processed += 1
+                if error:
+                    stage.errors += 1
+            # items the handler queued are in flight before this one is done
+            with self.__condition:
+                self.__in_flight -= 1
+                if not self.__in_flight:
+                    self.__condition.notify_all()
@@ -0,0 +1,156 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import ipaddress
+import socket
+import threading
+import time
+
+from crawler.core.stats import CrawlStats
+
+
+class DnsResolver:
+    '''
+    Process-wide DNS cache shared by all engines and crawlers.
+    The addresses of a host are cached for TTL seconds, and a failed
+    lookup for NEGATIVE_TTL seconds. Lookups run on a small thread pool,
+    and concurrent lookups of the same host wait for one pending future,
+    so a caller may block on it (resolve), await it (resolve_async), or
+    just start it (prefetch).
+    '''
+    TTL = 300
+    NEGATIVE_TTL = 30
+    MAX_WORKERS = 16
+    MAX_ENTRIES = 65536
+    __cache = OrderedDict()
+    __pending = {}
+    __executor = None
+    __lock = threading.Lock()
+
+    @classmethod
+    def resolve(cls, host):
+        '''
+        Return the (family, ip) pairs of a host, raise socket.gaierror
+        if it does not resolve.
+        '''
+        entry = cls.__get_entry(host)
+        if entry is None:
+            entry = cls.__submit(host).result()
+        return cls.__addresses(entry)
+
+    @classmethod
+    async def resolve_async(cls, host):
+        entry = cls.__get_entry(host)
+        if entry is None:
+            entry = await asyncio.wrap_future(cls.__submit(host))
+        return cls.__addresses(entry)
+
+    @classmethod
+    def prefetch(cls, hosts):
+        '''
+        Start resolving hosts in the background, without waiting.
+        '''
+        for host in hosts:
+            if host and cls.__get_entry(host) is None:
+                cls.__submit(host)
+
+    @classmethod
+    def create_connection(cls, address, timeout=None, source_address=None):
+        '''
+        Like socket.create_connection, with the host resolved through the
+        cache. Addresses are tried in order.
+        '''
+        host, port = address
+        error = None
+        for family, ip in cls.resolve(host):
+            try:
+                return socket.create_connection((ip, port), timeout, source_address)
+            except OSError as e:
+                error = e
+        raise error
+
+    @classmethod
+    async def open_connection(cls, host, port, **kwargs):
+        '''
+        Like asyncio.open_connection, with the host resolved through the
+        cache. Addresses are tried in order.
+        '''
+        error = None
+        for family, ip in await cls.resolve_async(host):
+            try:
+                return await asyncio.open_connection(ip, port, **kwargs)
+            except OSError as e:
+                error = e
+        raise error
+
+    @classmethod
+    def clear(cls):
+        with cls.__lock:
+            cls.__cache.clear()
+
+    @classmethod
+    def __get_entry(cls, host):
+        # (expire_time, addresses, error) of a host, or None if not cached
+        with cls.__lock:
+            entry = cls.__cache.get(host)
+            if entry is None:
+                literal = cls.__literal_entry(host)
+                if literal:
+                    return literal
+            elif entry[0] <= time.monotonic():
+                del cls.__cache[host]
+                entry = None
+        return entry
+
+    @classmethod
+    def __literal_entry(cls, host):
+        # ip literals are never looked up
+        try:
+            ip = ipaddress.ip_address(host)
+        except ValueError:
+            return None
+        family = socket.AF_INET6 if ip.version == 6 else socket.AF_INET
+        return (float('inf'), [(family, host)], None)
+
+    @classmethod
+    def __submit(cls, host):
+        with cls.__lock:
+            future = cls.__pending.get(host)
+            if future is None:
+                if cls.__executor is None:
+                    cls.__executor = ThreadPoolExecutor(cls.MAX_WORKERS, thread_name_prefix='dns')
+                future = cls.__executor.submit(cls.__lookup, host)
+                cls.__pending[host] = future
+        return future
+
+    @classmethod
+    def __lookup(cls, host):
+        addresses = []
+        error = None
+        start = time.perf_counter()
+        try:
+            for family, _, _, _, sockaddr in socket.getaddrinfo(host, None, type=socket.SOCK_STREAM):
+                if (family, sockaddr[0]) not in addresses:
+                    addresses.append((family, sockaddr[0]))
+        except OSError as e:
+            error = e.args
+            CrawlStats.count('dns.failures')
+        CrawlStats.record('dns', time.perf_counter() - start)
+        ttl = cls.NEGATIVE_TTL if error or not addresses else cls.TTL
+        entry = (time.monotonic() + ttl, addresses, error)
+        with cls.__lock:
+            cls.__cache[host] = entry
+            cls.__cache.move_to_end(host)
+            while len(cls.__cache) > cls.MAX_ENTRIES:
+                cls.__cache.popitem(last=False)
+            cls.__pending.pop(host, None)
+        return entry
+
+    @classmethod
+    def __addresses(cls, entry):
+        addresses, error = entry[1], entry[2]
+        if error:
+            raise socket.gaierror(*error)
+        if not addresses:
+            raise socket.gaierror(socket.EAI_NONAME, 'No address found')
+        return addresses
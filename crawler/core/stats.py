@@ -0,0 +1,186 @@
+import json
+import math
+import threading
+import time
+
+
+class Histogram:
+    '''
+    Latency histogram over log-scale buckets: each power of two of
+    microseconds is split in SUB_BUCKETS buckets, so percentiles are
+    estimated within about 20%, in constant memory and time.
+    '''
+    SUB_BUCKETS = 4
+    BUCKET_COUNT = 128
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * Histogram.BUCKET_COUNT
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        micros = seconds * 1e6
+        index = 0
+        if micros > 1:
+            index = min(int(math.log2(micros) * Histogram.SUB_BUCKETS) + 1, Histogram.BUCKET_COUNT - 1)
+        self.buckets[index] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+
+    def percentile(self, p):
+        '''
+        Return the upper bound in seconds of the bucket holding the p-th
+        percentile.
+        '''
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(2 ** (i / Histogram.SUB_BUCKETS) / 1e6, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count' : self.count,
+            'total' : self.total,
+            'mean' : self.total / self.count if self.count else 0.0,
+            'p50' : self.percentile(50),
+            'p90' : self.percentile(90),
+            'p99' : self.percentile(99),
+            'max' : self.max,
+            'buckets' : {str(i) : n for i, n in enumerate(self.buckets) if n}
+        }
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        histogram = Histogram()
+        histogram.count = snapshot['count']
+        histogram.total = snapshot['total']
+        histogram.max = snapshot['max']
+        for i, n in snapshot['buckets'].items():
+            histogram.buckets[int(i)] = n
+        return histogram
+
+
+class CrawlStats:
+    '''
+    Process-wide crawl statistics: a latency histogram per stage (dns,
+    connect, ttfb, download, decode, parse, storage, process, loop.lag...)
+    and counters (pages, bytes...). Recording takes a lock and a few arithmetic
+    operations, and can be switched off by setting ENABLED to False.
+    A snapshot is a JSON-serializable dict, and snapshots of other
+    processes can be merged in.
+    '''
+    ENABLED = True
+    __histograms = {}
+    __counters = {}
+    __start_time = time.monotonic()
+    __lock = threading.Lock()
+
+    @classmethod
+    def record(cls, stage, seconds):
+        if not cls.ENABLED:
+            return
+        with cls.__lock:
+            histogram = cls.__histograms.get(stage)
+            if histogram is None:
+                histogram = Histogram()
+                cls.__histograms[stage] = histogram
+            histogram.record(seconds)
+
+    @classmethod
+    def count(cls, name, value=1):
+        if not cls.ENABLED:
+            return
+        with cls.__lock:
+            cls.__counters[name] = cls.__counters.get(name, 0) + value
+
+    @classmethod
+    def timer(cls, stage):
+        '''
+        Return a context manager recording the time spent in its block.
+        '''
+        return _Timer(stage)
+
+    @classmethod
+    def snapshot(cls):
+        with cls.__lock:
+            elapsed = time.monotonic() - cls.__start_time
+            counters = dict(cls.__counters)
+            stages = {stage : h.snapshot() for stage, h in cls.__histograms.items()}
+        rates = {}
+        if elapsed > 0:
+            rates['pages_per_sec'] = counters.get('pages', 0) / elapsed
+            rates['bytes_per_sec'] = counters.get('bytes', 0) / elapsed
+        for name, capacity in counters.items():
+            # busy time of the workers of a pipeline stage over their time
+            if name.endswith('.capacity') and capacity > 0:
+                stage = name[:-len('.capacity')]
+                rates[stage + '.utilization'] = counters.get(stage + '.busy', 0) / capacity
+        return {
+            'elapsed' : elapsed,
+            'counters' : counters,
+            'rates' : rates,
+            'stages' : stages
+        }
+
+    @classmethod
+    def merge(cls, snapshot):
+        '''
+        Add the counters and histograms of a snapshot, such as one taken
+        in a worker process.
+        '''
+        with cls.__lock:
+            for name, value in snapshot['counters'].items():
+                cls.__counters[name] = cls.__counters.get(name, 0) + value
+            for stage, stage_snapshot in snapshot['stages'].items():
+                histogram = cls.__histograms.get(stage)
+                if histogram is None:
+                    histogram = Histogram()
+                    cls.__histograms[stage] = histogram
+                histogram.merge(Histogram.from_snapshot(stage_snapshot))
+
+    @classmethod
+    def dump(cls, path=None):
+        '''
+        Write a snapshot as JSON to a file, or return it if path is None.
+        '''
+        text = json.dumps(cls.snapshot(), indent=2, sort_keys=True)
+        if path is None:
+            return text
+        with open(path, 'w') as f:
+            f.write(text)
+
+    @classmethod
+    def reset(cls):
+        with cls.__lock:
+            cls.__histograms = {}
+            cls.__counters = {}
+            cls.__start_time = time.monotonic()
+
+
+class _Timer:
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        CrawlStats.record(self.stage, time.perf_counter() - self.start)
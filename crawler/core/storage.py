@@ -1,220 +1,1242 @@
 from datetime import datetime
 import hashlib
+import lzma
 import sqlite3
+import struct
+import threading
+import time
+from urllib.parse import urlsplit
+import zlib
 
-from crawler.core.common import Storage
+from crawler.core.common import Storage, LoggerFactory
+from crawler.core.stats import CrawlStats
+from crawler.core.urls import UrlNormalizer
+from crawler.core.utils import ScalableBloomFilter
 
 
-class CrawlerStorage(Storage):
+_LOG = LoggerFactory.get_logger(__name__)
+
+
+class PageCodec:
+    '''
+    Codec of page content stored in the page table.
+    An encoded value is MAGIC, a codec byte and the compressed data. A
+    ZLIB_DICT value also carries the 4-byte id of a shared dictionary,
+    which is built from the first dict_sample_pages pages of a domain,
+    since pages of a site share most of their markup. Values without
+    MAGIC are stored raw, like rows written before compression.
+    Dictionary ids are derived from the dictionary data, so databases
+    written by different processes rarely clash when they are merged.
+    '''
+    MAGIC = b'\x00\xc7'
+    RAW = 0
+    ZLIB = 1
+    LZMA = 2
+    ZLIB_DICT = 3
+    MAX_DICT_SIZE = 32768
+    __dict_id = struct.Struct('<I')
+    __insert_dict_sql = '''
+        INSERT OR IGNORE INTO codec_dict(id, domain, data, create_time) VALUES (?, ?, ?, ?)
+    '''
+    __select_domain_dict_sql = '''
+        SELECT id, data FROM codec_dict WHERE domain = ? ORDER BY create_time LIMIT 1
+    '''
+    __select_dict_sql = '''
+        SELECT data FROM codec_dict WHERE id = ?
+    '''
+    
+    def __init__(self, codec=ZLIB, level=6, dict_sample_pages=8):
+        if codec not in (PageCodec.RAW, PageCodec.ZLIB, PageCodec.LZMA):
+            raise ValueError('Unsupported page codec: ' + str(codec))
+        self._codec = codec
+        self._level = level
+        self._dict_sample_pages = dict_sample_pages
+        self.__dicts = {}
+        self.__domain_dicts = {}
+        self.__samples = {}
+        self.__lock = threading.Lock()
+        
+    def encode(self, content, url=None):
+        if not content or not isinstance(content, bytes) or self._codec == PageCodec.RAW:
+            return content
+        if self._codec == PageCodec.LZMA:
+            header = PageCodec.MAGIC + bytes([PageCodec.LZMA])
+            data = lzma.compress(content, preset=min(self._level, 9))
+        else:
+            dict_id, zdict = self.__get_domain_dict(url, content)
+            if zdict:
+                header = PageCodec.dict_header(dict_id)
+                compressor = zlib.compressobj(self._level, zdict=zdict)
+            else:
+                header = PageCodec.MAGIC + bytes([PageCodec.ZLIB])
+                compressor = zlib.compressobj(self._level)
+            data = compressor.compress(content) + compressor.flush()
+        if len(header) + len(data) >= len(content) + 3:
+            # not worth compressing
+            return PageCodec.MAGIC + bytes([PageCodec.RAW]) + content
+        return header + data
+    
+    def decode(self, value):
+        if not value or not isinstance(value, bytes) or not value.startswith(PageCodec.MAGIC):
+            return value
+        codec = value[2]
+        if codec == PageCodec.RAW:
+            return value[3:]
+        elif codec == PageCodec.ZLIB:
+            return zlib.decompress(value[3:])
+        elif codec == PageCodec.LZMA:
+            return lzma.decompress(value[3:])
+        elif codec == PageCodec.ZLIB_DICT:
+            dict_id = PageCodec.__dict_id.unpack_from(value, 3)[0]
+            decompressor = zlib.decompressobj(zdict=self.__get_dict(dict_id))
+            return decompressor.decompress(value[7:]) + decompressor.flush()
+        raise ValueError('Unknown page codec: ' + str(codec))
+    
+    def iter_decode(self, stream, chunk_size=65536):
+        '''
+        Yield the decoded content of a value read from a binary stream,
+        such as a SQLite blob, in chunks of at most chunk_size bytes, so
+        a highly compressed value is never inflated at once.
+        '''
+        data = stream.read(7)
+        if not data.startswith(PageCodec.MAGIC):
+            decompressor = None
+        elif data[2] == PageCodec.RAW:
+            decompressor = None
+            data = data[3:]
+        elif data[2] == PageCodec.ZLIB:
+            decompressor = zlib.decompressobj()
+            data = data[3:]
+        elif data[2] == PageCodec.LZMA:
+            decompressor = lzma.LZMADecompressor()
+            data = data[3:]
+        elif data[2] == PageCodec.ZLIB_DICT:
+            dict_id = PageCodec.__dict_id.unpack_from(data, 3)[0]
+            decompressor = zlib.decompressobj(zdict=self.__get_dict(dict_id))
+            data = b''
+        else:
+            raise ValueError('Unknown page codec: ' + str(data[2]))
+        while True:
+            if data:
+                if decompressor:
+                    yield from PageCodec.__iter_decompress(decompressor, data, chunk_size)
+                else:
+                    yield data
+            data = stream.read(chunk_size)
+            if not data:
+                break
+        if hasattr(decompressor, 'flush'):
+            # zlib only, lzma keeps no pending output
+            yield decompressor.flush()
+    
+    @staticmethod
+    def __iter_decompress(decompressor, data, chunk_size):
+        # input left over by a bounded call is the unconsumed tail of
+        # zlib, and kept inside lzma until it needs input again
+        if isinstance(decompressor, lzma.LZMADecompressor):
+            chunk = decompressor.decompress(data, chunk_size)
+            while True:
+                if chunk:
+                    yield chunk
+                if decompressor.needs_input or decompressor.eof:
+                    return
+                chunk = decompressor.decompress(b'', chunk_size)
+        chunk = decompressor.decompress(data, chunk_size)
+        while chunk:
+            yield chunk
+            chunk = decompressor.decompress(decompressor.unconsumed_tail, chunk_size)
+    
+    @classmethod
+    def dict_header(cls, dict_id):
+        '''
+        Return the leading bytes of values compressed with a dictionary.
+        '''
+        return cls.MAGIC + bytes([cls.ZLIB_DICT]) + cls.__dict_id.pack(dict_id)
+    
+    @classmethod
+    def new_dict_id(cls, zdict):
+        '''
+        Return a free dictionary id for the data: the first 4 bytes of its
+        md5 digest, probed linearly past the ids taken by other data.
+        '''
+        dict_id = cls.__dict_id.unpack_from(hashlib.md5(zdict).digest())[0]
+        while True:
+            result = SQLite.execute_query_sql(PageCodec.__select_dict_sql, (dict_id, ))
+            if not result or result[0][0] == zdict:
+                return dict_id
+            dict_id = (dict_id + 1) & 0xffffffff
     
+    def __get_dict(self, dict_id):
+        zdict = self.__dicts.get(dict_id)
+        if zdict is None:
+            result = SQLite.execute_query_sql(PageCodec.__select_dict_sql, (dict_id, ))
+            if not result:
+                raise ValueError('Missing codec dictionary: id = ' + str(dict_id))
+            zdict = result[0][0]
+            self.__dicts[dict_id] = zdict
+        return zdict
+    
+    def __get_domain_dict(self, url, content):
+        # return the (id, data) of the domain dictionary, and collect the
+        # content as a sample while the dictionary is not built yet
+        if not url or self._dict_sample_pages <= 0:
+            return None, None
+        domain = urlsplit(url).netloc
+        with self.__lock:
+            if domain not in self.__domain_dicts:
+                result = SQLite.execute_query_sql(PageCodec.__select_domain_dict_sql, (domain, ))
+                self.__domain_dicts[domain] = tuple(result[0]) if result else (None, None)
+            dict_id, zdict = self.__domain_dicts[domain]
+            if zdict:
+                return dict_id, zdict
+            samples = self.__samples.setdefault(domain, [])
+            samples.append(content[:PageCodec.MAX_DICT_SIZE // self._dict_sample_pages])
+            if len(samples) >= self._dict_sample_pages:
+                del self.__samples[domain]
+                self.__domain_dicts[domain] = self.__build_dict(domain, samples)
+        return None, None
+    
+    def __build_dict(self, domain, samples):
+        # page heads hold the markup shared by a site; zlib prefers matches
+        # near the end of a dictionary, so the latest sample goes last
+        zdict = b''.join(samples)[-PageCodec.MAX_DICT_SIZE:]
+        create_time = datetime.now().strftime("%y-%m-%d %H:%M:%S")
+        dict_id = PageCodec.new_dict_id(zdict)
+        SQLite.execute_dml_sql(PageCodec.__insert_dict_sql, (dict_id, domain, zdict, create_time))
+        result = SQLite.execute_query_sql(PageCodec.__select_dict_sql, (dict_id, ))
+        if not result or result[0][0] != zdict:
+            return None, None
+        self.__dicts[dict_id] = zdict
+        return dict_id, zdict
+    
+    
+class PageRecord(tuple):
+    '''
+    A row of the page table, whose content is decompressed by the codec
+    each time it is read through indexing, iteration or the content
+    property. A row of projected columns has its content at
+    content_index.
+    '''
+    CONTENT_INDEX = 6
+    
+    def __new__(cls, row, codec, content_index=CONTENT_INDEX):
+        record = super(PageRecord, cls).__new__(cls, row)
+        record._codec = codec
+        record._content_index = content_index
+        return record
+    
+    @property
+    def content(self):
+        return self._codec.decode(tuple.__getitem__(self, self._content_index))
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self)[index]
+        if index in (self._content_index, self._content_index - len(self)):
+            return self.content
+        return tuple.__getitem__(self, index)
+    
+    def __iter__(self):
+        for i, value in enumerate(tuple.__iter__(self)):
+            if i == self._content_index:
+                yield self.content
+            else:
+                yield value
+    
+    def __repr__(self):
+        return repr(tuple(self))
+    
+
+class CrawlerStorage(Storage):
+    '''
+    SQLite based crawler storage. Seen url checks go through an in-memory
+    Bloom filter first, which is pre-warmed from the url table and saved
+    next to the database file on close.
+    Page and url rows are written behind: they are buffered and flushed
+    in a single transaction when flush_size rows are pending, or when a
+    save happens flush_interval seconds after the last flush. Pending
+    rows are always flushed by close().
+    A storage object can be shared by threads, each of which reads
+    through its own SQLite connection.
+    Page content is compressed by a PageCodec before it is buffered, and
+    decompressed only when the content of a queried PageRecord is read.
+    A page crawled with status 200 is crawled again once it is older than
+    recrawl_interval seconds (never if it is not positive).
+    Content fingerprints are indexed by exact digest and by each SimHash
+    band, so duplicate lookups are a few indexed queries.
+    Rows are keyed by the url id, a 64-bit hash of the url, and the url
+    text is only stored in the url table.
+    Redirected urls map to the url they end up at. A temporary redirect
+    is followed again once it is older than recrawl_interval seconds.
+    A page dropped as a duplicate maps to the page it duplicates, and is
+    crawled again once the mapping is older than recrawl_interval
+    seconds, unless its own page row is newer.
+    Pages and urls are also streamed batch by batch, and page content
+    is read incrementally from its blob, for jobs going through a whole
+    database in constant memory.
+    The database file is db, or the current SQLite database if None.
+    '''
+    FILTER_SUFFIX = '.bloom'
+    PERMANENT_REDIRECT_CODES = frozenset([301, 308])
+    PAGE_COLUMNS = ('id', 'url', 'status_code', 'charset', 'etag', 'last_modified',
+                    'content', 'create_time', 'update_time')
+    BATCH_SIZE = 1000
+    __page_column_sql = {
+        'id' : 'page.id', 'url' : 'url.url', 'status_code' : 'status_code',
+        'charset' : 'charset', 'etag' : 'etag', 'last_modified' : 'last_modified',
+        'content' : 'content', 'create_time' : 'page.create_time', 'update_time' : 'page.update_time'
+    }
     __charset = 'UTF-8'
-    __insert_page_sql = '''
+    __time_format = '%y-%m-%d %H:%M:%S'
+    __uint64_mask = (1 << 64) - 1
+    __url_id = struct.Struct('>q')
+    __filter_batch_size = 10000
+    __upsert_page_sql = '''
         INSERT INTO page(
-        id, url, status_code, charset, etag, last_modified, content, create_time, update_time
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    '''
-    __update_page_sql = '''
-        UPDATE page SET
-        content = ?, status_code = ?, charset = ?, etag = ?, 
-        last_modified = ?, update_time = ? 
-        WHERE id = ?
+        id, status_code, charset, etag, last_modified, content, create_time, update_time
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+        status_code = excluded.status_code, charset = excluded.charset, etag = excluded.etag,
+        last_modified = excluded.last_modified, content = excluded.content,
+        update_time = excluded.update_time
     '''
     __insert_url_sql = '''
-        INSERT INTO url(md5, url, create_time, update_time) VALUES (?, ?, ?, ?)
+        INSERT OR IGNORE INTO url(id, url, create_time, update_time) VALUES (?, ?, ?, ?)
+    '''
+    __upsert_fingerprint_sql = '''
+        INSERT INTO fingerprint(id, exact, simhash, band0, band1, band2, band3)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+        exact = excluded.exact, simhash = excluded.simhash, band0 = excluded.band0,
+        band1 = excluded.band1, band2 = excluded.band2, band3 = excluded.band3
+    '''
+    __select_exact_fingerprint_sql = '''
+        SELECT url.url FROM fingerprint JOIN url ON url.id = fingerprint.id
+        WHERE exact = ? AND fingerprint.id != ? LIMIT 1
+    '''
+    __select_band_fingerprint_sql = '''
+        SELECT url.url, simhash FROM fingerprint JOIN url ON url.id = fingerprint.id
+        WHERE fingerprint.id IN (
+        SELECT id FROM fingerprint WHERE band0 = ? AND id != ?
+        UNION SELECT id FROM fingerprint WHERE band1 = ? AND id != ?
+        UNION SELECT id FROM fingerprint WHERE band2 = ? AND id != ?
+        UNION SELECT id FROM fingerprint WHERE band3 = ? AND id != ?)
+    '''
+    __upsert_redirect_sql = '''
+        INSERT OR REPLACE INTO redirect(id, target_id, status_code, create_time) VALUES (?, ?, ?, ?)
+    '''
+    __select_redirect_sql = '''
+        SELECT url.url, status_code, redirect.create_time
+        FROM redirect JOIN url ON url.id = redirect.target_id WHERE redirect.id = ?
+    '''
+    __upsert_duplicate_sql = '''
+        INSERT OR REPLACE INTO duplicate(id, original_id, create_time) VALUES (?, ?, ?)
+    '''
+    __select_duplicate_sql = '''
+        SELECT url.url, duplicate.create_time
+        FROM duplicate JOIN url ON url.id = duplicate.original_id WHERE duplicate.id = ?
+    '''
+    __touch_page_sql = '''
+        UPDATE page SET update_time = ? WHERE id = ?
     '''
     __select_page_sql = '''
-        SELECT * FROM page WHERE id = ?
+        SELECT page.id, url.url, status_code, charset, etag, last_modified, content,
+        page.create_time, page.update_time
+        FROM page LEFT JOIN url ON url.id = page.id WHERE page.id = ?
+    '''
+    __select_page_status_sql = '''
+        SELECT status_code, etag, last_modified, update_time FROM page WHERE id = ?
     '''
     __select_all_page_sql = '''
-        SELECT * FROM page
+        SELECT {columns} FROM page
+    '''
+    __select_all_page_url_sql = '''
+        SELECT {columns} FROM page LEFT JOIN url ON url.id = page.id
     '''
     __select_url_sql = '''
-        SELECT * FROM url WHERE md5 = ?
+        SELECT 1 FROM url WHERE id = ?
     '''
     __select_all_url_sql = '''
         SELECT * FROM url
     '''
+    __select_first_url_id_sql = '''
+        SELECT id FROM {schema}.url ORDER BY id LIMIT ?
+    '''
+    __select_url_id_sql = '''
+        SELECT id FROM {schema}.url WHERE id > ? ORDER BY id LIMIT ?
+    '''
+    __merge_schema = 'shard'
+    __select_merge_dict_sql = '''
+        SELECT id, domain, data, create_time FROM shard.codec_dict
+    '''
+    __select_dict_sql = '''
+        SELECT data FROM main.codec_dict WHERE id = ?
+    '''
+    __insert_dict_sql = '''
+        INSERT OR IGNORE INTO main.codec_dict(id, domain, data, create_time) VALUES (?, ?, ?, ?)
+    '''
+    __remap_dict_sql = '''
+        UPDATE shard.page SET content = CAST(? || substr(content, ?) AS BLOB)
+        WHERE substr(content, 1, ?) = ?
+    '''
+    __merge_url_sql = '''
+        INSERT OR IGNORE INTO main.url SELECT * FROM shard.url
+    '''
+    __merge_page_sql = '''
+        INSERT INTO main.page(
+        id, status_code, charset, etag, last_modified, create_time, update_time, content)
+        SELECT id, status_code, charset, etag, last_modified, create_time, update_time, content
+        FROM shard.page WHERE true
+        ON CONFLICT(id) DO UPDATE SET
+        status_code = excluded.status_code, charset = excluded.charset, etag = excluded.etag,
+        last_modified = excluded.last_modified, content = excluded.content,
+        update_time = excluded.update_time
+    '''
+    __merge_fingerprint_sql = '''
+        INSERT OR REPLACE INTO main.fingerprint SELECT * FROM shard.fingerprint
+    '''
+    __merge_redirect_sql = '''
+        INSERT OR REPLACE INTO main.redirect SELECT * FROM shard.redirect
+    '''
+    __merge_duplicate_sql = '''
+        INSERT OR REPLACE INTO main.duplicate SELECT * FROM shard.duplicate
+    '''
+    __copy_schema = 'origin'
+    __copy_sqls = [
+        'INSERT OR IGNORE INTO main.codec_dict SELECT * FROM origin.codec_dict',
+        'INSERT OR IGNORE INTO main.url SELECT * FROM origin.url WHERE on_domains(url)',
+        '''INSERT OR IGNORE INTO main.page(
+        id, status_code, charset, etag, last_modified, create_time, update_time, content)
+        SELECT id, status_code, charset, etag, last_modified, create_time, update_time, content
+        FROM origin.page WHERE id IN (SELECT id FROM main.url)''',
+        '''INSERT OR IGNORE INTO main.fingerprint SELECT * FROM origin.fingerprint
+        WHERE id IN (SELECT id FROM main.url)''',
+        '''INSERT OR IGNORE INTO main.redirect SELECT * FROM origin.redirect
+        WHERE id IN (SELECT id FROM main.url)''',
+        '''INSERT OR IGNORE INTO main.duplicate SELECT * FROM origin.duplicate
+        WHERE id IN (SELECT id FROM main.url)''',
+        # redirect targets and duplicated pages may be on other domains
+        '''INSERT OR IGNORE INTO main.url SELECT * FROM origin.url WHERE id IN (
+        SELECT target_id FROM main.redirect UNION SELECT original_id FROM main.duplicate)'''
+    ]
+    __count_url_sql = '''
+        SELECT count(*) FROM url
+    '''
+    
+    def __init__(self, flush_size=100, flush_interval=5, pragmas=None,
+                 codec=PageCodec.ZLIB, compress_level=6, dict_sample_pages=8,
+                 recrawl_interval=-1, db=None):
+        self.__url_filter = None
+        self._db = db
+        self._pragmas = pragmas
+        self._codec = PageCodec(codec, compress_level, dict_sample_pages)
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        self.__pending_pages = {}
+        self.__pending_urls = {}
+        self.__pending_touches = {}
+        self.__pending_fingerprints = {}
+        self.__pending_redirects = {}
+        self.__pending_duplicates = {}
+        self.__last_flush_time = time.monotonic()
+        self.__flush_failed = False
+        self.__lock = threading.RLock()
+        self.recrawl_interval = recrawl_interval
     
     def initialize(self):
-        SQLite.connect()
+        if self._pragmas:
+            SQLite.configure(**self._pragmas)
+        SQLite.connect(self._db)
         SQLite.create_crawler_tables()
+        self.__load_url_filter()
+        
+    def __load_url_filter(self):
+        # reuse the saved filter only if no url was added after saving it
+        path = SQLite.get_db() + CrawlerStorage.FILTER_SUFFIX
+        url_count = self.__count_urls()
+        url_filter, tag = ScalableBloomFilter.load(path)
+        if not url_filter or tag != url_count:
+            url_filter = ScalableBloomFilter()
+            self.__fill_url_filter(url_filter, 'main')
+        self.__url_filter = url_filter
+    
+    def __fill_url_filter(self, url_filter, schema):
+        # add the urls of a database schema, paged by id
+        batch_size = CrawlerStorage.__filter_batch_size
+        sql = CrawlerStorage.__select_first_url_id_sql.format(schema=schema)
+        value = (batch_size, )
+        while True:
+            result = SQLite.execute_query_sql(sql, value)
+            if not result:
+                break
+            for row in result:
+                url_filter.add(self.__filter_key(row[0]))
+            sql = CrawlerStorage.__select_url_id_sql.format(schema=schema)
+            value = (result[-1][0], batch_size)
+        
+    def __save_url_filter(self):
+        if self.__url_filter is not None:
+            path = SQLite.get_db() + CrawlerStorage.FILTER_SUFFIX
+            try:
+                self.__url_filter.save(path, self.__count_urls())
+            except OSError as e:
+                _LOG.warning('Fail to save url filter: %s, %s', path, e)
+            
+    def __count_urls(self):
+        result = SQLite.execute_query_sql(CrawlerStorage.__count_url_sql)
+        if result:
+            return result[0][0]
+        return 0
     
     def query_page(self, url):
-        md5 = self.__md5(url)
-        value = (md5, )
-        result = SQLite.execute_query_sql(CrawlerStorage.__select_page_sql, value)
-        return result
+        url_id = self.url_id(url)
+        if url_id in self.__pending_pages or url_id in self.__pending_touches:
+            self.flush()
+        value = (url_id, )
+        with CrawlStats.timer('storage.query'):
+            result = SQLite.execute_query_sql(CrawlerStorage.__select_page_sql, value)
+        return self.__to_page_records(result)
     
     def query_all_pages(self):
-        return SQLite.execute_query_sql(CrawlerStorage.__select_all_page_sql)
+        return list(self.iterate_pages())
+    
+    def __to_page_records(self, result):
+        if result is None:
+            return None
+        return [PageRecord(row, self._codec) for row in result]
     
     def query_all_urls(self):
-        return SQLite.execute_query_sql(CrawlerStorage.__select_all_url_sql)
+        return list(self.iterate_urls())
+    
+    def iterate_pages(self, columns=None, batch_size=BATCH_SIZE):
+        '''
+        Yield the page rows fetched batch_size rows at a time, as
+        PageRecords of the columns, PAGE_COLUMNS by default. Rows of
+        columns without content are plain tuples, so a job can leave the
+        content out and read it with iter_content only when needed.
+        '''
+        columns = tuple(columns or CrawlerStorage.PAGE_COLUMNS)
+        for column in columns:
+            if column not in CrawlerStorage.__page_column_sql:
+                raise ValueError('Unknown page column: ' + str(column))
+        column_sql = ', '.join(CrawlerStorage.__page_column_sql[column] for column in columns)
+        # the url text is only joined if it is asked for
+        sql = CrawlerStorage.__select_all_page_url_sql if 'url' in columns else CrawlerStorage.__select_all_page_sql
+        self.flush()
+        rows = SQLite.iterate_query_sql(sql.format(columns=column_sql), batch_size=batch_size)
+        if 'content' not in columns:
+            yield from rows
+            return
+        content_index = columns.index('content')
+        for row in rows:
+            yield PageRecord(row, self._codec, content_index)
+    
+    def iterate_urls(self, batch_size=BATCH_SIZE):
+        '''
+        Yield the url rows fetched batch_size rows at a time.
+        '''
+        self.flush()
+        yield from SQLite.iterate_query_sql(CrawlerStorage.__select_all_url_sql, batch_size=batch_size)
+    
+    def iter_content(self, url, chunk_size=65536):
+        '''
+        Yield the decoded content of the page of a url chunk by chunk,
+        read through incremental blob I/O instead of loading the blob.
+        Nothing is yielded if there is no such page or content.
+        '''
+        url_id = self.url_id(url)
+        if url_id in self.__pending_pages:
+            self.flush()
+        blob = SQLite.open_blob('page', 'content', url_id)
+        if blob is None:
+            return
+        with blob:
+            CrawlStats.count('storage.blob_reads')
+            yield from self._codec.iter_decode(blob, chunk_size)
     
     def save_page(self, **page_data):
         url = page_data.get('url', None)
         if url:
-            pk = self.__md5(url)
-            # binary data
-            content = page_data.get('content', '')
+            url_id = self.url_id(url)
+            # binary data, compressed
+            with CrawlStats.timer('storage.encode'):
+                content = self._codec.encode(page_data.get('content', ''), url)
             status_code = page_data.get('status_code', 0)
             charset = page_data.get('charset', '')
             etag = page_data.get('etag', '')
             last_modified = page_data.get('last_modified', '')
             create_time = self.__now_datetime()
             update_time = create_time
-            if not self.__is_need_update(url):
-                sql = CrawlerStorage.__insert_page_sql
-                value = (pk, url, content, status_code, charset, etag, last_modified, create_time, update_time)
-                print('INSERT page values: ' + str(value))
-            else:
-                sql = CrawlerStorage.__update_page_sql
-                value = (content, status_code, charset, etag, last_modified, update_time, pk)
-                print('UPDATE page values: url= ' + url + ', ' + str(value))
-            SQLite.execute_dml_sql(sql, value)
-    
-    def __is_need_update(self, url):
-        is_needed = False
-        result = self.query_page(url)
-        status_code = 0
-        if not result:
-            is_needed = False
-        elif len(result) <= 0:
-            is_needed = False
-        else:
-            status_code = result[0][3]
-            if status_code != 200:
-                is_needed = True
-        return is_needed
+            # an existing row keeps its create_time on upsert
+            value = (url_id, status_code, charset, etag, last_modified, content, create_time, update_time)
+            _LOG.debug('UPSERT page: url = %s, status_code = %s, content_size = %d', url, status_code, len(content))
+            with self.__lock:
+                # the url text of the page is in the url table
+                self.__save_url(url_id, url)
+                self.__pending_pages[url_id] = value
+                self.__flush_if_needed()
         
     def save_url(self, **url_data):
         url = url_data.get('url')
-        if url and not self.is_crawled(url):
-            md5 = self.__md5(url)
+        if not url:
+            return
+        with self.__lock:
+            self.__save_url(self.url_id(url), url)
+            self.__flush_if_needed()
+    
+    def __save_url(self, url_id, url):
+        if not self.__is_crawled(url_id):
             create_time = self.__now_datetime()
             update_time = create_time
-            sql = CrawlerStorage.__insert_url_sql
-            value = (md5, url, create_time, update_time)
-            print('INSERT url values: ' + str(value))
-            SQLite.execute_dml_sql(sql, value)
+            value = (url_id, url, create_time, update_time)
+            _LOG.debug('INSERT url: url = %s', url)
+            self.__pending_urls[url_id] = value
+            if self.__url_filter is not None:
+                self.__url_filter.add(self.__filter_key(url_id))
+            
+    def flush(self):
+        '''
+        Write all pending page and url rows in one transaction. Return
+        False if the transaction failed, in which case the rows stay
+        pending for the next flush.
+        '''
+        with self.__lock:
+            if not self.__count_pending():
+                return True
+            batch = [
+                (CrawlerStorage.__insert_url_sql, list(self.__pending_urls.values())),
+                (CrawlerStorage.__upsert_page_sql, list(self.__pending_pages.values())),
+                (CrawlerStorage.__touch_page_sql, [(t, url_id) for url_id, t in self.__pending_touches.items()]),
+                (CrawlerStorage.__upsert_fingerprint_sql, [v for _, v in self.__pending_fingerprints.values()]),
+                (CrawlerStorage.__upsert_redirect_sql, [v for _, v in self.__pending_redirects.values()]),
+                (CrawlerStorage.__upsert_duplicate_sql, [v for _, v in self.__pending_duplicates.values()])
+            ]
+            # rows stay visible to readers until they are committed
+            with CrawlStats.timer('storage.flush'):
+                flushed = SQLite.execute_batch_dml_sql(batch)
+            self.__last_flush_time = time.monotonic()
+            self.__flush_failed = not flushed
+            if not flushed:
+                CrawlStats.count('storage.flush_errors')
+                _LOG.warning('Fail to flush, rows kept pending: %d', self.__count_pending())
+                return False
+            CrawlStats.count('storage.rows', self.__count_pending())
+            self.__pending_urls = {}
+            self.__pending_pages = {}
+            self.__pending_touches = {}
+            self.__pending_fingerprints = {}
+            self.__pending_redirects = {}
+            self.__pending_duplicates = {}
+            return True
+            
+    def __count_pending(self):
+        return (len(self.__pending_pages) + len(self.__pending_urls) + len(self.__pending_touches)
+                + len(self.__pending_fingerprints) + len(self.__pending_redirects)
+                + len(self.__pending_duplicates))
+    
+    def __flush_if_needed(self):
+        pending_count = self.__count_pending()
+        # after a failed flush, retry once flush_interval has passed
+        if pending_count >= self._flush_size and not self.__flush_failed:
+            self.flush()
+        elif time.monotonic() - self.__last_flush_time >= self._flush_interval:
+            self.flush()
         
     def __now_datetime(self):
         #http://docs.python.org/3/library/datetime.html
         now = datetime.now()
-        str_date = now.strftime("%y-%m-%d %H:%M:%S")
+        str_date = now.strftime(CrawlerStorage.__time_format)
         return str_date
         
         
-    def __md5(self, url):
-        md5 = None
-        if url:
-            md5 = hashlib.md5(url.encode(CrawlerStorage.__charset)).hexdigest()
-        return md5
+    @classmethod
+    def url_id(cls, url):
+        '''
+        Return the id of a url: the first 8 bytes of its md5 digest, as
+        a signed 64-bit integer, since SQLite integers are signed.
+        '''
+        digest = hashlib.md5(url.encode(CrawlerStorage.__charset)).digest()
+        return cls.__url_id.unpack_from(digest)[0]
+    
+    @classmethod
+    def __filter_key(cls, url_id):
+        # the Bloom filter takes 128-bit digests
+        return hashlib.md5(cls.__url_id.pack(url_id)).digest()
     
     def should_crawl(self, url):
         should = False
-        md5 = self.__md5(url)
-        value = (md5, )
-        result = SQLite.execute_query_sql(CrawlerStorage.__select_page_sql, value)
+        status = self.__query_page_status(url)
         status_code = 0
-        if len(result) != 0:
-            status_code = result[0][3]
+        if status:
+            status_code = status[0]
         if status_code != 200:
             should = True
+        else:
+            should = self.__is_due(status[3])
+        if should:
+            # a duplicate is not downloaded again until it is due
+            duplicate = self.__query_duplicate(url)
+            if duplicate and (not status or duplicate[1] >= status[3]):
+                should = self.__is_due(duplicate[1])
         return should
     
+    def __is_due(self, time_str):
+        # whether a row of a time is older than the recrawl interval
+        if not self.recrawl_interval or self.recrawl_interval <= 0:
+            return False
+        row_time = datetime.strptime(time_str, CrawlerStorage.__time_format)
+        return (datetime.now() - row_time).total_seconds() >= self.recrawl_interval
+    
+    def find_duplicate_of(self, url):
+        '''
+        Return the url of the page a url was dropped as a duplicate of,
+        or None.
+        '''
+        duplicate = self.__query_duplicate(url)
+        if duplicate:
+            return duplicate[0]
+        return None
+    
+    def save_duplicate(self, url, original_url):
+        '''
+        Record that the page of a url duplicates the page of another one.
+        '''
+        url_id = self.url_id(url)
+        original_id = self.url_id(original_url)
+        value = (url_id, original_id, self.__now_datetime())
+        _LOG.debug('INSERT duplicate: url = %s, original_url = %s', url, original_url)
+        with self.__lock:
+            self.__save_url(url_id, url)
+            self.__save_url(original_id, original_url)
+            self.__pending_duplicates[url_id] = (original_url, value)
+            self.__flush_if_needed()
+    
+    def __query_duplicate(self, url):
+        # (original_url, create_time) of a duplicate, or None
+        url_id = self.url_id(url)
+        if not self.__is_crawled(url_id):
+            return None
+        with self.__lock:
+            pending = self.__pending_duplicates.get(url_id)
+        if pending:
+            return pending[0], pending[1][2]
+        result = SQLite.execute_query_sql(CrawlerStorage.__select_duplicate_sql, (url_id, ))
+        if not result:
+            return None
+        return tuple(result[0])
+    
+    def find_redirect(self, url):
+        '''
+        Return the url a url redirects to, or None.
+        '''
+        url_id = self.url_id(url)
+        # redirected urls are saved as urls
+        if not self.__is_crawled(url_id):
+            return None
+        with self.__lock:
+            pending = self.__pending_redirects.get(url_id)
+        if pending:
+            return pending[0]
+        result = SQLite.execute_query_sql(CrawlerStorage.__select_redirect_sql, (url_id, ))
+        if not result:
+            return None
+        target_url, status_code, create_time = result[0]
+        if status_code not in CrawlerStorage.PERMANENT_REDIRECT_CODES and \
+                self.recrawl_interval and self.recrawl_interval > 0:
+            create_time = datetime.strptime(create_time, CrawlerStorage.__time_format)
+            if (datetime.now() - create_time).total_seconds() >= self.recrawl_interval:
+                return None
+        return target_url
+    
+    def save_redirects(self, redirects, target_url):
+        '''
+        Map the (url, status_code) hops of a fetch to the url fetched
+        last. A url redirects for good only if every hop from it does.
+        '''
+        target_id = self.url_id(target_url)
+        create_time = self.__now_datetime()
+        status_code = None
+        with self.__lock:
+            self.__save_url(target_id, target_url)
+            for url, hop_status_code in reversed(redirects):
+                if status_code is None or status_code in CrawlerStorage.PERMANENT_REDIRECT_CODES:
+                    status_code = hop_status_code
+                url_id = self.url_id(url)
+                _LOG.debug('INSERT redirect: url = %s, target_url = %s, status_code = %s',
+                           url, target_url, status_code)
+                self.__save_url(url_id, url)
+                self.__pending_redirects[url_id] = (target_url, (url_id, target_id, status_code, create_time))
+            self.__flush_if_needed()
+    
+    def query_validators(self, url):
+        if not self.is_crawled(url):
+            return None
+        status = self.__query_page_status(url)
+        if not status or status[0] != 200:
+            return None
+        etag, last_modified = status[1], status[2]
+        if not etag and not last_modified:
+            return None
+        return etag, last_modified
+    
+    def touch_page(self, url):
+        url_id = self.url_id(url)
+        update_time = self.__now_datetime()
+        with self.__lock:
+            pending = self.__pending_pages.get(url_id)
+            if pending:
+                self.__pending_pages[url_id] = pending[:7] + (update_time, )
+            else:
+                self.__pending_touches[url_id] = update_time
+            self.__flush_if_needed()
+    
+    def find_duplicate(self, url, fingerprint):
+        with CrawlStats.timer('storage.dedup'):
+            return self.__find_duplicate(url, fingerprint)
+    
+    def __find_duplicate(self, url, fingerprint):
+        url_id = self.url_id(url)
+        bands = fingerprint.bands()
+        with self.__lock:
+            pending = list(self.__pending_fingerprints.values())
+        for other_url, row in pending:
+            if row[0] != url_id and (row[1] == fingerprint.exact or fingerprint.is_near(row[2] & CrawlerStorage.__uint64_mask)):
+                return other_url
+        result = SQLite.execute_query_sql(CrawlerStorage.__select_exact_fingerprint_sql, (fingerprint.exact, url_id))
+        if result:
+            return result[0][0]
+        value = []
+        for band in bands:
+            value.extend((band, url_id))
+        result = SQLite.execute_query_sql(CrawlerStorage.__select_band_fingerprint_sql, value)
+        for other_url, simhash in result or ():
+            if fingerprint.is_near(simhash & CrawlerStorage.__uint64_mask):
+                return other_url
+        return None
+    
+    def save_fingerprint(self, url, fingerprint):
+        url_id = self.url_id(url)
+        simhash = fingerprint.simhash
+        # SQLite integers are signed 64-bit
+        if simhash >= 1 << 63:
+            simhash -= 1 << 64
+        value = (url_id, fingerprint.exact, simhash) + tuple(fingerprint.bands())
+        with self.__lock:
+            # duplicates are reported by url, which is in the url table
+            self.__save_url(url_id, url)
+            self.__pending_fingerprints[url_id] = (url, value)
+            self.__flush_if_needed()
+    
+    def __query_page_status(self, url):
+        # (status_code, etag, last_modified, update_time) of a page, or None
+        url_id = self.url_id(url)
+        with self.__lock:
+            pending = self.__pending_pages.get(url_id)
+            touched_time = self.__pending_touches.get(url_id)
+        if pending:
+            return (pending[1], pending[3], pending[4], pending[7])
+        result = SQLite.execute_query_sql(CrawlerStorage.__select_page_status_sql, (url_id, ))
+        if not result:
+            return None
+        status = tuple(result[0])
+        if touched_time:
+            status = status[:3] + (touched_time, )
+        return status
+    
     def is_crawled(self, url):
-        md5 = self.__md5(url)
-        value = (md5, )
+        return self.__is_crawled(self.url_id(url))
+    
+    def __is_crawled(self, url_id):
+        if self.__url_filter is not None and self.__filter_key(url_id) not in self.__url_filter:
+            # definitely not seen
+            return False
+        if url_id in self.__pending_urls:
+            return True
+        value = (url_id, )
         result = SQLite.execute_query_sql(CrawlerStorage.__select_url_sql, value)
         return len(result) != 0
     
+    def merge(self, db):
+        '''
+        Merge the url, page and fingerprint rows of another crawler
+        database, such as a shard written by a worker process, in one
+        transaction. Pages of the other database replace stored ones.
+        Its codec dictionaries are copied, and a dictionary whose id is
+        taken by other data gets a new id, rewritten in its pages first.
+        '''
+        self.flush()
+        with self.__lock:
+            if not SQLite.attach(db, CrawlerStorage.__merge_schema):
+                return False
+            try:
+                batch = self.__merge_dicts()
+                batch.extend([
+                    (CrawlerStorage.__merge_url_sql, [()]),
+                    (CrawlerStorage.__merge_page_sql, [()]),
+                    (CrawlerStorage.__merge_fingerprint_sql, [()]),
+                    (CrawlerStorage.__merge_redirect_sql, [()]),
+                    (CrawlerStorage.__merge_duplicate_sql, [()])
+                ])
+                merged = SQLite.execute_batch_dml_sql(batch)
+                if merged and self.__url_filter is not None:
+                    self.__fill_url_filter(self.__url_filter, CrawlerStorage.__merge_schema)
+            finally:
+                SQLite.detach(CrawlerStorage.__merge_schema)
+        return merged
+    
+    def copy_from(self, db, domains):
+        '''
+        Copy the rows of the urls on some domains or their sub-domains
+        from another crawler database, in one transaction, so a shard
+        written by a worker process starts from the stored crawl state of
+        its hosts. Stored rows are kept, and codec dictionaries are all
+        copied. Return False on error.
+        '''
+        def on_domains(url):
+            return any(any(True for _ in UrlNormalizer.filter_urls((url, ), domain)) for domain in domains)
+        self.flush()
+        with self.__lock:
+            SQLite.create_function('on_domains', 1, on_domains)
+            if not SQLite.attach(db, CrawlerStorage.__copy_schema):
+                return False
+            try:
+                copied = SQLite.execute_batch_dml_sql([(sql, [()]) for sql in CrawlerStorage.__copy_sqls])
+                if copied and self.__url_filter is not None:
+                    self.__fill_url_filter(self.__url_filter, 'main')
+            finally:
+                SQLite.detach(CrawlerStorage.__copy_schema)
+        return copied
+    
+    def __merge_dicts(self):
+        # return the statements remapping the pages of clashing dictionaries
+        batch = []
+        result = SQLite.execute_query_sql(CrawlerStorage.__select_merge_dict_sql)
+        for dict_id, domain, zdict, create_time in result or ():
+            stored = SQLite.execute_query_sql(CrawlerStorage.__select_dict_sql, (dict_id, ))
+            if stored and stored[0][0] == zdict:
+                continue
+            if stored:
+                new_id = PageCodec.new_dict_id(zdict)
+                old_header = PageCodec.dict_header(dict_id)
+                new_header = PageCodec.dict_header(new_id)
+                value = (new_header, len(old_header) + 1, len(old_header), old_header)
+                batch.append((CrawlerStorage.__remap_dict_sql, [value]))
+                dict_id = new_id
+            value = (dict_id, domain, zdict, create_time)
+            batch.append((CrawlerStorage.__insert_dict_sql, [value]))
+        return batch
+    
     def close(self):
-        SQLite.close()
+        try:
+            if not self.flush():
+                raise sqlite3.OperationalError('Fail to flush pending rows: ' + SQLite.get_db())
+        finally:
+            self.__save_url_filter()
+            SQLite.close()
         
 
 class SQLite:
+    '''
+    Crawler database access. The version of the schema is kept in the
+    user_version of the database; version 0 databases keyed by md5 hex
+    text are converted by crawler.core.convert.
+    '''
+    SCHEMA_VERSION = 1
     __db = 'crawler.db'
     __page_sql = '''
         create table if not exists page (
-            id text primary key, 
-            url text unique, 
+            id integer primary key,
             status_code integer, 
             charset text,
             etag text, 
             last_modified text, 
-            content blob, 
             create_time text,
-            update_time text)
+            update_time text,
+            content blob)
     '''
     __url_sql = '''
         create table if not exists url (
-            md5 text primary key, 
-            url text unique,
+            id integer primary key,
+            url text not null,
             create_time text,
             update_time text)
     '''
+    __codec_dict_sql = '''
+        create table if not exists codec_dict (
+            id integer primary key,
+            domain text,
+            data blob,
+            create_time text)
+    '''
+    __fingerprint_sql = '''
+        create table if not exists fingerprint (
+            id integer primary key,
+            exact text,
+            simhash integer,
+            band0 integer,
+            band1 integer,
+            band2 integer,
+            band3 integer)
+    '''
+    __redirect_sql = '''
+        create table if not exists redirect (
+            id integer primary key,
+            target_id integer,
+            status_code integer,
+            create_time text)
+    '''
+    __duplicate_sql = '''
+        create table if not exists duplicate (
+            id integer primary key,
+            original_id integer,
+            create_time text)
+    '''
     __tables = {
               'page' : __page_sql, 
-              'url' : __url_sql
+              'url' : __url_sql,
+              'codec_dict' : __codec_dict_sql,
+              'fingerprint' : __fingerprint_sql,
+              'redirect' : __redirect_sql,
+              'duplicate' : __duplicate_sql
               }
-    connection = None
+    __indexes = [
+        'create index if not exists codec_dict_domain on codec_dict(domain)',
+        'create index if not exists fingerprint_exact on fingerprint(exact)',
+        'create index if not exists fingerprint_band0 on fingerprint(band0)',
+        'create index if not exists fingerprint_band1 on fingerprint(band1)',
+        'create index if not exists fingerprint_band2 on fingerprint(band2)',
+        'create index if not exists fingerprint_band3 on fingerprint(band3)'
+    ]
+    __pragmas = {
+        'journal_mode'  : 'WAL',
+        'synchronous'   : 'NORMAL',
+        'cache_size'    : -65536,
+        'mmap_size'     : 268435456,
+        'busy_timeout'  : 5000
+    }
+    __local = threading.local()
+    __connections = []
+    __generation = 0
+    __lock = threading.Lock()
+    __write_lock = threading.RLock()
     
     @classmethod
-    def connect(cls, db='crawler.db'):
-        if db:
+    def get_db(cls):
+        return cls.__db
+    
+    @classmethod
+    def configure(cls, **pragmas):
+        '''
+        Set pragmas (journal_mode, synchronous, cache_size, mmap_size,
+        busy_timeout) applied to connections opened afterwards.
+        '''
+        for name in pragmas:
+            if name not in cls.__pragmas:
+                raise ValueError('Unsupported pragma: ' + name)
+        cls.__pragmas.update(pragmas)
+    
+    @classmethod
+    def connect(cls, db=None):
+        '''
+        Return the connection of the current thread. Each thread owns its
+        connection, so reads in one thread never wait for another thread's
+        cursor, and WAL mode lets them run while a write is in progress.
+        Connecting to another db closes the connections to the current one.
+        '''
+        if db and db != cls.__db:
+            cls.close()
             cls.__db = db
-        if not cls.connection:
+        local = cls.__local
+        if getattr(local, 'generation', None) != cls.__generation:
+            local.connection = None
+        if not local.connection:
             try:
-                cls.connection = sqlite3.connect(cls.__db)
+                connection = sqlite3.connect(cls.__db, check_same_thread=False)
+                cls.__apply_pragmas(connection)
             except sqlite3.Error as e:
-                print('Fail to connect db ' + cls.db + ': ', e.args[0])
-        return cls.connection
+                _LOG.error('Fail to connect db %s: %s', cls.__db, e.args[0])
+            else:
+                with cls.__lock:
+                    cls.__connections.append(connection)
+                    local.connection = connection
+                    local.generation = cls.__generation
+        return local.connection
+    
+    @classmethod
+    def __apply_pragmas(cls, connection):
+        for name, value in cls.__pragmas.items():
+            if value is not None:
+                if not isinstance(value, int) and not str(value).isalnum():
+                    raise ValueError('Invalid value of pragma ' + name + ': ' + str(value))
+                connection.execute('PRAGMA ' + name + ' = ' + str(value))
     
     @classmethod
     def create_crawler_tables(cls):
+        connection = cls.connect()
+        version = cls.get_schema_version(connection)
+        if version != cls.SCHEMA_VERSION:
+            if version or cls.has_table(connection, 'url'):
+                raise ValueError('Crawler database schema version ' + str(version) + ' is not '
+                                 + str(cls.SCHEMA_VERSION) + ': ' + cls.__db
+                                 + ', convert it with python -m crawler.core.convert')
+            with cls.__write_lock:
+                connection.execute('PRAGMA user_version = ' + str(cls.SCHEMA_VERSION))
         for table in cls.__tables:
             cls.__create_table(table)
+        for index_sql in cls.__indexes:
+            try:
+                with cls.__write_lock:
+                    connection.execute(index_sql)
+            except sqlite3.Error as e:
+                _LOG.error('Fail to create index: %s, %s', index_sql, e.args[0])
        
+    @classmethod
+    def get_schema_version(cls, connection):
+        return connection.execute('PRAGMA user_version').fetchone()[0]
+    
+    @classmethod
+    def has_table(cls, connection, table):
+        sql = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+        return connection.execute(sql, (table, )).fetchone() is not None
+    
+    @classmethod
+    def get_table_sql(cls, table):
+        '''
+        Return the create statement of a crawler table.
+        '''
+        return cls.__tables[table]
+    
+    @classmethod
+    def get_index_sql(cls):
+        return list(cls.__indexes)
+    
     @classmethod         
     def __create_table(cls, table):
-        cls.connect(cls.__db)
-        cursor = cls.connection.cursor()
+        connection = cls.connect()
         if cls.__tables.get(table):
             try:
-                cursor.execute(cls.__tables[table])
+                with cls.__write_lock:
+                    connection.execute(cls.__tables[table])
             except sqlite3.Error as e:
-                print('Fail to create table ' + table, e.args[0]) 
+                _LOG.error('Fail to create table %s: %s', table, e.args[0])
+    
+    @classmethod
+    def attach(cls, db, schema):
+        '''
+        Attach another database file to the connection of the current
+        thread, return False on error.
+        '''
+        connection = cls.connect()
+        try:
+            with cls.__write_lock:
+                connection.execute('ATTACH DATABASE ? AS ' + schema, (db, ))
+        except sqlite3.Error as e:
+            _LOG.error('Fail to attach db %s: %s', db, e.args[0])
+            return False
+        return True
+    
+    @classmethod
+    def create_function(cls, name, num_params, func):
+        '''
+        Register a function with the connection of the current thread.
+        '''
+        cls.connect().create_function(name, num_params, func, deterministic=True)
+    
+    @classmethod
+    def detach(cls, schema):
+        connection = cls.connect()
+        try:
+            with cls.__write_lock:
+                connection.execute('DETACH DATABASE ' + schema)
+        except sqlite3.Error as e:
+            _LOG.error('Fail to detach db %s: %s', schema, e.args[0])
     
     @classmethod
     def execute_dml_sql(cls, sql, value):
-        cls.connect(cls.__db)
-        cursor = cls.connection.cursor()
+        connection = cls.connect()
         try:
-            cursor.execute(sql, value)
-            cls.connection.commit()
+            with cls.__write_lock, connection:
+                connection.execute(sql, value)
         except sqlite3.Error as e:
-            print('Fail to execute sql: ' + sql, e.args[0]) 
-        else:
-            cursor.close()
+            _LOG.error('Fail to execute sql: %s, %s', sql, e.args[0])
+    
+    @classmethod
+    def execute_batch_dml_sql(cls, batch):
+        '''
+        Execute a batch of (sql, values) pairs by executemany in a single
+        transaction, return False if the transaction is rolled back.
+        '''
+        connection = cls.connect()
+        try:
+            with cls.__write_lock, connection:
+                for sql, values in batch:
+                    if values:
+                        connection.executemany(sql, values)
+        except sqlite3.Error as e:
+            _LOG.error('Fail to execute batch sql: %s', e.args[0])
+            return False
+        return True
     
     @classmethod
     def execute_query_sql(cls, sql, value=None):
-        cls.connect(cls.__db)
-        cursor = cls.connection.cursor()
+        cursor = cls.connect().cursor()
         try:
             if value:
                 cursor.execute(sql, value)
             else:
                 cursor.execute(sql)
         except sqlite3.Error as e:
-            print('Fail to execute sql: ' + sql, e.args[0]) 
+            _LOG.error('Fail to execute sql: %s, %s', sql, e.args[0])
         else:
             result = list(cursor)
             cursor.close()
             return result
     
+    @classmethod
+    def iterate_query_sql(cls, sql, value=None, batch_size=1000):
+        '''
+        Yield the rows of a query, fetched batch_size rows at a time, so
+        only a batch of rows is held in memory. The cursor is closed once
+        the rows are consumed or the generator is closed.
+        '''
+        cursor = cls.connect().cursor()
+        try:
+            try:
+                if value:
+                    cursor.execute(sql, value)
+                else:
+                    cursor.execute(sql)
+            except sqlite3.Error as e:
+                _LOG.error('Fail to execute sql: %s, %s', sql, e.args[0])
+                return
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+    
+    @classmethod
+    def open_blob(cls, table, column, row_id, schema='main'):
+        '''
+        Open a blob of a row for incremental reads, return None if there
+        is no such row, or its value is not a blob.
+        '''
+        try:
+            return cls.connect().blobopen(table, column, row_id, readonly=True, name=schema)
+        except sqlite3.Error as e:
+            _LOG.debug('Fail to open blob: %s.%s, row = %s, %s', table, column, row_id, e.args[0])
+            return None
+    
     @classmethod
     def close(cls):
-        if cls.connection:
-            cls.connection.close()
+        '''
+        Close the connections of all threads.
+        '''
+        with cls.__lock:
+            connections = cls.__connections
+            cls.__connections = []
+            cls.__generation += 1
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,223 @@
+from collections import OrderedDict
+from functools import lru_cache
+import hashlib
+import re
+import threading
+from urllib.parse import urljoin, urlsplit, urlunsplit
+
+from crawler.core.utils import ScalableBloomFilter
+
+
+class UrlNormalizer:
+    '''
+    Url normalization stage for the links of a page.
+    A link is discarded when it is a fragment, contains a bad character,
+    has an unsupported scheme, or its path ends with a bad suffix name.
+    The remaining links are made absolute and canonicalized following
+    RFC 3986 section 6.2.2: lower-cased scheme and host, default port
+    removed, dot-segments removed, percent-encodings upper-cased and
+    unreserved characters decoded, and the fragment dropped.
+    Resolved and canonical forms are kept in LRU caches, since the same
+    navigation links show up on most pages of a site.
+    '''
+    SCHEMES = frozenset(['http', 'https'])
+    DEFAULT_PORTS = {'http' : 80, 'https' : 443}
+    BAD_CHARACTERS = re.compile('[\'"<> ]')
+    # no .php, whose pages are HTML
+    BAD_SUFFIX_NAMES = frozenset([
+        '.zip', '.rar', '.iso', '.gz', '.tar', '.jar',
+        '.gzip', '.7z', '.cab', '.uue', '.bz2', '.z',
+        '.rmvb', '.mkv', '.mp3', '.mp4', '.mov', '.flv',
+        '.wmv', '.asf', '.csf', '.sts', '.swf', '.avi',
+        '.ts', '.acm', '.adf', '.aiff', '.ani', '.dll',
+        '.so', '.emf', '.tiff', '.psd', '.pcx', '.wmf',
+        '.png', '.gif', '.bmp', '.ico', '.jpg', '.jpeg',
+        '.pdf', '.doc', '.docx', '.xls', '.xlsx', '.txt',
+        '.ppt', '.pptx', '.mdf', '.exe', '.css',
+        '.java', '.cpp', '.py', '.rb', '.go',
+        '.c', '.cc', '.hpp', '.sh', '.pl', '.clj', '.h'
+    ])
+    CACHE_SIZE = 65536
+    __PERCENT_ENCODING = re.compile('%[0-9A-Fa-f]{2}')
+    __UNRESERVED = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~')
+
+    @classmethod
+    def normalize_urls(cls, urls, base_url=None):
+        '''
+        Return the canonical forms of a batch of links, in page order and
+        without duplicates.
+        '''
+        canonical_urls = {}
+        for url in urls:
+            canonical_url = cls.normalize(url, base_url)
+            if canonical_url:
+                canonical_urls[canonical_url] = None
+        return list(canonical_urls)
+
+    @classmethod
+    def normalize(cls, url, base_url=None):
+        '''
+        Return the canonical form of a link, or None if it is discarded.
+        '''
+        if not url or url[0] == '#' or cls.BAD_CHARACTERS.search(url):
+            return None
+        return cls._canonicalize(cls._resolve(base_url, url))
+
+    @classmethod
+    def filter_urls(cls, urls, domain):
+        '''
+        Keep canonical urls on the domain or its sub-domains. The port is
+        compared only if the domain has one.
+        '''
+        with_port = ':' in domain
+        suffix = '.' + domain
+        for url in urls:
+            netloc, hostname = cls._split_host(url)
+            host = netloc if with_port else hostname
+            if host == domain or host.endswith(suffix):
+                yield url
+
+    @staticmethod
+    @lru_cache(maxsize=CACHE_SIZE)
+    def _resolve(base_url, url):
+        if base_url:
+            return urljoin(base_url, url)
+        return url
+
+    @staticmethod
+    @lru_cache(maxsize=CACHE_SIZE)
+    def _split_host(url):
+        parts = urlsplit(url)
+        return parts.netloc, parts.hostname or ''
+
+    @staticmethod
+    @lru_cache(maxsize=CACHE_SIZE)
+    def _canonicalize(url):
+        cls = UrlNormalizer
+        try:
+            parts = urlsplit(url)
+            scheme = parts.scheme.lower()
+            if scheme not in cls.SCHEMES:
+                return None
+            host = parts.hostname
+            port = parts.port
+        except ValueError:
+            return None
+        if not host:
+            return None
+        host = host.rstrip('.')
+        if ':' in host:
+            # IPv6 literal
+            host = '[' + host + ']'
+        if port and port != cls.DEFAULT_PORTS.get(scheme):
+            host = host + ':' + str(port)
+        path = cls.__remove_dot_segments(cls.__normalize_percent_encoding(parts.path)) or '/'
+        # discard binary resources by the suffix name of the last segment
+        name = path[path.rfind('/') + 1:]
+        dot = name.rfind('.')
+        if dot != -1 and name[dot:].lower() in cls.BAD_SUFFIX_NAMES:
+            return None
+        query = cls.__normalize_percent_encoding(parts.query)
+        return urlunsplit((scheme, host, path, query, ''))
+
+    @classmethod
+    def __normalize_percent_encoding(cls, component):
+        if '%' not in component:
+            return component
+        return cls.__PERCENT_ENCODING.sub(cls.__decode_unreserved, component)
+
+    @classmethod
+    def __decode_unreserved(cls, match):
+        ch = chr(int(match.group(0)[1:], 16))
+        if ch in cls.__UNRESERVED:
+            return ch
+        return match.group(0).upper()
+
+    @classmethod
+    def __remove_dot_segments(cls, path):
+        if '.' not in path:
+            return path
+        segments = []
+        for segment in path.split('/'):
+            if segment == '..':
+                if len(segments) > 1:
+                    segments.pop()
+            elif segment != '.':
+                segments.append(segment)
+        if path.endswith(('/.', '/..')):
+            segments.append('')
+        return '/'.join(segments)
+
+
+class RedirectMap:
+    '''
+    In-memory map of redirected urls to the url they end up at, for
+    crawls without storage. Beyond MAX_ENTRIES urls, the least recently
+    used ones are dropped.
+    '''
+    MAX_ENTRIES = 65536
+
+    def __init__(self):
+        self.__targets = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def find_redirect(self, url):
+        '''
+        Return the url a url redirects to, or None.
+        '''
+        with self.__lock:
+            target_url = self.__targets.get(url)
+            if target_url:
+                self.__targets.move_to_end(url)
+        return target_url
+
+    def save_redirects(self, redirects, target_url):
+        '''
+        Map the (url, status_code) hops of a fetch to the url fetched last.
+        '''
+        with self.__lock:
+            for url, _ in redirects:
+                self.__targets[url] = target_url
+                self.__targets.move_to_end(url)
+            while len(self.__targets) > RedirectMap.MAX_ENTRIES:
+                self.__targets.popitem(last=False)
+
+
+class FetchedUrls:
+    '''
+    Urls a crawl has fetched or is fetching, shared by its fetch threads,
+    so that a page reached both by a link and through a redirect is only
+    fetched once. Popped urls are kept behind a Bloom filter of their md5
+    digests, redirect targets in an LRU map of at most MAX_TARGETS urls.
+    '''
+    MAX_TARGETS = 65536
+
+    def __init__(self):
+        self.__fetched = ScalableBloomFilter()
+        self.__targets = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def claim(self, url):
+        '''
+        Claim the url of a popped task, False if a redirect fetched it.
+        '''
+        digest = hashlib.md5(url.encode('utf-8')).digest()
+        with self.__lock:
+            if url in self.__targets:
+                self.__targets.move_to_end(url)
+                return False
+            self.__fetched.add(digest)
+        return True
+
+    def claim_target(self, url):
+        '''
+        Claim the target of a redirect, False if it was fetched or claimed.
+        '''
+        digest = hashlib.md5(url.encode('utf-8')).digest()
+        with self.__lock:
+            if url in self.__targets or digest in self.__fetched:
+                return False
+            self.__targets[url] = None
+            while len(self.__targets) > FetchedUrls.MAX_TARGETS:
+                self.__targets.popitem(last=False)
+        return True
@@ -1,3 +1,7 @@
+import math
+import os
+import struct
+
 
 class UniqIdGenerator:
     seeds = {None : -1}
@@ -8,3 +12,124 @@ class UniqIdGenerator:
             cls.seeds[seed] = -1
         cls.seeds[seed] += 1
         return cls.seeds[seed]
+
+
+class BloomFilter:
+    '''
+    Fixed size Bloom filter over 128-bit digests (e.g. md5). The bit
+    positions are derived from the digest by double hashing, so a key
+    is hashed only once by the caller.
+    '''
+    def __init__(self, capacity=100000, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bit_count = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.bit_count / capacity * math.log(2))))
+        self.count = 0
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        
+    def add(self, digest):
+        '''
+        Add a digest, return False if it may have been added before.
+        '''
+        is_new = False
+        bits = self.bits
+        for position in self.__positions(digest):
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                is_new = True
+        if is_new:
+            self.count += 1
+        return is_new
+    
+    def __contains__(self, digest):
+        bits = self.bits
+        for position in self.__positions(digest):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+    
+    def __positions(self, digest):
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        m = self.bit_count
+        return [(h1 + i * h2) % m for i in range(self.hash_count)]
+    
+    
+class ScalableBloomFilter:
+    '''
+    Bloom filter which grows by chaining filters: when the last filter
+    is full, a larger one with a tighter error rate is appended, so the
+    overall false positive rate stays bounded by error_rate.
+    The filter can be saved to and loaded from a file, together with an
+    integer tag the owner uses to check that the file is not stale.
+    '''
+    __HEADER = struct.Struct('<4sIQ')
+    __FILTER_HEADER = struct.Struct('<QdQ')
+    __MAGIC = b'SBF1'
+    
+    def __init__(self, initial_capacity=100000, error_rate=0.001, growth=4, tightening=0.5):
+        self._initial_capacity = initial_capacity
+        self._error_rate = error_rate
+        self._growth = growth
+        self._tightening = tightening
+        self.filters = []
+        
+    def add(self, digest):
+        if digest in self:
+            return False
+        if not self.filters or self.filters[-1].count >= self.filters[-1].capacity:
+            self.__grow()
+        return self.filters[-1].add(digest)
+    
+    def __contains__(self, digest):
+        for f in self.filters:
+            if digest in f:
+                return True
+        return False
+    
+    def __len__(self):
+        return sum(f.count for f in self.filters)
+    
+    def __grow(self):
+        n = len(self.filters)
+        capacity = self._initial_capacity * (self._growth ** n)
+        error_rate = self._error_rate * (1 - self._tightening) * (self._tightening ** n)
+        self.filters.append(BloomFilter(capacity, error_rate))
+        
+    def save(self, path, tag=0):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(ScalableBloomFilter.__HEADER.pack(ScalableBloomFilter.__MAGIC, len(self.filters), tag))
+            for bf in self.filters:
+                f.write(ScalableBloomFilter.__FILTER_HEADER.pack(bf.capacity, bf.error_rate, bf.count))
+                f.write(bf.bits)
+        os.replace(tmp_path, path)
+    
+    @classmethod
+    def load(cls, path, initial_capacity=100000, error_rate=0.001):
+        '''
+        Return a (filter, tag) pair, or (None, None) if the file does not
+        exist or is broken.
+        '''
+        if not os.path.exists(path):
+            return None, None
+        sbf = ScalableBloomFilter(initial_capacity, error_rate)
+        try:
+            with open(path, 'rb') as f:
+                magic, filter_count, tag = cls.__HEADER.unpack(f.read(cls.__HEADER.size))
+                if magic != cls.__MAGIC:
+                    return None, None
+                for _ in range(filter_count):
+                    capacity, rate, count = cls.__FILTER_HEADER.unpack(f.read(cls.__FILTER_HEADER.size))
+                    bf = BloomFilter(capacity, rate)
+                    bits = f.read(len(bf.bits))
+                    if len(bits) != len(bf.bits):
+                        return None, None
+                    bf.bits = bytearray(bits)
+                    bf.count = count
+                    sbf.filters.append(bf)
+        except (OSError, struct.error):
+            return None, None
+        return sbf, tag
@@ -0,0 +1,83 @@
+import hashlib
+import os
+import sqlite3
+
+from crawler.core.storage import CrawlerStorage
+from crawler.core.utils import BloomFilter, ScalableBloomFilter
+
+
+def digest(i):
+    return hashlib.md5(str(i).encode('ascii')).digest()
+
+
+# test the false positive rate stays near the error rate
+def test_bloom_filter():
+    bloom_filter = BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom_filter.add(digest(i))
+    assert all(digest(i) in bloom_filter for i in range(1000))
+    false_positives = sum(1 for i in range(1000, 11000) if digest(i) in bloom_filter)
+    print('false positives = ' + str(false_positives))
+    assert false_positives < 300
+    # a scalable filter chains larger filters as it fills up
+    scalable_filter = ScalableBloomFilter(initial_capacity=100, error_rate=0.01)
+    for i in range(1000):
+        scalable_filter.add(digest(i))
+    assert len(scalable_filter.filters) > 1
+    assert all(digest(i) in scalable_filter for i in range(1000))
+
+
+def test_save_load():
+    path = 'bloom-test.bloom'
+    scalable_filter = ScalableBloomFilter(initial_capacity=100, error_rate=0.01)
+    for i in range(500):
+        scalable_filter.add(digest(i))
+    scalable_filter.save(path, tag=7)
+    loaded, tag = ScalableBloomFilter.load(path)
+    assert tag == 7 and len(loaded) == len(scalable_filter)
+    assert [f.bits for f in loaded.filters] == [f.bits for f in scalable_filter.filters]
+    assert all(digest(i) in loaded for i in range(500))
+    # a broken or missing file is not loaded
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 1)
+    assert ScalableBloomFilter.load(path) == (None, None)
+    os.remove(path)
+    assert ScalableBloomFilter.load(path) == (None, None)
+
+
+def remove_db(db):
+    for suffix in ('', '-wal', '-shm', CrawlerStorage.FILTER_SUFFIX):
+        if os.path.exists(db + suffix):
+            os.remove(db + suffix)
+
+
+# test the url filter of a storage is saved, and rebuilt once stale
+def test_storage_filter():
+    db = 'bloom-test.db'
+    remove_db(db)
+    storage = CrawlerStorage(db=db)
+    storage.initialize()
+    storage.save_url(url='http://example.com/1')
+    storage.close()
+    assert os.path.exists(db + CrawlerStorage.FILTER_SUFFIX)
+    # a url added behind the back of the storage makes the filter stale
+    connection = sqlite3.connect(db)
+    with connection:
+        connection.execute('INSERT INTO url(id, url) VALUES (?, ?)',
+                           (CrawlerStorage.url_id('http://example.com/2'), 'http://example.com/2'))
+    connection.close()
+    storage = CrawlerStorage(db=db)
+    storage.initialize()
+    try:
+        assert storage.is_crawled('http://example.com/1')
+        assert storage.is_crawled('http://example.com/2')
+        assert not storage.is_crawled('http://example.com/3')
+    finally:
+        storage.close()
+        remove_db(db)
+
+
+if __name__ == '__main__':
+    test_bloom_filter()
+    test_save_load()
+    test_storage_filter()
@@ -0,0 +1,113 @@
+import io
+import os
+import sqlite3
+
+from crawler.core.storage import CrawlerStorage, PageCodec
+
+
+def remove_db(db):
+    for suffix in ('', '-wal', '-shm', CrawlerStorage.FILTER_SUFFIX):
+        if os.path.exists(db + suffix):
+            os.remove(db + suffix)
+
+
+def build_page(site, i):
+    head = '<html><head><title>%s</title><link rel="stylesheet" href="/%s.css"></head>' % (site, site)
+    return (head + '<body>%s page %d</body></html>' % (site, i) * 20).encode('utf-8')
+
+
+# test values encode and decode back, and values without MAGIC pass as is
+def test_round_trip():
+    content = build_page('a', 1)
+    for codec in (PageCodec.RAW, PageCodec.ZLIB, PageCodec.LZMA):
+        page_codec = PageCodec(codec, dict_sample_pages=0)
+        value = page_codec.encode(content)
+        assert page_codec.decode(value) == content
+        assert b''.join(page_codec.iter_decode(io.BytesIO(value), 16)) == content
+        assert codec == PageCodec.RAW or len(value) < len(content)
+    page_codec = PageCodec()
+    # rows written before compression
+    for legacy in (b'<html>legacy</html>', b'x', b'', None):
+        assert page_codec.decode(legacy) == legacy
+    assert b''.join(page_codec.iter_decode(io.BytesIO(b'<html>legacy</html>'))) == b'<html>legacy</html>'
+    # content not worth compressing is stored raw, behind MAGIC
+    value = page_codec.encode(os.urandom(100))
+    assert value[:3] == PageCodec.MAGIC + bytes([PageCodec.RAW])
+    try:
+        page_codec.decode(PageCodec.MAGIC + bytes([9]) + b'data')
+        assert False, 'unknown codec decoded'
+    except ValueError:
+        pass
+
+
+def save_pages(db, site):
+    remove_db(db)
+    storage = CrawlerStorage(db=db, dict_sample_pages=2)
+    storage.initialize()
+    for i in range(4):
+        storage.save_page(url='http://%s.example.com/%d' % (site, i), status_code=200,
+                          content=build_page(site, i))
+    storage.close()
+    connection = sqlite3.connect(db)
+    dict_id = connection.execute('SELECT id FROM codec_dict').fetchone()[0]
+    connection.close()
+    return dict_id
+
+
+# test pages of a merged dictionary whose id is taken are remapped
+def test_merge_dict():
+    db, shard_db = 'codec-test.db', 'codec-shard.db'
+    dict_id = save_pages(db, 'a')
+    shard_dict_id = save_pages(shard_db, 'b')
+    assert dict_id != shard_dict_id
+    # the shard dictionary takes the id of the other one
+    connection = sqlite3.connect(shard_db)
+    with connection:
+        connection.execute('UPDATE codec_dict SET id = ?', (dict_id, ))
+        connection.execute('UPDATE page SET content = CAST(? || substr(content, 8) AS BLOB) '
+                           'WHERE substr(content, 1, 7) = ?',
+                           (PageCodec.dict_header(dict_id), PageCodec.dict_header(shard_dict_id)))
+        count = connection.execute('SELECT count(*) FROM page WHERE substr(content, 1, 7) = ?',
+                                   (PageCodec.dict_header(dict_id), )).fetchone()[0]
+    connection.close()
+    print('pages with a dictionary = ' + str(count))
+    assert count > 0
+    storage = CrawlerStorage(db=db)
+    storage.initialize()
+    try:
+        assert storage.merge(shard_db)
+        for site in ('a', 'b'):
+            for i in range(4):
+                url = 'http://%s.example.com/%d' % (site, i)
+                assert storage.query_page(url)[0].content == build_page(site, i)
+                assert b''.join(storage.iter_content(url)) == build_page(site, i)
+    finally:
+        storage.close()
+        remove_db(db)
+        remove_db(shard_db)
+
+
+# test a large compressed page is streamed in bounded chunks
+def test_iter_content():
+    content = b''.join(b'<p>line %d</p>' % (i % 1000) for i in range(500000))
+    db = 'codec-test.db'
+    for codec in (PageCodec.ZLIB, PageCodec.LZMA):
+        remove_db(db)
+        storage = CrawlerStorage(db=db, codec=codec, dict_sample_pages=0)
+        storage.initialize()
+        try:
+            storage.save_page(url='http://example.com/big', status_code=200, content=content)
+            storage.flush()
+            chunks = list(storage.iter_content('http://example.com/big', 65536))
+            print('codec = %d, size = %d, chunks = %d' % (codec, len(content), len(chunks)))
+            assert max(len(chunk) for chunk in chunks) <= 65536
+            assert b''.join(chunks) == content
+        finally:
+            storage.close()
+            remove_db(db)
+
+
+if __name__ == '__main__':
+    test_round_trip()
+    test_merge_dict()
+    test_iter_content()
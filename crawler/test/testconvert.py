@@ -0,0 +1,77 @@
+import os
+import sqlite3
+
+from crawler.core.convert import convert
+from crawler.core.storage import CrawlerStorage, SQLite
+
+
+# tables of a crawler database keyed by md5 hex text
+V0_TABLES = [
+    '''create table page (
+        id text primary key, url text unique, status_code integer, charset text,
+        etag text, last_modified text, content blob, create_time text, update_time text)''',
+    '''create table url (
+        md5 text primary key, url text unique, create_time text, update_time text)''',
+    '''create table codec_dict (
+        id integer primary key, domain text, data blob, create_time text)''',
+    '''create table fingerprint (
+        id text primary key, url text, exact text, simhash integer,
+        band0 integer, band1 integer, band2 integer, band3 integer)'''
+]
+CREATE_TIME = '2024-01-02 03:04:05'
+
+
+def build_v0_db(db):
+    connection = sqlite3.connect(db)
+    with connection:
+        for sql in V0_TABLES:
+            connection.execute(sql)
+        for url in ('http://a.example.com/', 'http://a.example.com/1'):
+            connection.execute('INSERT INTO url VALUES (?, ?, ?, ?)', ('md5-' + url, url, CREATE_TIME, CREATE_TIME))
+        # a page and a fingerprint whose urls have no url row
+        content = b'<html>2</html>'
+        connection.execute('INSERT INTO page VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           ('md5-2', 'http://a.example.com/2', 200, 'utf-8', '"e2"', None, content,
+                            CREATE_TIME, CREATE_TIME))
+        connection.execute('INSERT INTO fingerprint VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                           ('md5-3', 'http://a.example.com/3', 'exact', 12345, 1, 2, 3, 4))
+    connection.close()
+    # keyed by md5 digests, removed by the conversion
+    with open(db + CrawlerStorage.FILTER_SUFFIX, 'wb') as f:
+        f.write(b'filter')
+
+
+# test converting a version 0 database to url ids
+def test_convert():
+    db = 'convert-test.db'
+    for suffix in ('', CrawlerStorage.FILTER_SUFFIX):
+        if os.path.exists(db + suffix):
+            os.remove(db + suffix)
+    build_v0_db(db)
+    assert convert(db)
+    assert not os.path.exists(db + CrawlerStorage.FILTER_SUFFIX)
+    connection = sqlite3.connect(db)
+    try:
+        assert SQLite.get_schema_version(connection) == SQLite.SCHEMA_VERSION
+        urls = dict(connection.execute('SELECT url, id FROM url'))
+        print('urls = ' + str(sorted(urls)))
+        assert len(urls) == 4
+        for url, url_id in urls.items():
+            assert url_id == CrawlerStorage.url_id(url)
+        row = connection.execute('SELECT id, status_code, etag, content, create_time FROM page').fetchone()
+        assert row[0] == urls['http://a.example.com/2']
+        assert row[1:3] == (200, '"e2"')
+        assert row[3] == b'<html>2</html>'
+        assert row[4] == CREATE_TIME
+        row = connection.execute('SELECT id, simhash, band3 FROM fingerprint').fetchone()
+        assert row == (urls['http://a.example.com/3'], 12345, 4)
+        assert not SQLite.has_table(connection, 'page_v0')
+    finally:
+        connection.close()
+    # converted once only
+    assert not convert(db)
+    os.remove(db)
+
+
+if __name__ == '__main__':
+    test_convert()
@@ -1,6 +1,15 @@
+import gzip
+import os
+import pickle
+import time
+
 from crawler.core.common import CrawlerConf, TaskConf, CrawlMode
-from crawler.core.crawlers import DefaultCrawler, UrlTask
-from crawler.core.http import DefaultHttpEngine
+from crawler.core.crawlers import DefaultCrawler, TaskFactory, UrlTask
+from crawler.core.fingerprint import Fingerprint
+from crawler.core.http import AsyncHttpEngine, DefaultHttpEngine
+from crawler.core.stats import CrawlStats
+from crawler.core.storage import CrawlerStorage
+from crawler.test.fixtures import StaticSite, html_page, redirect
 
 
 # test crawler
@@ -16,5 +25,227 @@ def crawl():
     url_task = UrlTask(task_conf)
     crawler.crawl(url_task)
 
+
+# test child tasks share a frozen copy of the seed conf
+def test_url_tasks():
+    task_conf = TaskConf('localhost:8080')
+    task_conf.max_depth = 2
+    seed = UrlTask(task_conf)
+    # slotted, and the crawl result is created when first used
+    assert not hasattr(seed, '__dict__')
+    assert seed._crawl_result is None and seed.crawl_result.url == 'http://localhost:8080/'
+    url_tasks = TaskFactory.build_url_tasks(seed, ['http://localhost:8080/a', 'http://localhost:8080/b'])
+    assert [url_task.depth for url_task in url_tasks] == [1, 1]
+    child_conf = url_tasks[0].task_conf
+    assert url_tasks[1].task_conf is child_conf and seed.task_conf is child_conf
+    # the conf of the caller is left modifiable
+    assert child_conf is not task_conf
+    task_conf.priority = 1
+    try:
+        child_conf.priority = 1
+        assert False, 'frozen task conf modified'
+    except AttributeError:
+        pass
+    # a frozen conf is pickled frozen, without the resolved address
+    state = child_conf.__getstate__()
+    assert 'ip_addr' not in state and state['max_depth'] == 2
+    copier = pickle.loads(pickle.dumps(child_conf))
+    assert copier.__getstate__() == state
+    try:
+        copier.max_depth = 3
+        assert False, 'frozen task conf modified'
+    except AttributeError:
+        pass
+    # a clone of a frozen conf can be modified
+    clone = TaskConf.clone('localhost:8080/c', child_conf)
+    clone.max_depth = 3
+    assert clone.url == 'http://localhost:8080/c'
+    # the address is resolved when first used
+    ip_addr = child_conf.ip_addr
+    print('ip_addr = ' + str(ip_addr))
+    assert ip_addr in ('127.0.0.1', '::1')
+
+
+def remove_db(db):
+    for suffix in ('', '-wal', '-shm', CrawlerStorage.FILTER_SUFFIX):
+        if os.path.exists(db + suffix):
+            os.remove(db + suffix)
+
+
+def storage_crawl(site, db, max_depth=2, max_body_size=None, recrawl_interval=-1):
+    storage = CrawlerStorage(db=db, recrawl_interval=recrawl_interval)
+    storage.initialize()
+    crawler_conf = CrawlerConf()
+    crawler_conf.mode = CrawlMode.STORAGE
+    crawler_conf.storage = storage
+    crawler_conf.http_engine = DefaultHttpEngine()
+    task_conf = TaskConf(site.domain)
+    task_conf.max_depth = max_depth
+    if max_body_size:
+        task_conf.max_body_size = max_body_size
+    DefaultCrawler(crawler_conf).crawl(UrlTask(task_conf))
+    crawler_conf.http_engine.close()
+    storage.flush()
+    return storage
+
+
+# test a body cut at max_body_size is not kept nor fingerprinted
+def test_oversize_body():
+    status_code, headers, body = html_page('word ' * 20000)
+    headers = dict(headers)
+    # a small Content-Length, so the body is only cut while it is read
+    headers['Content-Encoding'] = 'gzip'
+    site = StaticSite({
+        '/' : html_page('home', links=['/big']),
+        '/big' : (status_code, headers, gzip.compress(body))
+    }).start()
+    db = 'crawlers-test.db'
+    remove_db(db)
+    try:
+        storage = storage_crawl(site, db, max_body_size=4096)
+        assert sorted(site.paths()) == ['/', '/big']
+        record = storage.query_page(site.url('/big'))[0]
+        print('big: status_code = %s, content = %d' % (record[2], len(record.content or b'')))
+        assert record[2] == 200
+        assert not record.content
+        assert storage.find_duplicate(site.url('/'), Fingerprint.compute(body[:4096])) is None
+        storage.close()
+    finally:
+        site.stop()
+        remove_db(db)
+
+
+# test a due page is revalidated, and a 304 keeps the stored page
+def test_conditional_recrawl():
+    site = StaticSite({
+        '/' : html_page('home', etag='"home"', links=['/a', '/b']),
+        '/a' : html_page('page a', etag='"a"'),
+        '/b' : (200, {'Content-Type' : 'text/html', 'Last-Modified' : 'Mon, 01 Jan 2024 00:00:00 GMT'},
+                b'<html>page b</html>')
+    }).start()
+    db = 'crawlers-test.db'
+    remove_db(db)
+    try:
+        storage_crawl(site, db, recrawl_interval=1).close()
+        first = CrawlerStorage(db=db)
+        first.initialize()
+        update_time = first.query_page(site.url('/a'))[0][8]
+        first.close()
+        assert site.conditional_paths() == []
+        time.sleep(1.1)
+        site.clear()
+        storage = storage_crawl(site, db, recrawl_interval=1)
+        print('conditional = ' + str(sorted(site.conditional_paths())))
+        # the links of the not modified seed come from its stored content
+        assert sorted(site.paths()) == ['/', '/a', '/b']
+        assert sorted(site.conditional_paths()) == ['/', '/a', '/b']
+        headers = dict(site.requests)['/b']
+        assert headers['If-Modified-Since'] == 'Mon, 01 Jan 2024 00:00:00 GMT'
+        record = storage.query_page(site.url('/a'))[0]
+        assert record[2] == 200 and record.content == html_page('page a')[2]
+        assert record[8] > update_time
+        storage.close()
+    finally:
+        site.stop()
+        remove_db(db)
+
+
+def simple_crawl(site, http_engine, stage_workers=None):
+    crawler_conf = CrawlerConf()
+    crawler_conf.mode = CrawlMode.SIMPLE
+    crawler_conf.http_engine = http_engine
+    crawler_conf.stage_workers = stage_workers
+    task_conf = TaskConf(site.domain)
+    task_conf.max_depth = 2
+    DefaultCrawler(crawler_conf).crawl(UrlTask(task_conf))
+    http_engine.close()
+
+
+# test a page linked both directly and through a redirect is fetched once
+def test_redirect_target_once():
+    site = StaticSite({
+        '/' : html_page('home', links=['/old', '/p/9', '/new']),
+        '/old' : redirect(301, '/p/9'),
+        '/new' : redirect(302, '/p/9'),
+        '/p/9' : html_page('page 9')
+    }).start()
+    try:
+        for mode, http_engine, stage_workers in (('sequential', DefaultHttpEngine(), None),
+                                                 ('pipelined', DefaultHttpEngine(), {'fetch' : 2}),
+                                                 ('async', AsyncHttpEngine(), None)):
+            site.clear()
+            simple_crawl(site, http_engine, stage_workers)
+            print(mode + ': ' + str(sorted(site.paths())))
+            assert sorted(site.paths()) == ['/', '/new', '/old', '/p/9']
+    finally:
+        site.stop()
+
+
+# test async crawls parse and store pages off the event loop
+def test_async_process():
+    site = StaticSite({
+        '/' : html_page('home', links=['/a', '/b']),
+        '/a' : html_page('page a', links=['/b']),
+        '/b' : html_page('page b')
+    }).start()
+    try:
+        CrawlStats.reset()
+        simple_crawl(site, AsyncHttpEngine())
+        stages = CrawlStats.snapshot()['stages']
+        print('fetch = %d, process = %d' % (stages['fetch']['count'], stages['process']['count']))
+        assert sorted(site.paths()) == ['/', '/a', '/b']
+        assert stages['fetch']['count'] == stages['process']['count'] == 3
+    finally:
+        site.stop()
+
+
+# test redirects saved to storage: a redirect ending on a redirect is not
+def test_redirect_limits():
+    site = StaticSite({
+        '/' : html_page('home', links=['/old', '/loop1', '/r1']),
+        '/old' : redirect(301, '/p/9'),
+        '/p/9' : html_page('page 9'),
+        '/loop1' : redirect(301, '/loop2'),
+        '/loop2' : redirect(301, '/loop1'),
+        '/r1' : redirect(301, '/r2'),
+        '/r2' : redirect(301, '/r3'),
+        '/r3' : redirect(301, '/r4'),
+        '/r4' : html_page('page 4')
+    }).start()
+    db = 'crawlers-test.db'
+    remove_db(db)
+    try:
+        storage = CrawlerStorage(db=db)
+        storage.initialize()
+        crawler_conf = CrawlerConf()
+        crawler_conf.mode = CrawlMode.STORAGE
+        crawler_conf.storage = storage
+        crawler_conf.http_engine = DefaultHttpEngine()
+        task_conf = TaskConf(site.domain)
+        task_conf.max_depth = 2
+        task_conf.max_redirects = 2
+        DefaultCrawler(crawler_conf).crawl(UrlTask(task_conf))
+        crawler_conf.http_engine.close()
+        storage.flush()
+        paths = site.paths()
+        print('paths = ' + str(sorted(paths)))
+        # a loop stops at the url it started from, a chain at max_redirects
+        assert sorted(paths) == ['/', '/loop1', '/loop2', '/old', '/p/9', '/r1', '/r2', '/r3']
+        assert storage.find_redirect(site.url('/old')) == site.url('/p/9')
+        for path in ('/loop1', '/loop2', '/r1', '/r2'):
+            assert storage.find_redirect(site.url(path)) is None
+        assert storage.query_page(site.url('/r3'))[0][2] == 301
+        storage.close()
+    finally:
+        site.stop()
+        remove_db(db)
+
+
 if __name__ == '__main__':
+    test_url_tasks()
+    test_oversize_body()
+    test_conditional_recrawl()
+    test_redirect_target_once()
+    test_async_process()
+    test_redirect_limits()
     crawl()
\ No newline at end of file
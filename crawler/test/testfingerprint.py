@@ -0,0 +1,106 @@
+import os
+import random
+
+from crawler.core.common import CrawlerConf, TaskConf, CrawlMode
+from crawler.core.crawlers import DefaultCrawler, UrlTask
+from crawler.core.fingerprint import Fingerprint, FingerprintIndex
+from crawler.core.http import DefaultHttpEngine
+from crawler.core.storage import CrawlerStorage
+from crawler.test.fixtures import StaticSite, html_page
+
+
+def remove_db(db):
+    for suffix in ('', '-wal', '-shm', CrawlerStorage.FILTER_SUFFIX):
+        if os.path.exists(db + suffix):
+            os.remove(db + suffix)
+
+
+def build_text(changed_word=None):
+    rng = random.Random(1)
+    words = ['%x' % rng.getrandbits(24) for _ in range(400)]
+    if changed_word:
+        words[10] = changed_word
+    return ' '.join(words)
+
+
+# test near-duplicates found through the SimHash bands
+def test_near_duplicate():
+    simhash = 0x0123456789abcdef
+    near = Fingerprint('near', simhash ^ 0b111)
+    # 4 bits apart, in band 0 only, so the other bands match
+    far = Fingerprint('far', simhash ^ 0b1111)
+    assert near.is_near(simhash) and not far.is_near(simhash)
+    db = 'fingerprint-test.db'
+    remove_db(db)
+    storage = CrawlerStorage(db=db)
+    storage.initialize()
+    for index in (FingerprintIndex(), storage):
+        index.save_fingerprint('http://a.example.com/1', Fingerprint('exact', simhash))
+        assert index.find_duplicate('http://a.example.com/2', near) == 'http://a.example.com/1'
+        assert index.find_duplicate('http://a.example.com/2', far) is None
+        assert index.find_duplicate('http://a.example.com/2', Fingerprint('exact', 0)) == 'http://a.example.com/1'
+        # never a duplicate of itself
+        assert index.find_duplicate('http://a.example.com/1', near) is None
+    # through the database, not the pending rows
+    storage.flush()
+    assert storage.find_duplicate('http://a.example.com/2', near) == 'http://a.example.com/1'
+    storage.close()
+    remove_db(db)
+    # a page with one word changed is near, not exact
+    page = Fingerprint.compute(build_text().encode('ascii'))
+    changed = Fingerprint.compute(build_text('changed').encode('ascii'))
+    print('distance = ' + str(bin(page.simhash ^ changed.simhash).count('1')))
+    assert page.exact != changed.exact and page.is_near(changed.simhash)
+
+
+def crawl(site, db):
+    storage = CrawlerStorage(db=db)
+    storage.initialize()
+    conf = CrawlerConf()
+    conf.mode = CrawlMode.STORAGE
+    conf.storage = storage
+    conf.http_engine = DefaultHttpEngine()
+    task_conf = TaskConf(site.domain)
+    task_conf.max_depth = 2
+    task_conf.cross_host_allowed = True
+    DefaultCrawler(conf).crawl(UrlTask(task_conf))
+    conf.http_engine.close()
+    storage.close()
+
+
+# test a dropped duplicate is not downloaded by the next run
+def test_duplicate_rerun():
+    site = StaticSite({
+        '/' : html_page('seed', links=['/b', '/c']),
+        '/b' : html_page(build_text()),
+        '/c' : html_page(build_text('changed'))
+    }).start()
+    # another seed linking to the same pages
+    other_site = StaticSite({
+        '/' : html_page('other seed', links=[site.url('/b'), site.url('/c')])
+    }).start()
+    db = 'fingerprint-test.db'
+    remove_db(db)
+    try:
+        crawl(site, db)
+        assert sorted(site.paths()) == ['/', '/b', '/c']
+        storage = CrawlerStorage(db=db)
+        storage.initialize()
+        duplicate_of = storage.find_duplicate_of(site.url('/c'))
+        print('duplicate_of = ' + str(duplicate_of))
+        assert duplicate_of == site.url('/b')
+        assert not storage.should_crawl(site.url('/c'))
+        storage.close()
+        site.clear()
+        crawl(other_site, db)
+        print('rerun = ' + str(site.paths()))
+        assert other_site.paths() == ['/'] and site.paths() == []
+    finally:
+        site.stop()
+        other_site.stop()
+        remove_db(db)
+
+
+if __name__ == '__main__':
+    test_near_duplicate()
+    test_duplicate_rerun()
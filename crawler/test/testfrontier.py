@@ -0,0 +1,129 @@
+from crawler.core.common import TaskConf
+from crawler.core.crawlers import UrlTask, TaskFactory
+from crawler.core.frontier import CrawlFrontier, DiskFrontier
+
+
+def build_task(domain, priority=0, depth=0):
+    task_conf = TaskConf(domain)
+    task_conf.priority = priority
+    task_conf.max_depth = 3
+    url_task = UrlTask(task_conf)
+    url_task.depth = depth
+    return url_task
+
+
+# test frontier
+def test_frontier():
+    frontier = CrawlFrontier()
+    low = build_task('a.example.com')
+    high = build_task('b.example.com', priority=1)
+    frontier.push(low)
+    frontier.push(high)
+    # duplicated url is rejected
+    assert not frontier.push(build_task('b.example.com', priority=1))
+    children = TaskFactory.build_url_tasks(low, ['http://a.example.com/1', 'http://a.example.com/2'])
+    for child in children:
+        frontier.push(child)
+    popped = []
+    while frontier:
+        popped.append(frontier.pop().url)
+    print('popped = ' + str(popped))
+    assert popped == ['http://b.example.com/', 'http://a.example.com/',
+                      'http://a.example.com/1', 'http://a.example.com/2']
+
+
+def test_bounded_frontier():
+    frontier = CrawlFrontier(max_size=1)
+    assert frontier.push(build_task('a.example.com'))
+    assert not frontier.push(build_task('b.example.com'))
+    print('dropped = ' + str(frontier.get_dropped_count()))
+
+
+def test_seen_cap():
+    seen_cap = CrawlFrontier.SEEN_CAP
+    CrawlFrontier.SEEN_CAP = 4
+    try:
+        frontier = CrawlFrontier()
+        seed = build_task('a.example.com')
+        children = TaskFactory.build_url_tasks(seed, ['http://a.example.com/%d' % i for i in range(10)])
+        # seen urls beyond the cap are still rejected, from the Bloom filter
+        assert all(frontier.push(child) for child in children)
+        assert not any(frontier.push(child) for child in children)
+        assert frontier.push(build_task('b.example.com'))
+        assert len(frontier) == 11
+    finally:
+        CrawlFrontier.SEEN_CAP = seen_cap
+
+
+def test_disk_frontier():
+    path = 'frontier-test.db'
+    DiskFrontier.remove(path)
+    seed = build_task('a.example.com')
+    frontier = DiskFrontier(path, seed.url, memory_size=2)
+    frontier.push(seed)
+    children = TaskFactory.build_url_tasks(seed, ['http://a.example.com/%d' % i for i in range(10)])
+    for child in children:
+        frontier.push(child)
+    # crawl the seed, then stop without closing
+    frontier.task_done(frontier.pop())
+    frontier.checkpoint()
+    resumed = DiskFrontier(path, seed.url, memory_size=2)
+    print('resumed = ' + str(len(resumed)))
+    assert len(resumed) == 10
+    assert not resumed.push(children[0])
+    while resumed:
+        resumed.task_done(resumed.pop())
+    resumed.close()
+    assert DiskFrontier.is_complete(path, seed.url)
+    assert not DiskFrontier.is_pending(path, seed.url)
+    DiskFrontier.remove(path)
+
+
+def test_deferred_checkpoint():
+    path = 'frontier-test.db'
+    DiskFrontier.remove(path)
+    seed = build_task('a.example.com')
+    # pages of done tasks fail to be stored
+    frontier = DiskFrontier(path, seed.url, before_checkpoint=lambda: False)
+    frontier.push(seed)
+    frontier.task_done(frontier.pop())
+    frontier.close()
+    assert not DiskFrontier.is_complete(path, seed.url)
+    assert DiskFrontier.is_pending(path, seed.url)
+    resumed = DiskFrontier(path, seed.url)
+    print('deferred = ' + str(len(resumed)))
+    assert len(resumed) == 1
+    resumed.close()
+    DiskFrontier.remove(path)
+
+
+def test_deferred_refill():
+    path = 'frontier-test.db'
+    DiskFrontier.remove(path)
+    seed = build_task('a.example.com')
+    frontier = DiskFrontier(path, seed.url, memory_size=2, checkpoint_size=1,
+                            before_checkpoint=lambda: False)
+    frontier.push(seed)
+    crawled = []
+    while frontier:
+        task = frontier.pop()
+        crawled.append(task.url)
+        if task is seed:
+            for child in TaskFactory.build_url_tasks(seed, ['http://a.example.com/%d' % i for i in range(6)]):
+                frontier.push(child)
+        frontier.task_done(task)
+    frontier.close()
+    print('crawled = ' + str(crawled))
+    # done tasks left in the file are not refilled
+    assert sorted(crawled) == sorted(set(crawled))
+    assert len(crawled) == 7
+    DiskFrontier.remove(path)
+
+
+if __name__ == '__main__':
+    test_frontier()
+    test_bounded_frontier()
+    test_seen_cap()
+    test_disk_frontier()
+    test_deferred_checkpoint()
+    test_deferred_refill()
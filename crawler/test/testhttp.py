@@ -0,0 +1,228 @@
+import asyncio
+import gzip
+import threading
+import zlib
+
+from crawler.core.common import TaskConf
+from crawler.core.crawlers import UrlTask
+from crawler.core.http import AsyncHttpEngine, ContentDecoder, DefaultHttpEngine, HttpConnectionPool, \
+    LinkExtractor, ResumableSSLContext
+from crawler.core.stats import CrawlStats
+from crawler.test.fixtures import KEY_CERT, StaticSite, html_page
+
+
+BODY = b''.join(b'<a href="/page/%d">page %d</a>\n' % (i, i) for i in range(2000))
+
+
+def compress_deflate(data, wbits):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decode_chunks(content_encoding, data, chunk_size, max_length=0):
+    decoder = ContentDecoder(content_encoding)
+    decoded = []
+    for i in range(0, len(data), chunk_size):
+        piece = decoder.decode(data[i:i + chunk_size], max_length)
+        assert not max_length or len(piece) <= max_length
+        decoded.append(piece)
+    decoded.append(decoder.flush())
+    return b''.join(decoded)
+
+
+# test deflate with and without the zlib wrapper
+def test_deflate():
+    for wbits in (zlib.MAX_WBITS, -zlib.MAX_WBITS):
+        data = compress_deflate(BODY, wbits)
+        # the flavor is chosen by the first two bytes, even split
+        for chunk_size in (1, 7, len(data)):
+            assert decode_chunks('deflate', data, chunk_size) == BODY
+        print('deflate: wbits = %d, size = %d' % (wbits, len(data)))
+    # a body of less than two bytes is passed through on flush
+    assert decode_chunks('Deflate', b'x', 1) == b'x'
+
+
+def test_gzip():
+    data = gzip.compress(BODY)
+    for content_encoding in ('gzip', 'x-gzip', ' GZIP '):
+        assert decode_chunks(content_encoding, data, 512) == BODY
+    # chunked transfer splits the gzip header and trailer too
+    assert decode_chunks('gzip', data, 3) == BODY
+    # output held back by max_length comes with the next chunks
+    assert decode_chunks('gzip', data, 512, 4096) == BODY
+    print('gzip: size = %d' % len(data))
+
+
+def test_bounded_decode():
+    data = gzip.compress(BODY)
+    decoder = ContentDecoder('gzip')
+    decoded = []
+    # a small chunk inflates to many pieces of bounded size
+    for i in range(0, len(data), 1024):
+        for piece in decoder.iter_decode(data[i:i + 1024], 4096):
+            assert len(piece) <= 4096
+            decoded.append(piece)
+    decoded.append(decoder.flush())
+    assert b''.join(decoded) == BODY
+    print('pieces = %d' % len(decoded))
+
+
+def test_identity():
+    for content_encoding in (None, '', 'identity', 'br'):
+        assert decode_chunks(content_encoding, BODY, 1000) == BODY
+        decoder = ContentDecoder(content_encoding)
+        assert list(decoder.iter_decode(BODY, 10)) == [BODY]
+
+
+PAGE = ('<html><head><base href="/base/"><base href="/other/"></head><body>'
+        '<a href="a.html">a</a><A HREF = \'/b\'>b</A><a>no href</a><a href=" ">blank</a>'
+        '<map><area href="/c"></map><p>\u00e9t\u00e9 \u4e2d\u6587</p>'
+        '<a class="x" href="/d?q=1&amp;r=2">d</a></body></html>')
+
+
+# test links are the same however the page bytes are split
+def test_link_extractor():
+    expected = ['a.html', '/b', '/c', '/d?q=1&r=2']
+    for charset in ('utf-8', 'gbk'):
+        data = PAGE.encode(charset)
+        for chunk_size in (1, 3, len(data)):
+            extractor = LinkExtractor(charset)
+            chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+            assert list(extractor.extract(chunks)) == expected
+            # the first base href only
+            assert extractor.base_url == '/base/'
+    # links are handed out as soon as their tags are complete
+    extractor = LinkExtractor()
+    assert extractor.feed_bytes(b'<a href="/1">1</a><a hr') == ['/1']
+    assert extractor.feed_bytes(b'ef="/2">') == ['/2']
+    assert extractor.close() == []
+
+
+def fetch_paths(site, http_engine, paths):
+    task_conf = TaskConf(site.domain)
+    for path in paths:
+        url_task = UrlTask(task_conf, site.url(path))
+        http_engine.reuse()
+        http_engine.fetch(url_task)
+        assert url_task.crawl_result.status_code == 200
+
+
+# test keep-alive connections are reused, unless idle for too long
+def test_connection_pool():
+    site = StaticSite({path : html_page(path) for path in ('/a', '/b', '/c')}).start()
+    try:
+        for idle_timeout, reused in ((30, 2), (0, 0)):
+            CrawlStats.reset()
+            http_engine = DefaultHttpEngine(HttpConnectionPool(idle_timeout=idle_timeout))
+            fetch_paths(site, http_engine, ['/a', '/b', '/c'])
+            http_engine.close()
+            counters = CrawlStats.snapshot()['counters']
+            print('idle_timeout = %d, reused = %d' % (idle_timeout, counters.get('http.reused', 0)))
+            assert counters.get('http.reused', 0) == reused
+        # a host has at most max_per_host connections in use
+        pool = HttpConnectionPool(max_per_host=1)
+        conn, reused = pool.acquire('127.0.0.1', 80)
+        acquired = threading.Event()
+        def acquire():
+            other, _ = pool.acquire('127.0.0.1', 80)
+            acquired.set()
+            pool.release('127.0.0.1', 80, other, keep_alive=False)
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        assert not reused and not acquired.wait(0.2)
+        pool.release('127.0.0.1', 80, conn, keep_alive=False)
+        assert acquired.wait(5)
+        thread.join()
+        pool.close()
+    finally:
+        site.stop()
+
+
+def client_ssl_context():
+    ssl_context = ResumableSSLContext.create_default()
+    ssl_context.load_verify_locations(cadata=KEY_CERT[KEY_CERT.index('-----BEGIN CERTIFICATE'):])
+    return ssl_context
+
+
+# test new HTTPS connections to a host resume its TLS session
+def test_tls_resumption():
+    site = StaticSite({path : html_page(path) for path in ('/a', '/b', '/c')}, tls=True).start()
+    try:
+        # no keep-alive, so each fetch makes a handshake
+        ssl_context = client_ssl_context()
+        CrawlStats.reset()
+        http_engine = DefaultHttpEngine(HttpConnectionPool(idle_timeout=0, ssl_context=ssl_context))
+        fetch_paths(site, http_engine, ['/a', '/b', '/c'])
+        counters = CrawlStats.snapshot()['counters']
+        print('handshakes = %d, resumed = %d' % (counters['tls.handshakes'], counters.get('tls.resumed', 0)))
+        assert counters['tls.handshakes'] == 3 and counters.get('tls.resumed', 0) == 2
+        assert ssl_context.get_session('127.0.0.1') is not None
+        # a full handshake once the sessions are cleared
+        ssl_context.clear_sessions()
+        CrawlStats.reset()
+        fetch_paths(site, http_engine, ['/a'])
+        assert CrawlStats.snapshot()['counters'].get('tls.resumed', 0) == 0
+        http_engine.close()
+        # the asyncio engine resumes sessions the same way
+        CrawlStats.reset()
+        http_engine = AsyncHttpEngine(ssl_context=client_ssl_context())
+        task_conf = TaskConf(site.domain)
+        async def fetch_all():
+            for path in ('/a', '/b', '/c'):
+                url_task = UrlTask(task_conf, site.url(path))
+                await http_engine.fetch_async(url_task)
+                assert url_task.crawl_result.status_code == 200
+        asyncio.run(fetch_all())
+        counters = CrawlStats.snapshot()['counters']
+        assert counters['tls.handshakes'] == 3 and counters.get('tls.resumed', 0) == 2
+    finally:
+        site.stop()
+
+
+class FakeSession:
+    has_ticket = True
+    id = b'id'
+
+
+class FakeSslObject:
+    def __init__(self):
+        self.session = FakeSession()
+
+
+def test_session_cache():
+    ssl_context = ResumableSSLContext.create_default()
+    max_sessions = ResumableSSLContext.MAX_SESSIONS
+    ResumableSSLContext.MAX_SESSIONS = 2
+    try:
+        sessions = {}
+        for host in ('a.example.com', 'b.example.com'):
+            ssl_object = FakeSslObject()
+            sessions[host] = ssl_object.session
+            ssl_context.save_session(host, ssl_object)
+        # the least recently used host is dropped first
+        assert ssl_context.get_session('a.example.com') is sessions['a.example.com']
+        ssl_context.save_session('c.example.com', FakeSslObject())
+        assert ssl_context.get_session('b.example.com') is None
+        assert ssl_context.get_session('a.example.com') is sessions['a.example.com']
+        assert ssl_context.get_session('c.example.com') is not None
+    finally:
+        ResumableSSLContext.MAX_SESSIONS = max_sessions
+    # nothing is saved without a host or a resumable session
+    ssl_context.clear_sessions()
+    ssl_context.save_session(None, FakeSslObject())
+    ssl_context.save_session('a.example.com', None)
+    ssl_object = FakeSslObject()
+    ssl_object.session.has_ticket, ssl_object.session.id = False, b''
+    ssl_context.save_session('a.example.com', ssl_object)
+    assert ssl_context.get_session('a.example.com') is None and ssl_context.get_session(None) is None
+
+
+if __name__ == '__main__':
+    test_deflate()
+    test_gzip()
+    test_bounded_decode()
+    test_identity()
+    test_link_extractor()
+    test_connection_pool()
+    test_tls_resumption()
+    test_session_cache()
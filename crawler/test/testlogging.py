@@ -0,0 +1,46 @@
+import logging
+import threading
+
+import crawler.core.crawlers
+import crawler.core.manager
+from crawler.core.common import LoggerFactory
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append((threading.current_thread().name, record.getMessage()))
+
+
+# test importing the crawler leaves logging alone until it is started
+def test_logger_factory():
+    root = logging.getLogger(LoggerFactory.ROOT)
+    thread_count = threading.active_count()
+    assert not LoggerFactory.is_started()
+    assert root.propagate and root.level == logging.NOTSET and not root.handlers
+    # records propagate to the application handlers, and through the
+    # queue to the listener once started
+    application = ListHandler()
+    logging.getLogger().addHandler(application)
+    handler = ListHandler()
+    try:
+        LoggerFactory.start(handler=handler)
+        assert LoggerFactory.is_started() and threading.active_count() == thread_count + 1
+        LoggerFactory.get_logger('crawler.test').info('message %d', 1)
+        assert root.propagate and root.level == LoggerFactory.LEVEL
+        LoggerFactory.stop()
+    finally:
+        logging.getLogger().removeHandler(application)
+    print('messages = ' + str(handler.messages))
+    assert [message for _, message in handler.messages] == ['message 1']
+    assert handler.messages[0][0] != threading.current_thread().name
+    assert application.messages == [(threading.current_thread().name, 'message 1')]
+    assert not LoggerFactory.is_started() and threading.active_count() == thread_count
+    assert not root.handlers
+
+
+if __name__ == '__main__':
+    test_logger_factory()
@@ -1,8 +1,12 @@
 
+import os
+import time
+
 from crawler.core.common import CrawlMode
 from crawler.core.http import DefaultHttpEngine
-from crawler.core.manager import DefaultCrawlerManager, Key
+from crawler.core.manager import DefaultCrawlerManager, ProcessCrawlerManager, Key
 from crawler.core.storage import CrawlerStorage
+from crawler.test.fixtures import StaticSite, html_page
 
 
 def managed_crawl():
@@ -16,5 +20,45 @@ def managed_crawl():
     manager = DefaultCrawlerManager(settings)
     manager.wait_for()
     
+
+
+# test a second managed run revalidates the stored pages
+def test_managed_recrawl():
+    site = StaticSite({
+        '/' : html_page('home', etag='"home"', links=['/b']),
+        '/b' : html_page('b', etag='"b"')
+    }).start()
+    task_file = 'manager-test.conf'
+    db = 'manager-test.db'
+    with open(task_file, 'w') as f:
+        f.write(site.domain + ', -1, 0, 2, false, 500, 500\n')
+    settings = {
+        Key.CRAWLER_CRAWL_MODE          :   CrawlMode.STORAGE,
+        Key.CRAWLER_TASK_FILE           :   task_file,
+        Key.CRAWLER_HTTP_ENGINE_CLASS   :   DefaultHttpEngine,
+        Key.CRAWLER_STORAGE_CLASS       :   CrawlerStorage,
+        Key.CRAWLER_STORAGE_DB          :   db,
+        Key.CRAWLER_PROCESS_COUNT       :   1,
+        Key.CRAWLER_RECRAWL_INTERVAL    :   1
+    }
+    try:
+        for manager_class in (DefaultCrawlerManager, ProcessCrawlerManager):
+            for run in range(2):
+                site.clear()
+                manager_class(settings).wait_for()
+                # pages are due again
+                time.sleep(1.1)
+            print(manager_class.__name__ + ': conditional = ' + str(site.conditional_paths()))
+            assert sorted(site.paths()) == ['/', '/b']
+            assert sorted(site.conditional_paths()) == ['/', '/b']
+            for suffix in ('', '-wal', '-shm', CrawlerStorage.FILTER_SUFFIX):
+                if os.path.exists(db + suffix):
+                    os.remove(db + suffix)
+    finally:
+        site.stop()
+        os.remove(task_file)
+
+
 if __name__ == '__main__':
+    test_managed_recrawl()
     managed_crawl()
\ No newline at end of file
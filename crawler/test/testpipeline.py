@@ -0,0 +1,41 @@
+import threading
+
+from crawler.core.pipeline import Pipeline
+
+
+# test pipeline
+def test_pipeline():
+    results = []
+    lock = threading.Lock()
+    pipeline = Pipeline('test')
+    pipeline.add_stage('square', lambda n: pipeline.put('collect', n * n), workers=4, queue_size=2)
+    def collect(n):
+        with lock:
+            results.append(n)
+    pipeline.add_stage('collect', collect)
+    pipeline.start()
+    for n in range(100):
+        pipeline.put('square', n)
+    pipeline.stop()
+    utilization = pipeline.get_utilization()
+    print('utilization = ' + str(utilization))
+    assert sorted(results) == [n * n for n in range(100)]
+    assert utilization['square']['processed'] == 100
+    assert utilization['collect']['processed'] == 100
+
+
+def test_pipeline_error():
+    failed = []
+    pipeline = Pipeline('test')
+    pipeline.add_stage('fail', lambda n: 1 // n, error_handler=lambda n, e: failed.append(n))
+    pipeline.start()
+    for n in range(3):
+        pipeline.put('fail', n)
+    pipeline.stop()
+    assert failed == [0]
+    assert pipeline.get_utilization()['fail']['errors'] == 1
+
+
+if __name__ == '__main__':
+    test_pipeline()
+    test_pipeline_error()
@@ -0,0 +1,135 @@
+import asyncio
+import socket
+import threading
+import time
+
+from crawler.core.resolver import DnsResolver
+from crawler.core.stats import CrawlStats
+
+
+class FakeDns:
+    '''
+    Stands in for socket.getaddrinfo, counting the lookups of each host.
+    Hosts of known resolve to their ip, and the others fail. A lookup
+    waits for release to be set.
+    '''
+    def __init__(self, known):
+        self.known = known
+        self.lookups = {}
+        self.release = threading.Event()
+        self.release.set()
+        self.__lock = threading.Lock()
+        self.__getaddrinfo = None
+
+    def __enter__(self):
+        self.__getaddrinfo = socket.getaddrinfo
+        socket.getaddrinfo = self.getaddrinfo
+        DnsResolver.clear()
+        return self
+
+    def __exit__(self, *args):
+        socket.getaddrinfo = self.__getaddrinfo
+        DnsResolver.clear()
+
+    def getaddrinfo(self, host, port, *args, **kwargs):
+        with self.__lock:
+            self.lookups[host] = self.lookups.get(host, 0) + 1
+        self.release.wait(5)
+        if host not in self.known:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (self.known[host], 0))]
+
+
+# test addresses are cached for TTL seconds, and failures for NEGATIVE_TTL
+def test_ttl():
+    ttl, negative_ttl = DnsResolver.TTL, DnsResolver.NEGATIVE_TTL
+    DnsResolver.TTL, DnsResolver.NEGATIVE_TTL = 0.5, 0.2
+    CrawlStats.reset()
+    try:
+        with FakeDns({'a.example.com' : '10.0.0.1'}) as dns:
+            for _ in range(3):
+                assert DnsResolver.resolve('a.example.com') == [(socket.AF_INET, '10.0.0.1')]
+                try:
+                    DnsResolver.resolve('bad.example.com')
+                    assert False
+                except socket.gaierror:
+                    pass
+            assert dns.lookups == {'a.example.com' : 1, 'bad.example.com' : 1}
+            # the failure expires first
+            time.sleep(0.3)
+            DnsResolver.resolve('a.example.com')
+            try:
+                DnsResolver.resolve('bad.example.com')
+                assert False
+            except socket.gaierror:
+                pass
+            assert dns.lookups == {'a.example.com' : 1, 'bad.example.com' : 2}
+            time.sleep(0.3)
+            DnsResolver.resolve('a.example.com')
+            assert dns.lookups['a.example.com'] == 2
+            # ip literals are never looked up
+            assert DnsResolver.resolve('127.0.0.1') == [(socket.AF_INET, '127.0.0.1')]
+            assert DnsResolver.resolve('::1') == [(socket.AF_INET6, '::1')]
+            assert '127.0.0.1' not in dns.lookups and '::1' not in dns.lookups
+    finally:
+        DnsResolver.TTL, DnsResolver.NEGATIVE_TTL = ttl, negative_ttl
+    snapshot = CrawlStats.snapshot()
+    print('dns = %d, failures = %d' % (snapshot['stages']['dns']['count'],
+                                       snapshot['counters']['dns.failures']))
+    assert snapshot['stages']['dns']['count'] == 4
+    assert snapshot['counters']['dns.failures'] == 2
+
+
+# test concurrent and prefetched lookups of a host share one lookup
+def test_pending():
+    with FakeDns({'a.example.com' : '10.0.0.1', 'b.example.com' : '10.0.0.2'}) as dns:
+        dns.release.clear()
+        DnsResolver.prefetch(['a.example.com', 'a.example.com', None])
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(DnsResolver.resolve('a.example.com')))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        async def resolve_async():
+            return await DnsResolver.resolve_async('a.example.com')
+        def release():
+            time.sleep(0.1)
+            dns.release.set()
+        threading.Thread(target=release).start()
+        assert asyncio.run(resolve_async()) == [(socket.AF_INET, '10.0.0.1')]
+        for thread in threads:
+            thread.join()
+        assert results == [[(socket.AF_INET, '10.0.0.1')]] * 4
+        assert dns.lookups == {'a.example.com' : 1}
+        # a prefetched host is cached when resolved
+        DnsResolver.prefetch(['b.example.com'])
+        deadline = time.monotonic() + 5
+        while not dns.lookups.get('b.example.com') and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert DnsResolver.resolve('b.example.com') == [(socket.AF_INET, '10.0.0.2')]
+        assert dns.lookups['b.example.com'] == 1
+
+
+# test the oldest hosts are dropped past MAX_ENTRIES
+def test_max_entries():
+    max_entries = DnsResolver.MAX_ENTRIES
+    DnsResolver.MAX_ENTRIES = 2
+    try:
+        hosts = {'%s.example.com' % name : '10.0.0.%d' % i for i, name in enumerate('abc')}
+        with FakeDns(hosts) as dns:
+            DnsResolver.resolve('a.example.com')
+            DnsResolver.resolve('b.example.com')
+            DnsResolver.resolve('c.example.com')
+            DnsResolver.resolve('b.example.com')
+            DnsResolver.resolve('c.example.com')
+            assert dns.lookups == {'a.example.com' : 1, 'b.example.com' : 1, 'c.example.com' : 1}
+            DnsResolver.resolve('a.example.com')
+            assert dns.lookups['a.example.com'] == 2
+    finally:
+        DnsResolver.MAX_ENTRIES = max_entries
+
+
+if __name__ == '__main__':
+    test_ttl()
+    test_pending()
+    test_max_entries()
@@ -1,6 +1,143 @@
+import os
+import sqlite3
+import threading
+
 from crawler.core.storage import SQLite, CrawlerStorage
 
 
+def remove_db(db):
+    for suffix in ('', '-wal', '-shm', CrawlerStorage.FILTER_SUFFIX):
+        if os.path.exists(db + suffix):
+            os.remove(db + suffix)
+
+
+def count_rows(db, table):
+    connection = sqlite3.connect(db)
+    try:
+        return connection.execute('SELECT count(*) FROM ' + table).fetchone()[0]
+    finally:
+        connection.close()
+
+
+# test pages are written in batches, and kept pending if a flush fails
+def test_write_behind():
+    db = 'storage-test.db'
+    remove_db(db)
+    SQLite.configure(busy_timeout=0)
+    storage = CrawlerStorage(flush_size=3, flush_interval=3600, db=db)
+    storage.initialize()
+    try:
+        # a page is a url row and a page row
+        storage.save_page(url='http://example.com/1', status_code=200, content=b'1')
+        assert count_rows(db, 'page') == 0
+        storage.save_page(url='http://example.com/2', status_code=200, content=b'2')
+        assert count_rows(db, 'page') == 2 and count_rows(db, 'url') == 2
+        # pending rows are read back
+        storage.save_page(url='http://example.com/3', status_code=200, content=b'3')
+        assert storage.query_page('http://example.com/3')[0].content == b'3'
+        assert count_rows(db, 'page') == 3
+        # a flush blocked by another writer keeps its rows
+        storage.save_page(url='http://example.com/4', status_code=200, content=b'4')
+        connection = sqlite3.connect(db, isolation_level=None)
+        connection.execute('BEGIN IMMEDIATE')
+        assert not storage.flush()
+        connection.execute('ROLLBACK')
+        connection.close()
+        assert storage.flush()
+        assert count_rows(db, 'page') == 4
+    finally:
+        storage.close()
+        SQLite.configure(busy_timeout=5000)
+        remove_db(db)
+
+
+# test each thread has its own connection to the database in WAL mode
+def test_thread_connections():
+    db = 'storage-test.db'
+    remove_db(db)
+    connection = SQLite.connect(db)
+    SQLite.create_crawler_tables()
+    try:
+        assert SQLite.connect() is connection
+        assert connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        connections = []
+        sql = 'INSERT INTO url(id, url) VALUES (?, ?)'
+        def insert(n):
+            connections.append(SQLite.connect())
+            for i in range(50):
+                url = 'http://example.com/%d/%d' % (n, i)
+                SQLite.execute_dml_sql(sql, (CrawlerStorage.url_id(url), url))
+        threads = [threading.Thread(target=insert, args=(n, )) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(set(map(id, connections + [connection]))) == 5
+        assert SQLite.execute_query_sql('SELECT count(*) FROM url')[0][0] == 200
+        # readers are not blocked by a write in progress
+        writer = sqlite3.connect(db, isolation_level=None)
+        writer.execute('BEGIN IMMEDIATE')
+        writer.execute(sql, (1, 'http://example.com/uncommitted'))
+        assert SQLite.execute_query_sql('SELECT count(*) FROM url')[0][0] == 200
+        writer.execute('COMMIT')
+        writer.close()
+        assert SQLite.execute_query_sql('SELECT count(*) FROM url')[0][0] == 201
+    finally:
+        SQLite.close()
+    # closed connections are not handed out again
+    assert SQLite.connect() is not connection
+    SQLite.close()
+    remove_db(db)
+
+
+# test pages and urls are streamed in batches, and content read by chunks
+def test_iterate_pages():
+    db = 'storage-test.db'
+    remove_db(db)
+    storage = CrawlerStorage(db=db)
+    storage.initialize()
+    content = b''.join(b'<p>%d</p>' % i for i in range(2000))
+    try:
+        storage.save_page(url='http://example.com/1', status_code=200, charset='utf-8', content=content)
+        storage.save_page(url='http://example.com/2', status_code=404, content=b'not found')
+        storage.save_page(url='http://example.com/3', status_code=304)
+        storage.save_url(url='http://example.com/4')
+        # rows without content are plain tuples of the columns
+        rows = list(storage.iterate_pages(('url', 'status_code'), batch_size=2))
+        print('pages = ' + str(sorted(rows)))
+        assert sorted(rows) == [('http://example.com/1', 200), ('http://example.com/2', 404),
+                                ('http://example.com/3', 304)]
+        assert all(type(row) is tuple for row in rows)
+        records = {record[1] : record for record in storage.iterate_pages(batch_size=2)}
+        assert len(records) == 3 and len(records['http://example.com/1']) == len(CrawlerStorage.PAGE_COLUMNS)
+        assert records['http://example.com/1'].content == content
+        assert records['http://example.com/1'][3] == 'utf-8'
+        assert records['http://example.com/2'][6] == b'not found'
+        contents = {row[0] : row.content for row in storage.iterate_pages(('url', 'content'))}
+        assert contents['http://example.com/1'] == content and contents['http://example.com/2'] == b'not found'
+        assert not contents['http://example.com/3']
+        try:
+            list(storage.iterate_pages(('url', 'body')))
+            assert False
+        except ValueError:
+            pass
+        # a url without a page is a url row only
+        urls = [row[1] for row in storage.iterate_urls(batch_size=2)]
+        assert sorted(urls) == ['http://example.com/%d' % i for i in range(1, 5)]
+        assert sorted(row[1] for row in storage.query_all_urls()) == sorted(urls)
+        chunks = list(storage.iter_content('http://example.com/1', chunk_size=1000))
+        assert len(chunks) > 1 and all(len(chunk) <= 1000 for chunk in chunks)
+        assert b''.join(chunks) == content
+        assert b''.join(storage.iter_content('http://example.com/3')) == b''
+        assert list(storage.iter_content('http://example.com/4')) == []
+        # a pending page is flushed before its blob is opened
+        storage.save_page(url='http://example.com/5', status_code=200, content=b'5')
+        assert b''.join(storage.iter_content('http://example.com/5')) == b'5'
+    finally:
+        storage.close()
+        remove_db(db)
+
+
 if __name__ == '__main__':
     SQLite.connect()
     SQLite.create_crawler_tables()
@@ -61,4 +198,7 @@ if __name__ == '__main__':
     if is_query_all_urls:
         test_query_all_urls()
     if is_crawled:
-        test_is_crawled()
\ No newline at end of file
+        test_is_crawled()
+    test_write_behind()
+    test_thread_connections()
+    test_iterate_pages()
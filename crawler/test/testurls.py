@@ -0,0 +1,116 @@
+from crawler.core.common import TaskConf
+from crawler.core.http import HtmlParser
+from crawler.core.urls import FetchedUrls, RedirectMap, UrlNormalizer
+
+
+# test url canonicalization
+def test_canonicalize():
+    base_url = 'http://www.example.com/a/b/c.html'
+    cases = [
+        ('HTTP://WWW.Example.COM:80/x', 'http://www.example.com/x'),
+        ('https://www.example.com:443', 'https://www.example.com/'),
+        ('http://www.example.com:8080/x', 'http://www.example.com:8080/x'),
+        ('http://www.example.com./x', 'http://www.example.com/x'),
+        ('/%7euser/%41%2f%3a?q=%3a%2d', 'http://www.example.com/~user/A%2F%3A?q=%3A-'),
+        ('d.html#top', 'http://www.example.com/a/b/d.html'),
+        ('http://[::1]:80/x', 'http://[::1]/x')
+    ]
+    for url, canonical_url in cases:
+        normalized = UrlNormalizer.normalize(url, base_url)
+        print(url + ' = ' + str(normalized))
+        assert normalized == canonical_url
+    # urls of the same page collapse in page order
+    urls = UrlNormalizer.normalize_urls(['/x', 'http://WWW.example.com/x', '/y#z', '/y'], base_url)
+    assert urls == ['http://www.example.com/x', 'http://www.example.com/y']
+    # seeds take the canonical form of their links
+    assert TaskConf('www.Example.com').url == 'http://example.com/'
+
+
+def test_remove_dot_segments():
+    base_url = 'http://example.com/a/b/c'
+    cases = [
+        ('./d', 'http://example.com/a/b/d'),
+        ('../d', 'http://example.com/a/d'),
+        ('../../../../d', 'http://example.com/d'),
+        ('http://example.com/a/./b/../c/', 'http://example.com/a/c/'),
+        ('http://example.com/a/b/..', 'http://example.com/a/'),
+        ('http://example.com/a/b/.', 'http://example.com/a/b/'),
+        ('http://example.com/a.b/c', 'http://example.com/a.b/c')
+    ]
+    for url, canonical_url in cases:
+        normalized = UrlNormalizer.normalize(url, base_url)
+        print(url + ' = ' + str(normalized))
+        assert normalized == canonical_url
+
+
+def test_discard():
+    base_url = 'http://example.com/'
+    for url in ['#top', '', 'a b.html', 'mailto:a@example.com', 'javascript:void(0)',
+                'ftp://example.com/x', 'http://:80/x', '/f.zip', '/img/A.JPG', '/s.tar.gz']:
+        normalized = UrlNormalizer.normalize(url, base_url)
+        print(repr(url) + ' = ' + str(normalized))
+        assert normalized is None
+    # the suffix name of the last segment only
+    assert UrlNormalizer.normalize('/f.zip/index.html', base_url) == 'http://example.com/f.zip/index.html'
+    assert UrlNormalizer.normalize('/f.php?file=a.zip', base_url) == 'http://example.com/f.php?file=a.zip'
+    # pages of a .php script are HTML, and crawled
+    assert UrlNormalizer.normalize('/index.PHP', base_url) == 'http://example.com/index.PHP'
+
+
+def test_html_parser_lists():
+    assert isinstance(HtmlParser.BAD_CHARACTERS, list) and isinstance(HtmlParser.BAD_SUFFIX_NAMES, list)
+    assert '.zip' in HtmlParser.BAD_SUFFIX_NAMES and '.php' not in HtmlParser.BAD_SUFFIX_NAMES
+    # the lists are the ones the normalizer checks links against
+    for character in HtmlParser.BAD_CHARACTERS:
+        assert UrlNormalizer.normalize('/a' + character + 'b', 'http://example.com/') is None
+    for name in HtmlParser.BAD_SUFFIX_NAMES:
+        assert UrlNormalizer.normalize('/a' + name, 'http://example.com/') is None
+
+
+def test_filter_urls():
+    urls = ['http://example.com/', 'http://www.example.com/', 'http://badexample.com/',
+            'http://example.com:8080/']
+    assert list(UrlNormalizer.filter_urls(urls, 'example.com')) == \
+        ['http://example.com/', 'http://www.example.com/', 'http://example.com:8080/']
+    assert list(UrlNormalizer.filter_urls(urls, 'example.com:8080')) == ['http://example.com:8080/']
+
+
+def test_redirect_map():
+    redirect_map = RedirectMap()
+    redirect_map.save_redirects([('http://example.com/a', 301), ('http://example.com/b', 302)],
+                                'http://example.com/c')
+    assert redirect_map.find_redirect('http://example.com/a') == 'http://example.com/c'
+    assert redirect_map.find_redirect('http://example.com/b') == 'http://example.com/c'
+    assert redirect_map.find_redirect('http://example.com/c') is None
+    # the least recently used urls are dropped first
+    max_entries = RedirectMap.MAX_ENTRIES
+    RedirectMap.MAX_ENTRIES = 2
+    try:
+        redirect_map.find_redirect('http://example.com/a')
+        redirect_map.save_redirects([('http://example.com/d', 301)], 'http://example.com/c')
+    finally:
+        RedirectMap.MAX_ENTRIES = max_entries
+    assert redirect_map.find_redirect('http://example.com/a') == 'http://example.com/c'
+    assert redirect_map.find_redirect('http://example.com/b') is None
+    assert redirect_map.find_redirect('http://example.com/d') == 'http://example.com/c'
+
+
+def test_fetched_urls():
+    fetched_urls = FetchedUrls()
+    assert fetched_urls.claim('http://example.com/a')
+    # a popped url is not fetched again as a redirect target
+    assert not fetched_urls.claim_target('http://example.com/a')
+    assert fetched_urls.claim_target('http://example.com/b')
+    assert not fetched_urls.claim_target('http://example.com/b')
+    # nor a redirect target as a popped url
+    assert not fetched_urls.claim('http://example.com/b')
+
+
+if __name__ == '__main__':
+    test_canonicalize()
+    test_remove_dot_segments()
+    test_discard()
+    test_filter_urls()
+    test_html_parser_lists()
+    test_redirect_map()
+    test_fetched_urls()